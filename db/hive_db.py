@@ -1,11 +1,38 @@
+import atexit
+import hashlib
+import os
 import sqlite3
 import time
-from contextlib import closing
+from contextlib import closing, contextmanager
+from itertools import product
+
+from db import move_codec
+from db import metrics
+from db.sources import BGA_START, BGA_END, ENTOMOLOGY_START, ENTOMOLOGY_END, SOURCES, table_source
 
-BGA_START = 100000000 # 100,000,000
-BGA_END =   999999999
 BOT_NAMES = ['Dumbot', 'WeakBot', 'SmartBot']
-DB_NAME = 'db/hivemind.db'
+DB_NAME = os.environ.get('HIVEMIND_DB', 'db/hivemind.db')  # see use_db() to point it elsewhere
+EXPORT_FETCH_SIZE = 10000 # rows fetched per round trip when streaming tables and actions
+WRITER_BATCH_SIZE = 200      # tables buffered by TableWriter before a flush
+WRITER_FLUSH_INTERVAL = 30   # max seconds a TableWriter holds results before a flush
+FINGERPRINT_MIN_MOVES = 10   # shorter games (early resignations, draws) are too often identical by chance to be fingerprinted
+NON_MOVE_NOTATIONS = ['offer-draw', 'accept-draw', 'decline-draw', 'resign']
+BGA_PASS_TYPE = 'message'
+BGA_ACCEPT_DRAW_TYPE = 'acceptDraw'
+BGA_DRAW_WINNERS = [0, 1]    # 0 is a mutually agreed draw, 1 both queens surrounded at once
+BS_ACCEPT_DRAW = 'accept-draw'
+_, _, DRAW, WHITE_WINS, BLACK_WINS = move_codec.GAME_STATES
+BS_RESULTS = {'white wins': WHITE_WINS, 'black wins': BLACK_WINS, 'draw': DRAW}  # BoardSpace winner strings
+FRONTIER_FIRST_SEARCH_DAYS = 360  # history covered by a player's first search, 12 months of 30 days
+FRONTIER_RANK_WEIGHT = 10         # the top ranked player is searched as if they played 11 times as often, the 10th twice
+FRONTIER_DEFAULT_RATE = 0.1       # games per day expected from a player with no search or stored game yet
+DB_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',     # readers no longer block the scrapers' writes
+    'PRAGMA synchronous = NORMAL',   # with WAL, only checkpoints fsync instead of every commit
+    'PRAGMA cache_size = -65536',    # 64MB page cache
+    'PRAGMA mmap_size = 268435456',  # 256MB memory mapped I/O
+    'PRAGMA temp_store = MEMORY',
+]
 DB_SCHEMA = '''
 BEGIN;
 CREATE TABLE IF NOT EXISTS actions(
@@ -40,48 +67,558 @@ CREATE TABLE IF NOT EXISTS game_strings(
 );
 COMMIT;
 '''
+# each entry upgrades the schema by one version, tracked through PRAGMA user_version
+MIGRATIONS = [
+    # 1: secondary indexes for the export, moves list and player lookups
+    '''
+    CREATE INDEX IF NOT EXISTS actions_table_move ON actions(table_id, move_number, notation DESC, type, type_copied);
+    CREATE INDEX IF NOT EXISTS tables_expansions ON tables(uses_mosquito, uses_ladybug, uses_pillbug);
+    CREATE INDEX IF NOT EXISTS tables_player_white ON tables(player_white);
+    CREATE INDEX IF NOT EXISTS tables_player_black ON tables(player_black);
+    ''',
+    # 2: compact storage of each game's UHP moves, packed by db/move_codec.py
+    '''
+    CREATE TABLE IF NOT EXISTS games(
+        table_id INTEGER PRIMARY KEY,
+        state INTEGER NOT NULL,
+        moves BLOB NOT NULL,
+        FOREIGN KEY(table_id) REFERENCES tables(table_id)
+    );
+    ''',
+    # 3: per account BGA replay quota tracking
+    '''
+    CREATE TABLE IF NOT EXISTS accounts(
+        email TEXT PRIMARY KEY,
+        replays_used INTEGER NOT NULL DEFAULT 0,
+        replay_limit INTEGER,
+        window_start INTEGER,
+        depleted_timestamp INTEGER
+    );
+    ''',
+    # 4: resumable index ranges of a sharded crawl, next_index is the first index not yet committed
+    '''
+    CREATE TABLE IF NOT EXISTS crawl_shards(
+        shard_id INTEGER PRIMARY KEY,
+        start_index INTEGER NOT NULL,
+        end_index INTEGER NOT NULL,
+        next_index INTEGER NOT NULL
+    );
+    ''',
+    # 5: last table_id appended to an incremental game strings export, per filter combination
+    '''
+    CREATE TABLE IF NOT EXISTS export_watermarks(
+        filters TEXT PRIMARY KEY,
+        last_table_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        exported INTEGER NOT NULL,
+        updated INTEGER NOT NULL
+    );
+    ''',
+    # 6: fingerprint of each game's moves, so the same game can't be stored twice under different table_ids
+    '''
+    ALTER TABLE tables ADD COLUMN fingerprint INTEGER;
+    CREATE UNIQUE INDEX IF NOT EXISTS tables_fingerprint ON tables(fingerprint);
+    ''',
+    # 7: results of every finished game per player, color and expansions, kept up to date by every insert and delete.
+    # moves is the total number of moves of those games. Databases migrated from an older version need a rebuild.
+    '''
+    CREATE TABLE IF NOT EXISTS player_stats(
+        player_id INTEGER NOT NULL,
+        color TEXT NOT NULL,
+        uses_mosquito INTEGER NOT NULL,
+        uses_ladybug INTEGER NOT NULL,
+        uses_pillbug INTEGER NOT NULL,
+        games INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        losses INTEGER NOT NULL,
+        draws INTEGER NOT NULL,
+        moves INTEGER NOT NULL,
+        PRIMARY KEY(player_id, color, uses_mosquito, uses_ladybug, uses_pillbug)
+    );
+    ''',
+    # 8: BGA player discovery frontier, seeded with every player of a stored BGA table.
+    # rank is the player's arena rank when last seen in the ranking, games_per_day the new tables found per day
+    # by their last search
+    f'''
+    ALTER TABLE players ADD COLUMN rank INTEGER;
+    ALTER TABLE players ADD COLUMN games_per_day REAL;
+    INSERT OR IGNORE INTO players(player_id)
+    SELECT player_white FROM tables WHERE table_id >= {BGA_START} AND table_id <= {BGA_END}
+    UNION SELECT player_black FROM tables WHERE table_id >= {BGA_START} AND table_id <= {BGA_END};
+    ''',
+    # 9: match history watermark of each player, the newest table_id seen and the end of the last complete search
+    '''
+    ALTER TABLE players ADD COLUMN history_table_id INTEGER;
+    ALTER TABLE players ADD COLUMN history_timestamp INTEGER;
+    ''',
+    # 10: crawled games that could not be fetched or decoded, kept to be retried instead of being lost behind a checkpoint
+    '''
+    CREATE TABLE IF NOT EXISTS crawl_failures(
+        table_id INTEGER PRIMARY KEY,
+        reason TEXT NOT NULL,
+        timestamp INTEGER NOT NULL
+    );
+    ''',
+    # 11: insertion sequence of each table, bumped whenever the table is written again, so incremental exports pick up
+    # tables stored out of table_id order. Existing tables keep their table_id, which keeps the export watermarks valid.
+    '''
+    ALTER TABLE tables ADD COLUMN seq INTEGER;
+    UPDATE tables SET seq = table_id;
+    CREATE INDEX IF NOT EXISTS tables_seq ON tables(seq);
+    ALTER TABLE export_watermarks RENAME COLUMN last_table_id TO last_seq;
+    ''',
+    # 12: BGA tables found in a match history but not stored yet, scraped first by the next run since the player's
+    # history watermark has already moved past them. attempts counts the scrapes that failed with an error.
+    '''
+    CREATE TABLE IF NOT EXISTS pending_tables(
+        table_id INTEGER PRIMARY KEY,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        timestamp INTEGER NOT NULL
+    );
+    ''',
+]
+TABLE_COLUMNS = 'table_id, player_white, player_black, winner, uses_mosquito, uses_ladybug, uses_pillbug'
+MOVES_LIST_QUERY = '''
+SELECT * FROM actions WHERE table_id = ?
+ORDER BY move_number ASC, notation DESC
+'''
+PLAYER_TABLES_QUERY = f'''
+SELECT {TABLE_COLUMNS} FROM tables WHERE player_white = ? OR player_black = ?
+ORDER BY table_id ASC
+'''
+FINGERPRINT_QUERY = '''
+SELECT table_id FROM tables WHERE fingerprint = ? AND table_id != ?
+'''
+# expected new games since the last search, weighted by rank. A player's first search covers FRONTIER_FIRST_SEARCH_DAYS
+# and is estimated from the games already stored with them
+FRONTIER_QUERY = '''
+SELECT player_id FROM players
+ORDER BY COALESCE(games_per_day,
+                  (SELECT SUM(games) * 1.0 FROM player_stats s WHERE s.player_id = players.player_id) / :first_search_days,
+                  :default_rate)
+         * MIN(:now - COALESCE(last_search_timestamp, 0), :first_search_days * 86400) / 86400.0
+         * (CASE WHEN rank IS NULL THEN 1 ELSE 1 + :rank_weight / CAST(rank AS REAL) END) DESC
+LIMIT :limit
+'''
+PLAYER_STATS_QUERY = '''
+SELECT color, uses_mosquito, uses_ladybug, uses_pillbug, games, wins, losses, draws, CAST(moves AS REAL) / games
+FROM player_stats WHERE player_id = ?
+ORDER BY color DESC, uses_mosquito, uses_ladybug, uses_pillbug
+'''
 
 
-def init():
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
-                cur.executescript(DB_SCHEMA)
-    except Exception as e:
-        print('ERROR: init() failed: ', e)
-        exit(-1)
+def move_notations(moves):
+    ''' Returns the MoveStrings of a game's (move_number, notation, type) moves, in play order with passes
+    '''
+    notations = []
+    # same order as MOVES_LIST_QUERY
+    for _, notation, move_type in sorted(sorted(moves, key=lambda move: move[1] or '', reverse=True), key=lambda move: move[0]):
+        if notation:
+            notation = notation.strip('[]').strip()
+            if notation.lower() not in NON_MOVE_NOTATIONS:
+                notations.append(notation)
+        elif move_type == BGA_PASS_TYPE:
+            notations.append('pass')
 
+    return notations
 
-def searched_player(player_id):
-    ''' Updates players table with new timestamp to increase scraping efficieny
+
+def move_fingerprint(m, l, p, moves):
+    ''' Returns a signed 64 bit hash of a game's expansions and MoveStrings, the same whichever source it came from,
+        or None for games shorter than FINGERPRINT_MIN_MOVES. moves are (move_number, notation, type) tuples.
     '''
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
+    notations = move_notations(moves)
+    if len(notations) < FINGERPRINT_MIN_MOVES:
+        return
+
+    game = f'{int(bool(m))}{int(bool(l))}{int(bool(p))};' + ';'.join(notations)
+    return int.from_bytes(hashlib.blake2b(game.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+def game_result(white, black, winner, moves):
+    ''' Returns the GameStateString of a finished game from its tables row and (move_number, notation, type) moves,
+        or None if it has no result. An accepted draw offer overrides the winner.
+    '''
+    state = None
+    if isinstance(winner, str): # BoardSpace uses a string for the winner
+        state = BS_RESULTS.get(winner)
+    elif isinstance(winner, int): # BoardGameArena uses an ID for a winner
+        if winner in BGA_DRAW_WINNERS:
+            state = DRAW
+        elif winner == white:
+            state = WHITE_WINS
+        elif winner == black:
+            state = BLACK_WINS
+        else:
+            return
+
+    if any(notation == BS_ACCEPT_DRAW or (not notation and move_type == BGA_ACCEPT_DRAW_TYPE) for _, notation, move_type in moves):
+        state = DRAW
+
+    return state
+
+
+def add_player_stats(stats, table, moves, sign=1):
+    ''' Adds (or with sign -1 removes) a tables row and its (move_number, notation, type) moves to
+        {(player_id, color, m, l, p): [games, wins, losses, draws, moves]}. Unfinished games are ignored.
+    '''
+    _, white, black, winner, m, l, p = table
+    state = game_result(white, black, winner, moves)
+    if state is None:
+        return
+
+    plies = len(move_notations(moves))
+    for player, color, win, loss in [(white, 'white', WHITE_WINS, BLACK_WINS), (black, 'black', BLACK_WINS, WHITE_WINS)]:
+        totals = stats.setdefault((player, color, m, l, p), [0, 0, 0, 0, 0])
+        for i, value in enumerate([1, state == win, state == loss, state == DRAW, plies]):
+            totals[i] += sign * value
+
+
+def _table_filter(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, prefix='', table_range=None, seq_range=None):
+    ''' Returns the WHERE clause and its params used to filter the tables table,
+        optionally limited to an inclusive (first, last) table_id range and to the tables written after seq_range[0]
+        up to seq_range[1] included
+    '''
+    params = [uses_m, uses_l, uses_p]
+    query = f'''
+            ({prefix}uses_mosquito = ? AND {prefix}uses_ladybug = ? AND {prefix}uses_pillbug = ?)
+            '''
+    if table_range:
+        params += list(table_range)
+        query += f'''
+                 AND
+                 ({prefix}table_id >= ? AND {prefix}table_id <= ?)
+                 '''
+    if seq_range:
+        params += list(seq_range)
+        query += f'''
+                 AND
+                 ({prefix}seq > ? AND {prefix}seq <= ?)
+                 '''
+    if not include_bs:
+        params += [BGA_START, BGA_END]
+        query += f'''
+                 AND
+                 ({prefix}table_id >= ? AND {prefix}table_id <= ?)
+                 '''
+    elif not include_bga:
+        params += [BGA_START, BGA_END]
+        query += f'''
+                 AND
+                 ({prefix}table_id < ? OR {prefix}table_id > ?)
+                 '''
+
+    if not include_bots:
+        params += BOT_NAMES + BOT_NAMES
+        query += f'''
+                AND
+                ({prefix}player_white != ? AND {prefix}player_white != ? AND {prefix}player_white != ?)
+                AND
+                ({prefix}player_black != ? AND {prefix}player_black != ? AND {prefix}player_black != ?)
+                '''
+
+    return query, params
+
+
+class HiveDB:
+    ''' Long-lived handle to the hivemind database.
+        Holds a single tuned sqlite3 connection instead of connecting on every call.
+    '''
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name or DB_NAME
+        self.con = sqlite3.connect(self.db_name)
+        for pragma in DB_PRAGMAS:
+            self.con.execute(pragma)
+        # a new file is created at the latest schema, only an existing database is worth reporting as upgraded
+        fresh = not self.con.execute('SELECT 1 FROM sqlite_master').fetchone()
+        self.con.executescript(DB_SCHEMA)
+        version = self.migrate()
+        if not fresh and version < len(MIGRATIONS):
+            print(f'Migrated {self.db_name} from schema version {version} to {len(MIGRATIONS)}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def migrate(self):
+        ''' Applies every migration newer than the database's user_version, each in its own transaction.
+            Returns the schema version the database was at.
+        '''
+        version = self.con.execute('PRAGMA user_version').fetchone()[0]
+        for new_version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                self.con.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {new_version};\nCOMMIT;')
+            except Exception as e:
+                self.con.rollback()
+                raise RuntimeError(f'migration to schema version {new_version} failed: {e}')
+
+        return version
+
+    def query_plan(self, query, params=()):
+        ''' Returns the EXPLAIN QUERY PLAN detail lines for the given query
+        '''
+        with closing(self.con.cursor()) as cur:
+            cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+
+            return [row[3] for row in cur.fetchall()]
+
+    def check_query_plans(self):
+        ''' Returns {name: plan} for every hot query whose plan still contains a full table scan
+        '''
+        where, params = _table_filter(False, True, True, True, True, True)
+        hot_queries = {
+            'get_moves_list': (MOVES_LIST_QUERY, [0]),
+            'get_player_tables': (PLAYER_TABLES_QUERY, [0, 0]),
+            'get_all_table_data': (f'SELECT {TABLE_COLUMNS} FROM tables WHERE ' + where, params),
+            'insert_many_table_data(fingerprint)': (FINGERPRINT_QUERY, [0, 0]),
+            'get_player_stats': (PLAYER_STATS_QUERY, [0]),
+            'iter_table_moves': self._table_moves_query(False, True, True, True, True, True, False),
+            'iter_table_moves(bga)': self._table_moves_query(False, True, True, True, True, False, False),
+            'iter_table_moves(bs)': self._table_moves_query(False, True, True, True, False, True, False),
+            'iter_table_moves(range)': self._table_moves_query(False, True, True, True, True, False, False, (BGA_START, BGA_END)),
+            'iter_table_moves(seq)': self._table_moves_query(False, True, True, True, True, True, False, None, (0, 0)),
+        }
+
+        full_scans = {}
+        for name, (query, params) in hot_queries.items():
+            plan = self.query_plan(query, params)
+            if any(detail.startswith('SCAN') for detail in plan):
+                full_scans[name] = plan
+
+        return full_scans
+
+    def searched_player(self, player_id, new_tables=None):
+        ''' Updates players table with new timestamp to increase scraping efficieny.
+            new_tables, the number of tables the search found that weren't stored yet, updates the player's games per day.
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
                 now = int(time.time())
-                cur.execute('INSERT OR IGNORE INTO players(player_id, last_search_timestamp) VALUES(?,?)', [player_id, now])
-                cur.execute('UPDATE players SET last_search_timestamp = ? WHERE player_id = ?', [now, player_id])
-                con.commit()
+                cur.execute('INSERT OR IGNORE INTO players(player_id) VALUES(?)', [player_id])
+                # one extra game keeps players who had nothing new slowly coming back as they go stale
+                cur.execute(
+                    '''
+                    UPDATE players SET games_per_day = CASE WHEN :new_tables IS NULL THEN games_per_day
+                    ELSE (:new_tables + 1) * 86400.0 / MAX(:now - COALESCE(last_search_timestamp, :now - :first_search), 86400) END,
+                    last_search_timestamp = :now
+                    WHERE player_id = :player_id
+                    ''',
+                    {'new_tables': new_tables, 'now': now, 'first_search': FRONTIER_FIRST_SEARCH_DAYS * 86400, 'player_id': player_id}
+                )
 
-    except Exception as e:
-        print(f'ERROR inserting player_id {player_id}: ', e)
+        except Exception as e:
+            print(f'ERROR inserting player_id {player_id}: ', e)
 
+    def get_history_watermarks(self, player_ids):
+        ''' Returns {player_id: (history_table_id, history_timestamp)} for the given players searched before
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                watermarks = {}
+                for player_id in player_ids:
+                    row = cur.execute('SELECT history_table_id, history_timestamp FROM players WHERE player_id = ? AND history_timestamp IS NOT NULL',
+                                      [player_id]).fetchone()
+                    if row:
+                        watermarks[player_id] = row
 
-def insert_table_data(table_id, player_white, player_black, winner, m, l, p, actions):
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
-                # create or update tables table
+                return watermarks
+
+        except Exception as e:
+            print(f'ERROR retrieving history watermarks: ', e)
+            return {}
+
+    def set_history_watermark(self, player_id, table_id, timestamp):
+        ''' Records the newest table_id in a player's match history, and the end of the search that covered it entirely
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.execute('INSERT OR IGNORE INTO players(player_id) VALUES(?)', [player_id])
+                cur.execute('UPDATE players SET history_table_id = ?, history_timestamp = ? WHERE player_id = ?', [table_id, timestamp, player_id])
+
+        except Exception as e:
+            print(f'ERROR updating history watermark for player_id {player_id}: ', e)
+
+    def add_pending_tables(self, table_ids):
+        ''' Queues table_ids found in a match history to be scraped, keeping the ones already queued as they are
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                now = int(time.time())
+                cur.executemany('INSERT OR IGNORE INTO pending_tables(table_id, timestamp) VALUES(?,?)', [[table_id, now] for table_id in table_ids])
+
+        except Exception as e:
+            print(f'ERROR queueing {len(table_ids)} pending tables: ', e)
+
+    def get_pending_tables(self):
+        ''' Returns the table_ids still to be scraped, the longest queued first
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT table_id FROM pending_tables ORDER BY timestamp ASC, table_id ASC')
+
+                return [row[0] for row in cur.fetchall()]
+
+        except Exception as e:
+            print(f'ERROR retrieving pending tables: ', e)
+            return []
+
+    def delete_pending_tables(self, table_ids):
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('DELETE FROM pending_tables WHERE table_id = ?', [[table_id] for table_id in table_ids])
+
+        except Exception as e:
+            print(f'ERROR deleting pending tables: ', e)
+
+    def fail_pending_tables(self, table_ids, max_attempts):
+        ''' Counts a failed scrape of each of table_ids, giving up on the ones that failed max_attempts times
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('UPDATE pending_tables SET attempts = attempts + 1 WHERE table_id = ?', [[table_id] for table_id in table_ids])
+                cur.execute('DELETE FROM pending_tables WHERE attempts >= ?', [max_attempts])
+
+        except Exception as e:
+            print(f'ERROR updating pending tables: ', e)
+
+    def set_player_ranks(self, player_ids):
+        ''' Records the arena ranking, best player first, forgetting the ranks of players no longer in it
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.execute('UPDATE players SET rank = NULL WHERE rank IS NOT NULL')
+                cur.executemany('INSERT OR IGNORE INTO players(player_id) VALUES(?)', [[player_id] for player_id in player_ids])
+                cur.executemany('UPDATE players SET rank = ? WHERE player_id = ?',
+                                [(rank, player_id) for rank, player_id in enumerate(player_ids, start=1)])
+
+        except Exception as e:
+            print(f'ERROR updating player ranks: ', e)
+
+    def get_frontier(self, limit):
+        ''' Returns the ids of the limit players most worth searching next: the most new games expected since their
+            last search, weighted towards the top of the ranking
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute(FRONTIER_QUERY, {'now': int(time.time()), 'first_search_days': FRONTIER_FIRST_SEARCH_DAYS,
+                                             'default_rate': FRONTIER_DEFAULT_RATE, 'rank_weight': FRONTIER_RANK_WEIGHT,
+                                             'limit': limit})
+
+                return [row[0] for row in cur.fetchall()]
+
+        except Exception as e:
+            print(f'ERROR retrieving the player frontier: ', e)
+
+    def get_account(self, email):
+        ''' Returns the (email, replays_used, replay_limit, window_start, depleted_timestamp) row for a BGA account
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT * FROM accounts WHERE email = ?', [email])
+
+                return cur.fetchone()
+
+        except Exception as e:
+            print(f'ERROR retrieving account {email}: ', e)
+
+    def update_account_quota(self, email, replays, depleted):
+        ''' Adds replays to the account's usage in its current window, and records when it was depleted.
+            The replays used at depletion become the account's replay_limit.
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                now = int(time.time())
+                cur.execute('INSERT OR IGNORE INTO accounts(email, window_start) VALUES(?,?)', [email, now])
                 cur.execute(
+                    '''
+                    UPDATE accounts SET replays_used = replays_used + ?,
+                    replay_limit = CASE WHEN ? THEN replays_used + ? ELSE replay_limit END,
+                    depleted_timestamp = CASE WHEN ? THEN ? ELSE depleted_timestamp END
+                    WHERE email = ?
+                    ''',
+                    [replays, depleted, replays, depleted, now, email]
+                )
+
+        except Exception as e:
+            print(f'ERROR updating quota for account {email}: ', e)
+
+    def reset_account_quota(self, email):
+        ''' Starts a new replay window for the account
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                now = int(time.time())
+                cur.execute('INSERT OR IGNORE INTO accounts(email, window_start) VALUES(?,?)', [email, now])
+                cur.execute('UPDATE accounts SET replays_used = 0, window_start = ?, depleted_timestamp = NULL WHERE email = ?', [now, email])
+
+        except Exception as e:
+            print(f'ERROR resetting quota for account {email}: ', e)
+
+    def insert_table_data(self, table_id, player_white, player_black, winner, m, l, p, actions):
+        return self.insert_many_table_data([(table_id, player_white, player_black, winner, m, l, p, actions)])
+
+    def insert_many_table_data(self, rows, checkpoints=(), replace=False, failures=()):
+        ''' Inserts (table_id, player_white, player_black, winner, m, l, p, actions) rows in a single transaction,
+            together with any (next_index, shard_id) crawl checkpoints and the (table_id, reason) of the crawled
+            games that failed before them. Returns True if everything was written.
+            With replace, the tables' existing actions are dropped first instead of being merged with the new ones.
+            Rows whose moves match another table's fingerprint are duplicates and skipped.
+        '''
+        try:
+            with metrics.timer('db_insert'), self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('UPDATE crawl_shards SET next_index = ? WHERE shard_id = ?', checkpoints)
+                cur.executemany('INSERT OR REPLACE INTO crawl_failures(table_id, reason, timestamp) VALUES(?,?,?)',
+                                [(table_id, reason, int(time.time())) for table_id, reason in failures])
+
+                # drop games already stored under another table_id, including earlier in this batch
+                fingerprints = {}
+                unique_rows = []
+                for row in rows:
+                    fingerprint = move_fingerprint(*row[4:7], [(action.get('move_number', -1), action.get('notation', ''),
+                                                                 action.get('type', '')) for action in row[7]])
+                    duplicate = fingerprints.get(fingerprint)
+                    if fingerprint is not None and duplicate is None:
+                        duplicate = cur.execute(FINGERPRINT_QUERY, [fingerprint, row[0]]).fetchone()
+                        duplicate = duplicate and duplicate[0]
+                    if duplicate is not None and duplicate != row[0]:
+                        print(f'Skipping table_id {row[0]}, same game as table_id {duplicate}')
+                        metrics.count('db_duplicates')
+                        continue
+
+                    if fingerprint is not None:
+                        fingerprints[fingerprint] = row[0]
+                    unique_rows.append((*row, fingerprint))
+                rows = unique_rows
+
+                # player_stats swaps the tables' previous results, if any, for their new ones
+                stats = {}
+                self._add_tables_stats(cur, [row[0] for row in rows], stats, -1)
+
+                if replace:
+                    cur.executemany('DELETE FROM actions WHERE table_id = ?', [row[:1] for row in rows])
+
+                # create or update tables table, every written table getting the next insertion sequence
+                seq = cur.execute('SELECT COALESCE(MAX(seq), 0) FROM tables').fetchone()[0]
+                cur.executemany(
                     '''
                     INSERT OR REPLACE INTO tables(table_id, player_white, player_black,
-                    winner, uses_mosquito, uses_ladybug, uses_pillbug) VALUES(?,?,?,?,?,?,?)
-                    ''', 
-                    [table_id, player_white, player_black, winner, m, l, p]
+                    winner, uses_mosquito, uses_ladybug, uses_pillbug, fingerprint, seq) VALUES(?,?,?,?,?,?,?,?,?)
+                    ''',
+                    [(*row[:7], row[8], seq + i) for i, row in enumerate(rows, start=1)]
                 )
 
+                # both players of a BGA table join the discovery frontier
+                cur.executemany('INSERT OR IGNORE INTO players(player_id) VALUES(?)',
+                                [[player_id] for row in rows if table_source(row[0]) == 'bga' for player_id in row[1:3]])
+
                 # convert actions into tuples for insert
-                convert = lambda action, table_id=table_id: (
+                convert = lambda action, table_id: (
                     action.get('move_number', -1),
                     action.get('notation', ''),
                     table_id,
@@ -89,7 +626,7 @@ def insert_table_data(table_id, player_white, player_black, winner, m, l, p, act
                     action.get('type_copied', ''),
                     action.get('log', '')
                 )
-                actions_params = list(map(convert, actions))
+                actions_params = [convert(action, row[0]) for row in rows for action in row[7]]
 
                 # bulk add/update actions
                 cur.executemany(
@@ -101,93 +638,625 @@ def insert_table_data(table_id, player_white, player_black, winner, m, l, p, act
                     actions_params
                 )
 
-                con.commit()
+                self._add_tables_stats(cur, [row[0] for row in rows], stats)
+                self._update_player_stats(cur, stats)
 
-    except Exception as e:
-        print(f'ERROR inserting table_id {table_id}: ', e)
+                # a failed game that got through on a retry, or a queued BGA table
+                cur.executemany('DELETE FROM crawl_failures WHERE table_id = ?', [row[:1] for row in rows])
+                cur.executemany('DELETE FROM pending_tables WHERE table_id = ?', [row[:1] for row in rows])
 
+            metrics.count('db_tables_inserted', len(rows))
+            return True
+
+        except Exception as e:
+            if len(rows) == 1:
+                print(f'ERROR inserting table_id {rows[0][0]}: ', e)
+            else:
+                print(f'ERROR inserting batch of {len(rows)} tables: ', e)
+            metrics.count('db_errors')
+            return False
+
+    def _add_tables_stats(self, cur, table_ids, stats, sign=1):
+        ''' Adds the stored results of the given tables to a add_player_stats() dict
+        '''
+        for table_id in table_ids:
+            table = cur.execute(f'SELECT {TABLE_COLUMNS} FROM tables WHERE table_id = ?', [table_id]).fetchone()
+            if table:
+                moves = cur.execute(MOVES_LIST_QUERY, [table_id]).fetchall()
+                add_player_stats(stats, table, [(move[0], move[1], move[3]) for move in moves], sign)
+
+    def _update_player_stats(self, cur, stats):
+        ''' Adds a add_player_stats() dict to the player_stats table
+        '''
+        cur.executemany(
+            '''
+            INSERT INTO player_stats(player_id, color, uses_mosquito, uses_ladybug, uses_pillbug, games, wins, losses, draws, moves)
+            VALUES(?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(player_id, color, uses_mosquito, uses_ladybug, uses_pillbug) DO UPDATE SET
+            games = games + excluded.games, wins = wins + excluded.wins, losses = losses + excluded.losses,
+            draws = draws + excluded.draws, moves = moves + excluded.moves
+            ''',
+            [(*key, *totals) for key, totals in stats.items() if any(totals)]
+        )
+        cur.executemany(
+            '''
+            DELETE FROM player_stats WHERE player_id = ? AND color = ? AND uses_mosquito = ? AND uses_ladybug = ?
+            AND uses_pillbug = ? AND games = 0
+            ''',
+            [key for key, totals in stats.items() if totals[0] < 0]
+        )
+
+    def rebuild_player_stats(self):
+        ''' Recomputes the player_stats table from every table, holding the write lock so no insert is missed.
+            Returns the number of player_stats rows.
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.execute('BEGIN IMMEDIATE')
+                stats = {}
+                for m, l, p in product([True, False], repeat=3):
+                    for table, moves in self.iter_table_moves(True, m, l, p):
+                        add_player_stats(stats, table, [(move[0], move[1], move[3]) for move in moves])
+
+                cur.execute('DELETE FROM player_stats')
+                self._update_player_stats(cur, stats)
+
+                return len(stats)
+
+        except Exception as e:
+            print(f'ERROR rebuilding player stats: ', e)
+
+    def get_player_stats(self, player_id):
+        ''' Returns a (color, m, l, p, games, wins, losses, draws, average moves) row
+            for every color and expansions combination player_id finished a game with
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute(PLAYER_STATS_QUERY, [player_id])
+
+                return cur.fetchall()
+
+        except Exception as e:
+            print(f'ERROR retrieving stats for player_id {player_id}: ', e)
+
+    def get_crawl_shards(self):
+        ''' Returns every (shard_id, start_index, end_index, next_index) row of the sharded crawl
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT * FROM crawl_shards ORDER BY shard_id ASC')
+
+                return cur.fetchall()
+
+        except Exception as e:
+            print(f'ERROR retrieving crawl shards: ', e)
+
+    def add_crawl_shards(self, ranges):
+        ''' Adds a shard for every (start_index, end_index) range
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('INSERT INTO crawl_shards(start_index, end_index, next_index) VALUES(?,?,?)',
+                                [(start, end, start) for start, end in ranges])
+
+        except Exception as e:
+            print(f'ERROR adding crawl shards: ', e)
+
+    def get_crawl_failures(self):
+        ''' Returns the (table_id, reason, timestamp) of every crawled game that failed and was not retried successfully
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT * FROM crawl_failures ORDER BY table_id ASC')
+
+                return cur.fetchall()
+
+        except Exception as e:
+            print(f'ERROR retrieving crawl failures: ', e)
+
+    def delete_crawl_failures(self, table_ids):
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('DELETE FROM crawl_failures WHERE table_id = ?', [[table_id] for table_id in table_ids])
+
+        except Exception as e:
+            print(f'ERROR deleting crawl failures: ', e)
+
+    def update_table_expansions(self, table_id, m, l, p):
+        ''' Sets a table's expansions, moving its results in player_stats over to the new expansions.
+            Its fingerprint hashes the expansions too, and is dropped if the game turns out to be another table's.
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                stats = {}
+                self._add_tables_stats(cur, [table_id], stats, -1)
+
+                moves = cur.execute(MOVES_LIST_QUERY, [table_id]).fetchall()
+                fingerprint = move_fingerprint(m, l, p, [(move[0], move[1], move[3]) for move in moves])
+                duplicate = fingerprint is not None and cur.execute(FINGERPRINT_QUERY, [fingerprint, table_id]).fetchone()
+                if duplicate:
+                    print(f'table_id {table_id} is the same game as table_id {duplicate[0]}')
+                    metrics.count('db_duplicates')
+                    fingerprint = None
 
-def update_table_expansions(table_id, m, l, p):
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
                 cur.execute(
                     '''
-                    UPDATE tables SET uses_mosquito = ?, uses_ladybug = ?, uses_pillbug = ?
+                    UPDATE tables SET uses_mosquito = ?, uses_ladybug = ?, uses_pillbug = ?, fingerprint = ?,
+                    seq = (SELECT MAX(seq) FROM tables) + 1
                     WHERE table_id = ?
                     ''',
-                    [m, l, p, table_id]
+                    [m, l, p, fingerprint, table_id]
                 )
-                con.commit()
+                self._add_tables_stats(cur, [table_id], stats)
+                self._update_player_stats(cur, stats)
 
-    except Exception as e:
-        print(f'ERROR updating expansions: ', e)
+        except Exception as e:
+            print(f'ERROR updating expansions: ', e)
 
+    def get_all_table_data(self, include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, table_range = None):
+        try:
+            with closing(self.con.cursor()) as cur:
+                where, params = _table_filter(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, table_range=table_range)
+                cur.execute(f'SELECT {TABLE_COLUMNS} FROM tables WHERE ' + where, params)
 
-def get_all_table_data(include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True):
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
-                params = [uses_m, uses_l, uses_p]
-                query = '''
-                        SELECT * FROM tables WHERE
-                        (uses_mosquito = ? AND uses_ladybug = ? AND uses_pillbug = ?)
-                        '''
-                if not include_bs:
-                    params += [BGA_START, BGA_END]
-                    query += '''
-                             AND
-                             (table_id >= ? AND table_id <= ?)
-                             '''
-                elif not include_bga:
-                    params += [BGA_START, BGA_END]
-                    query += '''
-                             AND
-                             (table_id < ? OR table_id > ?)
-                             '''
-
-                if not include_bots:
-                    params += BOT_NAMES + BOT_NAMES
-                    query += '''
-                            AND
-                            (player_white != ? AND player_white != ? AND player_white != ?)
-                            AND
-                            (player_black != ? AND player_black != ? AND player_black != ?)
-                            '''
+                return cur.fetchall()
+
+        except Exception as e:
+            print(f'ERROR retrieving from tables: ', e)
+
+    def iter_table_moves(self, include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, include_log = False, table_range = None, seq_range = None):
+        ''' Streams every matching table together with its ordered moves list using a single query.
+            Yields (table_row, moves) tuples shaped like the rows of get_all_table_data() and get_moves_list().
+            Tables without any actions are yielded with an empty moves list.
+        '''
+        query, params = self._table_moves_query(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, include_log, table_range, seq_range)
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.arraysize = EXPORT_FETCH_SIZE
                 cur.execute(query, params)
 
-                return cur.fetchall()
+                table, moves = None, []
+                while rows := cur.fetchmany():
+                    for row in rows:
+                        if table is None or row[0] != table[0]:
+                            if table is not None:
+                                yield table, moves
+                            table, moves = row[:7], []
 
-    except Exception as e:
-        print(f'ERROR retrieving from tables: ', e)
+                        # LEFT JOIN produces a NULL action row for tables without moves
+                        if row[7] is not None:
+                            moves.append(row[7:])
 
+                if table is not None:
+                    yield table, moves
 
-def get_unique_table_ids():
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
+        except Exception as e:
+            print(f'ERROR streaming tables and actions: ', e)
+
+    def _table_moves_query(self, include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, include_log, table_range=None, seq_range=None):
+        where, params = _table_filter(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, prefix='t.', table_range=table_range, seq_range=seq_range)
+        query = f'''
+                SELECT t.table_id, t.player_white, t.player_black, t.winner,
+                       t.uses_mosquito, t.uses_ladybug, t.uses_pillbug,
+                       a.move_number, a.notation, a.table_id, a.type, a.type_copied,
+                       {'a.log' if include_log else 'NULL'}
+                FROM tables t LEFT JOIN actions a ON a.table_id = t.table_id
+                WHERE {where}
+                ORDER BY t.table_id ASC, a.move_number ASC, a.notation DESC
+                '''
+
+        return query, params
+
+    def get_table_ids(self, include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, table_range = None, seq_range = None):
+        ''' Returns the sorted table_ids of every matching table
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                where, params = _table_filter(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, table_range=table_range, seq_range=seq_range)
+                cur.execute('SELECT table_id FROM tables WHERE ' + where + ' ORDER BY table_id ASC', params)
+
+                return [row[0] for row in cur.fetchall()]
+
+        except Exception as e:
+            print(f'ERROR retrieving table_ids: ', e)
+
+    def get_written_table_ids(self, seq_range):
+        ''' Returns the table_ids of every table written after seq_range[0] up to seq_range[1] included, whatever its filters
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT table_id FROM tables WHERE seq > ? AND seq <= ?', list(seq_range))
+
+                return [row[0] for row in cur.fetchall()]
+
+        except Exception as e:
+            print(f'ERROR retrieving written table_ids: ', e)
+
+    def get_last_seq(self):
+        ''' Returns the insertion sequence of the last table written, 0 without any table
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT COALESCE(MAX(seq), 0) FROM tables')
+
+                return cur.fetchone()[0]
+
+        except Exception as e:
+            print(f'ERROR retrieving the last insertion sequence: ', e)
+
+    def get_table_fingerprints(self):
+        ''' Returns {fingerprint: table_id} for every table with a fingerprint
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT fingerprint, table_id FROM tables WHERE fingerprint IS NOT NULL')
+
+                return dict(cur.fetchall())
+
+        except Exception as e:
+            print(f'ERROR retrieving fingerprints: ', e)
+
+    def set_table_fingerprints(self, rows):
+        ''' Sets the fingerprint of every (fingerprint, table_id) row in a single transaction
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('UPDATE tables SET fingerprint = ? WHERE table_id = ?', rows)
+
+            return True
+
+        except Exception as e:
+            print(f'ERROR setting {len(rows)} fingerprints: ', e)
+            return False
+
+    def delete_tables(self, table_ids):
+        ''' Removes the given tables with their actions, compact games and game strings
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                stats = {}
+                self._add_tables_stats(cur, table_ids, stats, -1)
+                self._update_player_stats(cur, stats)
+
+                params = [[table_id] for table_id in table_ids]
+                for table in ['actions', 'games', 'game_strings', 'tables']:
+                    cur.executemany(f'DELETE FROM {table} WHERE table_id = ?', params)
+
+        except Exception as e:
+            print(f'ERROR deleting {len(table_ids)} tables: ', e)
+
+    def get_export_watermark(self, filters):
+        ''' Returns the (filters, last_seq, path, exported, updated) row of an incremental export
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute('SELECT * FROM export_watermarks WHERE filters = ?', [filters])
+
+                return cur.fetchone()
+
+        except Exception as e:
+            print(f'ERROR retrieving export watermark for {filters}: ', e)
+
+    def set_export_watermark(self, filters, last_seq, path, exported):
+        ''' Records the last insertion sequence covered by an incremental export and how many games its file now holds
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.execute('INSERT OR REPLACE INTO export_watermarks(filters, last_seq, path, exported, updated) VALUES(?,?,?,?,?)',
+                            [filters, last_seq, path, exported, int(time.time())])
+
+        except Exception as e:
+            print(f'ERROR updating export watermark for {filters}: ', e)
+
+    def insert_compact_games(self, rows):
+        ''' Inserts (table_id, state, moves) rows into the games table, see db/move_codec.py for the encoding
+        '''
+        try:
+            with self.con, closing(self.con.cursor()) as cur:
+                cur.executemany('INSERT OR REPLACE INTO games(table_id, state, moves) VALUES(?,?,?)', rows)
+
+        except Exception as e:
+            print(f'ERROR inserting {len(rows)} compact games: ', e)
+
+    def iter_compact_games(self, include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True):
+        ''' Streams (table_row, state, moves) for every matching table stored in the games table
+        '''
+        where, params = _table_filter(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, prefix='t.')
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.arraysize = EXPORT_FETCH_SIZE
+                cur.execute(
+                    f'''
+                    SELECT t.table_id, t.player_white, t.player_black, t.winner,
+                           t.uses_mosquito, t.uses_ladybug, t.uses_pillbug,
+                           g.state, g.moves
+                    FROM tables t JOIN games g ON g.table_id = t.table_id
+                    WHERE {where}
+                    ORDER BY t.table_id ASC
+                    ''',
+                    params
+                )
+
+                while rows := cur.fetchmany():
+                    for row in rows:
+                        yield row[:7], row[7], row[8]
+
+        except Exception as e:
+            print(f'ERROR streaming compact games: ', e)
+
+    def get_unique_table_ids(self):
+        try:
+            with closing(self.con.cursor()) as cur:
                 cur.execute('SELECT DISTINCT table_id FROM tables')
 
                 return set(map(lambda val: val[0], cur.fetchall()))
 
-    except Exception as e:
-        print(f'ERROR retrieving unique table_ids: ', e)
+        except Exception as e:
+            print(f'ERROR retrieving unique table_ids: ', e)
 
+    def get_moves_list(self, table_id) -> list[tuple[int,str,int,str,str,str]]:
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute(MOVES_LIST_QUERY, [table_id])
 
-def get_moves_list(table_id) -> list[tuple[int,str,int,str,str,str]]:
-    try:
-        with closing(sqlite3.connect(DB_NAME)) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('''
-                            SELECT * FROM actions WHERE table_id = ?
-                            ORDER BY move_number ASC, notation DESC
-                            ''',
-                            [table_id])
+                return cur.fetchall()
+
+        except Exception as e:
+            print(f'ERROR retrieving moves list for table_id {table_id}: ', e)
+
+    def get_player_tables(self, player_id):
+        ''' Returns every row of the tables table where player_id played either color
+        '''
+        try:
+            with closing(self.con.cursor()) as cur:
+                cur.execute(PLAYER_TABLES_QUERY, [player_id, player_id])
 
                 return cur.fetchall()
 
+        except Exception as e:
+            print(f'ERROR retrieving tables for player_id {player_id}: ', e)
+
+
+class TableWriter:
+    ''' Buffers scraped tables and writes them in one transaction once batch_size tables
+        or flush_interval seconds have accumulated, instead of committing every game.
+        Anything still buffered is flushed when the interpreter exits.
+    '''
+
+    def __init__(self, db=None, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL):
+        self.db = db or get_db()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.checkpoints = {}
+        self.failures = {}
+        self.last_flush = time.monotonic()
+        # atexit runs last registered first, so the metrics file is written after the final flush
+        metrics.get_metrics()
+        atexit.register(self.flush)
+
+    def add(self, table_id, player_white, player_black, winner, m, l, p, actions):
+        self.pending.append((table_id, player_white, player_black, winner, m, l, p, actions))
+        metrics.gauge('writer_pending', len(self.pending))
+        self._maybe_flush()
+
+    def checkpoint(self, shard_id, next_index):
+        ''' Records crawl progress, committed in the same transaction as the tables added before it
+        '''
+        self.checkpoints[shard_id] = next_index
+        self._maybe_flush()
+
+    def fail(self, table_id, reason):
+        ''' Records a crawled game that failed, committed with the checkpoints that move past it so it is never lost
+        '''
+        self.failures[table_id] = reason
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        checkpoints, self.checkpoints = [(i, shard_id) for shard_id, i in self.checkpoints.items()], {}
+        failures, self.failures = list(self.failures.items()), {}
+        self.last_flush = time.monotonic()
+        if not pending and not checkpoints and not failures:
+            return
+
+        metrics.gauge('writer_pending', 0)
+        if not self.db.insert_many_table_data(pending, checkpoints, failures=failures):
+            # fall back to one transaction per table so a single bad row can't drop the whole batch.
+            # The rows that still fail are recorded with the checkpoints that move past them, so they're never lost.
+            for row in pending:
+                if not self.db.insert_table_data(*row):
+                    failures.append((row[0], 'insert failed'))
+            self.db.insert_many_table_data([], checkpoints, failures=failures)
+
+
+# shared handle used by the module level functions below, so existing scripts keep working.
+# One per process, since an sqlite connection must not be used across a fork.
+_dbs = {}
+
+
+def get_db():
+    if os.getpid() not in _dbs:
+        _dbs[os.getpid()] = HiveDB()
+
+    return _dbs[os.getpid()]
+
+
+@contextmanager
+def use_db(db_name):
+    ''' Points the module level functions at db_name for the with block, in this process and in the worker
+        processes it starts, whether they fork or import this module again. Yields the handle, and closes it
+        and restores the previous one on exit.
+    '''
+    global DB_NAME
+    previous = DB_NAME, os.environ.get('HIVEMIND_DB'), _dbs.pop(os.getpid(), None)
+    DB_NAME = os.environ['HIVEMIND_DB'] = db_name
+    try:
+        yield get_db()
+    finally:
+        db = _dbs.pop(os.getpid(), None)
+        if db:
+            db.close()
+
+        DB_NAME, env, db = previous
+        if env is None:
+            os.environ.pop('HIVEMIND_DB', None)
+        else:
+            os.environ['HIVEMIND_DB'] = env
+        if db:
+            _dbs[os.getpid()] = db
+
+
+def init():
+    try:
+        get_db()
     except Exception as e:
-        print(f'ERROR retrieving moves list for table_id {table_id}: ', e)
+        print('ERROR: init() failed: ', e)
+        exit(-1)
+
+
+def searched_player(player_id, new_tables=None):
+    return get_db().searched_player(player_id, new_tables)
+
+
+def get_history_watermarks(player_ids):
+    return get_db().get_history_watermarks(player_ids)
+
+
+def set_history_watermark(player_id, table_id, timestamp):
+    return get_db().set_history_watermark(player_id, table_id, timestamp)
+
+
+def add_pending_tables(table_ids):
+    return get_db().add_pending_tables(table_ids)
+
+
+def get_pending_tables():
+    return get_db().get_pending_tables()
+
+
+def delete_pending_tables(table_ids):
+    return get_db().delete_pending_tables(table_ids)
+
+
+def fail_pending_tables(table_ids, max_attempts):
+    return get_db().fail_pending_tables(table_ids, max_attempts)
+
+
+def set_player_ranks(player_ids):
+    return get_db().set_player_ranks(player_ids)
+
+
+def get_frontier(limit):
+    return get_db().get_frontier(limit)
+
+
+def get_account(email):
+    return get_db().get_account(email)
+
+
+def update_account_quota(email, replays, depleted):
+    return get_db().update_account_quota(email, replays, depleted)
+
+
+def reset_account_quota(email):
+    return get_db().reset_account_quota(email)
+
+
+def insert_table_data(table_id, player_white, player_black, winner, m, l, p, actions):
+    return get_db().insert_table_data(table_id, player_white, player_black, winner, m, l, p, actions)
+
+
+def rebuild_player_stats():
+    return get_db().rebuild_player_stats()
+
+
+def get_player_stats(player_id):
+    return get_db().get_player_stats(player_id)
+
+
+def get_crawl_shards():
+    return get_db().get_crawl_shards()
+
+
+def add_crawl_shards(ranges):
+    return get_db().add_crawl_shards(ranges)
+
+
+def get_crawl_failures():
+    return get_db().get_crawl_failures()
+
+
+def delete_crawl_failures(table_ids):
+    return get_db().delete_crawl_failures(table_ids)
+
+
+def update_table_expansions(table_id, m, l, p):
+    return get_db().update_table_expansions(table_id, m, l, p)
+
+
+def get_all_table_data(include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, table_range = None):
+    return get_db().get_all_table_data(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, table_range)
+
+
+def iter_table_moves(include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, include_log = False, table_range = None, seq_range = None):
+    return get_db().iter_table_moves(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, include_log, table_range, seq_range)
+
+
+def get_table_ids(include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True, table_range = None, seq_range = None):
+    return get_db().get_table_ids(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs, table_range, seq_range)
+
+
+def get_written_table_ids(seq_range):
+    return get_db().get_written_table_ids(seq_range)
+
+
+def get_last_seq():
+    return get_db().get_last_seq()
+
+
+def get_table_fingerprints():
+    return get_db().get_table_fingerprints()
+
+
+def set_table_fingerprints(rows):
+    return get_db().set_table_fingerprints(rows)
+
+
+def delete_tables(table_ids):
+    return get_db().delete_tables(table_ids)
+
+
+def get_export_watermark(filters):
+    return get_db().get_export_watermark(filters)
+
+
+def set_export_watermark(filters, last_seq, path, exported):
+    return get_db().set_export_watermark(filters, last_seq, path, exported)
+
+
+def insert_compact_games(rows):
+    return get_db().insert_compact_games(rows)
+
+
+def iter_compact_games(include_bots = False, uses_m = True, uses_l = True, uses_p = True, include_bga = True, include_bs = True):
+    return get_db().iter_compact_games(include_bots, uses_m, uses_l, uses_p, include_bga, include_bs)
+
+
+def get_unique_table_ids():
+    return get_db().get_unique_table_ids()
+
+
+def get_moves_list(table_id) -> list[tuple[int,str,int,str,str,str]]:
+    return get_db().get_moves_list(table_id)
+
+
+def get_player_tables(player_id):
+    return get_db().get_player_tables(player_id)
 
 
 init()
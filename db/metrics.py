@@ -0,0 +1,166 @@
+import atexit
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Pipeline instrumentation: latency histograms per stage, counters and gauges, kept by every process and written
+# as JSON to METRICS_DIR/<pid>.json at most every FLUSH_INTERVAL seconds and at exit. It only depends on the
+# standard library so every layer can record metrics, see scripts/metrics.py to read them.
+METRICS_DIR = 'metrics'
+FLUSH_INTERVAL = 10       # seconds between writes of a process' metrics file
+RETENTION = 7 * 86400     # seconds the file of a finished process is kept for
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # histogram upper bounds in seconds
+
+
+class Metrics:
+    """ Histograms, counters and gauges of one process, written to its own file so forked workers never share one
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, {'buckets': [0] * (len(BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0})
+            histogram['buckets'][next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+        self._maybe_flush()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self._maybe_flush()
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {'pid': os.getpid(), 'process': os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'python',
+                    'started': self.started, 'updated': time.time(), 'histograms': json.loads(json.dumps(self.histograms)),
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not (self.histograms or self.counters or self.gauges):
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self.path)
+
+        except OSError as e:
+            print(f'ERROR writing metrics to {self.path}: ', e)
+
+
+def is_alive(pid):
+    """ Returns True if a process with this pid is running on this machine
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def load(directory=METRICS_DIR, since=None):
+    """ Returns the snapshot of every process that wrote metrics to directory, only those updated
+        in the last since seconds if given. Each snapshot gets an 'alive' flag for its process.
+    """
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if since is None or snapshot['updated'] >= time.time() - since:
+            snapshot['alive'] = is_alive(snapshot['pid'])
+            snapshots.append(snapshot)
+
+    return snapshots
+
+
+def prune(directory=METRICS_DIR, retention=RETENTION):
+    """ Deletes the files of processes that have exited and stopped updating them more than retention seconds ago.
+        Returns the number of files deleted.
+    """
+    pruned = 0
+    for snapshot in load(directory):
+        if not snapshot['alive'] and snapshot['updated'] < time.time() - retention:
+            try:
+                os.remove(os.path.join(directory, f'{snapshot["pid"]}.json'))
+                pruned += 1
+            except OSError:
+                continue
+
+    return pruned
+
+
+# one registry per process, since the parallel crawlers fork after import
+_metrics = {}
+
+
+def get_metrics():
+    if os.getpid() not in _metrics:
+        prune()
+        _metrics[os.getpid()] = Metrics(os.path.join(METRICS_DIR, f'{os.getpid()}.json'))
+
+    return _metrics[os.getpid()]
+
+
+def observe(stage, seconds):
+    get_metrics().observe(stage, seconds)
+
+
+def count(name, n=1):
+    get_metrics().count(name, n)
+
+
+def gauge(name, value):
+    get_metrics().gauge(name, value)
+
+
+def flush():
+    """ Writes this process' metrics now, for worker processes that exit without running atexit handlers
+    """
+    get_metrics().flush()
+
+
+@contextmanager
+def timer(stage):
+    """ Records the time spent in the with block under stage, whether or not it raised
+    """
+    # created first, so the process' start time precedes its first stage
+    metrics = get_metrics()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
@@ -0,0 +1,134 @@
+import sys
+from array import array
+
+# Compact integer encoding of UHP MoveStrings, e.g. 'wA1 bQ\'
+# https://github.com/jonthysell/Mzinga/wiki/UniversalHiveProtocol#movestring
+#
+# Every move packs into 16 bits:
+#   bits 0-4   piece id (index into PIECES)
+#   bits 5-9   reference piece id (0 if the move has no reference piece)
+#   bits 10-12 direction (index into DIRECTIONS)
+#   bits 13-14 kind (KIND_*)
+
+PASS_MOVE = 'pass'
+COLORS = ['w', 'b']
+BUGS = ['Q', 'S1', 'S2', 'B1', 'B2', 'G1', 'G2', 'G3', 'A1', 'A2', 'A3', 'M', 'L', 'P']
+
+# id 0 is reserved for "no piece"
+PIECES = [''] + [color + bug for color in COLORS for bug in BUGS]
+PIECE_IDS = {piece: i for i, piece in enumerate(PIECES) if piece}
+
+# (prefix, suffix) written around the reference piece, with the matching axial (q, r) offset
+# from the reference piece to the moved piece. r grows towards the bottom of the board.
+DIRECTIONS = [
+    ('', ''),     # on top of the reference piece
+    ('', '-'),    # east
+    ('', '/'),    # north east
+    ('\\', ''),   # north west
+    ('-', ''),    # west
+    ('/', ''),    # south west
+    ('', '\\'),   # south east
+]
+DIRECTION_OFFSETS = [(0, 0), (1, 0), (1, -1), (0, -1), (-1, 0), (-1, 1), (0, 1)]
+DIRECTION_IDS = {forms: i for i, forms in enumerate(DIRECTIONS)}
+SEPARATORS = ('-', '/', '\\')
+
+KIND_MOVE = 0   # piece placed or moved next to (or on top of) a reference piece
+KIND_FIRST = 1  # very first placement of the game, no reference piece
+KIND_PASS = 2
+
+# UHP GameStateString values, stored as their index
+GAME_STATES = ['NotStarted', 'InProgress', 'Draw', 'WhiteWins', 'BlackWins']
+
+
+def parse_move(notation):
+    """ Splits a MoveString into (piece, reference piece, direction id).
+        The reference piece is '' for the first move of a game. Raises ValueError on anything else.
+    """
+    parts = notation.split(' ')
+    if len(parts) == 1 and parts[0] in PIECE_IDS:
+        return parts[0], '', 0
+
+    if len(parts) == 2 and parts[0] in PIECE_IDS:
+        ref = parts[1]
+        prefix = ref[:1] if ref[:1] in SEPARATORS else ''
+        suffix = ref[-1:] if ref[-1:] in SEPARATORS and not prefix else ''
+        ref = ref[len(prefix):len(ref) - len(suffix)]
+        if ref in PIECE_IDS:
+            return parts[0], ref, DIRECTION_IDS[(prefix, suffix)]
+
+    raise ValueError(f'invalid MoveString: {notation!r}')
+
+
+def format_move(piece, ref, direction):
+    """ Inverse of parse_move()
+    """
+    if not ref:
+        return piece
+
+    prefix, suffix = DIRECTIONS[direction]
+    return f'{piece} {prefix}{ref}{suffix}'
+
+
+def encode_move(notation):
+    """ Returns the 16 bit integer code for a single MoveString
+    """
+    if notation == PASS_MOVE:
+        return KIND_PASS << 13
+
+    piece, ref, direction = parse_move(notation)
+    kind = KIND_MOVE if ref else KIND_FIRST
+
+    return PIECE_IDS[piece] | (PIECE_IDS.get(ref, 0) << 5) | (direction << 10) | (kind << 13)
+
+
+def decode_move(code):
+    """ Returns the MoveString for a code produced by encode_move()
+    """
+    kind = code >> 13
+    if kind == KIND_PASS:
+        return PASS_MOVE
+
+    piece = PIECES[code & 0x1f]
+    ref = PIECES[(code >> 5) & 0x1f] if kind == KIND_MOVE else ''
+
+    return format_move(piece, ref, (code >> 10) & 0x7)
+
+
+def unpack_move(code):
+    """ Returns the (piece id, reference piece id, direction, kind) tuple stored in a move code
+    """
+    return code & 0x1f, (code >> 5) & 0x1f, (code >> 10) & 0x7, code >> 13
+
+
+def encode_moves(notations):
+    """ Packs a list of MoveStrings into a little endian blob of 2 bytes per move
+    """
+    codes = array('H', map(encode_move, notations))
+    if sys.byteorder != 'little':
+        codes.byteswap()
+
+    return codes.tobytes()
+
+
+def decode_moves(blob):
+    """ Returns the list of MoveStrings packed by encode_moves()
+    """
+    codes = array('H')
+    codes.frombytes(blob)
+    if sys.byteorder != 'little':
+        codes.byteswap()
+
+    return list(map(decode_move, codes))
+
+
+def encode_moves_string(moves_string):
+    """ Packs the ';' separated MoveStrings section of a GameString
+    """
+    return encode_moves(moves_string.split(';') if moves_string else [])
+
+
+def decode_moves_string(blob):
+    """ Inverse of encode_moves_string()
+    """
+    return ';'.join(decode_moves(blob))
@@ -0,0 +1,17 @@
+# table_id ranges of every source, kept apart from hive_db so readers of exported files don't open the DB
+BGA_START = 100000000 # 100,000,000
+BGA_END =   999999999
+ENTOMOLOGY_START = 0        # entomology table_ids are indexes into entomology_uuids.json
+ENTOMOLOGY_END =   9999999
+SOURCES = ['bga', 'entomology', 'boardspace']
+
+
+def table_source(table_id):
+    ''' Returns which of SOURCES a table_id was scraped from
+    '''
+    if BGA_START <= table_id <= BGA_END:
+        return 'bga'
+    if ENTOMOLOGY_START <= table_id <= ENTOMOLOGY_END:
+        return 'entomology'
+
+    return 'boardspace'
@@ -1,24 +1,28 @@
 import scripts.bga_scraping as bga_scraping
 import db.hive_db as hive_db
+from db import metrics
 
 
 # if ran as script, automatically begin scraping
 if __name__ == '__main__':
     sess = bga_scraping.get_next_session()
+    writer = hive_db.TableWriter()
 
-    player_ids = bga_scraping.get_players_by_rank(sess, 10)
-    print(f'found the top {len(player_ids)} ranking player IDs', flush=True)
+    ranked = bga_scraping.get_players_by_rank(sess, bga_scraping.RANKED_PLAYERS)
+    hive_db.set_player_ranks(ranked)
+    player_ids = hive_db.get_frontier(bga_scraping.PLAYERS_PER_RUN)
+    print(f'found the top {len(ranked)} ranking player IDs, searching the {len(player_ids)} best players of the frontier', flush=True)
 
-    for player in player_ids:
-        bga_scraping.hive_db.searched_player(player)
-
-    table_ids = list(bga_scraping.get_top_arena_tables(sess, player_ids))
-    print(f'proccessing {len(table_ids)} table IDs:', flush=True)
+    new_tables = bga_scraping.get_top_arena_tables(sess, player_ids)
+    # the tables earlier runs left behind come first, along with the new ones
+    table_ids = hive_db.get_pending_tables()
+    print(f'proccessing {len(table_ids)} table IDs, {len(new_tables)} of them new:', flush=True)
 
     index = 0
     session_count = 0
     while sess and index < len(table_ids):
         table_id = table_ids[index]
+        metrics.gauge('bga_queue', len(table_ids) - index)
         result = bga_scraping.analyze_table_data(sess, table_id)
 
         if not result:
@@ -32,6 +36,7 @@ if __name__ == '__main__':
             continue
 
         if result == table_id: # this table should be ignored for whichever reason (missing replay, corrupted, etc.)
+            hive_db.delete_pending_tables([table_id])
             index += 1
             session_count += 1
             continue
@@ -40,10 +45,11 @@ if __name__ == '__main__':
             print(f'failed to retrieve data for table_id {table_id}')
             break
         
-        # send to db
-        hive_db.insert_table_data(table_id, *result)
+        # send to db, committed in batches by the writer
+        writer.add(table_id, *result)
         index += 1
 
+    writer.flush()
     print(f'SCRAPING COMPLETED')
     print(f'  added {index} tables to db')
     print(f'  {len(table_ids) - index} ids remaining:')
@@ -3,34 +3,19 @@
 script_dir=$(dirname "$(readlink -f "$0")")
 cd $script_dir
 
-PYTHON_PROGRAM="./main.py"
-LAST_EXECUTION_FILE="./last_execution_time.txt"
-
-# Check if the last execution time file exists
-if [ ! -f "$LAST_EXECUTION_FILE" ]; then
-    touch "$LAST_EXECUTION_FILE"
+PYTHON_MODULE="scripts.bga_async_scraping"
+
+# Each account's replay quota and depletion time are tracked in the DB, so this can run every hour:
+# only accounts whose replay limit has reset (24.5 hours after they were depleted) are logged in.
+# A run can outlast the hour though, so the next one is skipped while it holds the lock.
+exec 9> "./scrape.lock"
+if ! flock -n 9; then
+    echo "$PYTHON_MODULE is still running, skipping this run"
+    exit 0
 fi
 
-# Get the last execution time
-last_execution_time=$(cat "$LAST_EXECUTION_FILE")
-
-# Get the current time
-current_time=$(date +%s)
-
-# Calculate the difference in seconds between the last execution time and the current time
-time_difference=$((current_time - last_execution_time))
+python3 -u -m "$PYTHON_MODULE" | timestamp >> "./scrape.log"
 
-# Check if the time difference is greater than 24.5 hours (88200 seconds)
-if [ "$time_difference" -gt 88200 ]; then
-    # Run the Python program
-    python3 "$PYTHON_PROGRAM" | timestamp >> "./scrape.log"
-
-    # Update the last execution time if successful
-    if [ "$?" -eq 0 ]; then
-        date +%s > "$LAST_EXECUTION_FILE"
-    else
-        echo "$PYTHON_PROGRAM failed with exit code $?"
-    fi
-else
-    echo "Not enough time has elapsed since last execution ($time_difference/88200 seconds elapsed)"
-fi
\ No newline at end of file
+if [ "${PIPESTATUS[0]}" -ne 0 ]; then
+    echo "$PYTHON_MODULE failed with exit code ${PIPESTATUS[0]}"
+fi
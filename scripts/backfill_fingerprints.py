@@ -0,0 +1,59 @@
+from db import hive_db
+from itertools import product
+
+import argparse
+import time
+
+BATCH_SIZE = 1000
+
+
+def backfill_fingerprints():
+    """ Fingerprints every table that has none yet, in table_id order.
+        Returns the (table_id, original table_id) of every table found to duplicate an earlier one.
+    """
+    fingerprints = hive_db.get_table_fingerprints()
+    fingerprinted = set(fingerprints.values())
+
+    pending = []
+    for m, l, p in product([True, False], repeat=3):
+        for table, moves in hive_db.iter_table_moves(include_bots=True, uses_m=m, uses_l=l, uses_p=p):
+            if table[0] not in fingerprinted:
+                fingerprint = hive_db.move_fingerprint(m, l, p, [(move[0], move[1], move[3]) for move in moves])
+                if fingerprint is not None:
+                    pending.append((table[0], fingerprint))
+
+    # a table already fingerprinted, or else the lowest table_id, keeps the fingerprint of a duplicated game
+    duplicates = []
+    rows = []
+    for table_id, fingerprint in sorted(pending):
+        if fingerprint in fingerprints:
+            duplicates.append((table_id, fingerprints[fingerprint]))
+            continue
+
+        fingerprints[fingerprint] = table_id
+        rows.append((fingerprint, table_id))
+        if len(rows) >= BATCH_SIZE:
+            hive_db.set_table_fingerprints(rows)
+            rows = []
+
+    hive_db.set_table_fingerprints(rows)
+
+    return duplicates
+
+
+# fingerprints the tables inserted before schema version 6, reporting (and optionally deleting) duplicate games
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delete', action='store_true', help='delete every duplicate table along with its actions')
+    args = parser.parse_args()
+
+    start = time.time()
+    duplicates = backfill_fingerprints()
+    for table_id, original in duplicates:
+        print(f'table_id {table_id} is the same game as table_id {original}')
+
+    if args.delete and duplicates:
+        hive_db.delete_tables([table_id for table_id, _ in duplicates])
+        print(f'Deleted {len(duplicates)} duplicate tables')
+
+    print(f'BACKFILL COMPLETED in {time.time() - start:.1f}s, {len(duplicates)} duplicates found')
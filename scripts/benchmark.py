@@ -0,0 +1,403 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+# hive_db opens its shared handle on import, keep it off the real DB: the benchmarks open their own
+os.environ.setdefault('HIVEMIND_DB', ':memory:')
+
+from db import hive_db
+from scripts import hive_engine
+from db import metrics
+from scripts import replay_archive
+from scripts.generate_game_strings import export, get_game_type_string, get_turn_string, table_ids_path
+
+# Reproducible benchmarks on a synthetic corpus. Games are played with random legal moves from the rules engine,
+# with half of them branching off a shared opening so the corpus has the repeated prefixes real games have.
+# The same seed always generates the same corpus, and every report records its checksum, so two reports can be
+# compared across versions of the code. Everything is written to BENCH_DIR, away from the real DB and archive:
+# the corpus to BENCH_DIR/corpus, replaced on every run, and the reports next to it.
+BENCH_DIR = 'bench'
+DEFAULT_GAMES = 1000
+DEFAULT_SEED = 0
+DEFAULT_WORKERS = os.cpu_count() or 1
+MIN_PLIES = 10
+MAX_PLIES = 120
+OPENING_PLIES = 8        # moves of the shared openings games branch off
+OPENINGS = 50            # shared openings kept per game type
+OPENING_SHARE = 0.5      # games starting from a shared opening
+DRAW_SHARE = 0.05        # unfinished games ending in an agreed draw, the others in a resignation
+GAMES_PER_PLAYER = 5     # average games of every synthetic player
+PLAYER_ID_START = 80000000
+GAME_TYPES = [((True, True, True), 0.8), ((False, False, False), 0.1), ((True, False, False), 0.05), ((False, True, True), 0.05)]
+QUERY_SAMPLES = 200      # calls timed for every per-player or per-table query
+FRONTIER_SIZE = 10       # players picked from the frontier per scraper run
+BGA_WHITE, BGA_BLACK = '#ffffff', '#000000'
+ENTOMOLOGY_RESULTS = {hive_engine.WHITE_WINS: 'white wins', hive_engine.BLACK_WINS: 'black wins', hive_engine.DRAW: 'draw'}
+
+
+def random_game(rng, expansions, openings):
+    """ Returns the MoveStrings and final GameState of a game of random legal moves, starting from one of
+        openings (a list of (moves, GameState)) or adding its own opening to them
+    """
+    if openings and rng.random() < OPENING_SHARE:
+        moves, game = rng.choice(openings)
+        moves, game = list(moves), game.copy()
+    else:
+        moves, game = [], hive_engine.GameState(expansions)
+
+    plies = rng.randint(MIN_PLIES, MAX_PLIES)
+    while len(moves) < plies and game.state in (hive_engine.NOT_STARTED, hive_engine.IN_PROGRESS):
+        # sorted, since the engine's move order isn't guaranteed to be the same from one interpreter to the next
+        legal = sorted(game.legal_moves())
+        move = game.move_string(*rng.choice(legal)) if legal else hive_engine.PASS_MOVE
+        game.play(move)
+        moves.append(move)
+
+        if len(moves) == OPENING_PLIES and len(openings) < OPENINGS:
+            openings.append((tuple(moves), game.copy()))
+
+    return moves, game
+
+
+def generate_corpus(games, seed):
+    """ Returns games synthetic BGA tables as dicts of table_id, white, black, winner, m, l, p, moves and state.
+        Games that didn't surround a queen end in a resignation or, sometimes, an agreed draw.
+    """
+    rng = random.Random(seed)
+    players = max(2, games // GAMES_PER_PLAYER)
+    openings = {}
+    corpus = []
+    for i in range(games):
+        (m, l, p), = rng.choices([game_type for game_type, _ in GAME_TYPES], [share for _, share in GAME_TYPES])
+        expansions = {bug for bug, used in zip(hive_engine.EXPANSION_BUGS, (m, l, p)) if used}
+        moves, game = random_game(rng, expansions, openings.setdefault((m, l, p), []))
+
+        white, black = rng.sample(range(PLAYER_ID_START, PLAYER_ID_START + players), 2)
+        state = game.state
+        if state not in (hive_engine.DRAW, hive_engine.WHITE_WINS, hive_engine.BLACK_WINS):
+            state = hive_engine.DRAW if rng.random() < DRAW_SHARE else rng.choice([hive_engine.WHITE_WINS, hive_engine.BLACK_WINS])
+        winner = {hive_engine.DRAW: 0, hive_engine.WHITE_WINS: white, hive_engine.BLACK_WINS: black}[state]
+
+        corpus.append({'table_id': hive_db.BGA_START + i, 'white': white, 'black': black, 'winner': winner,
+                       'm': m, 'l': l, 'p': p, 'moves': moves, 'state': state, 'surrounded': game.state == state})
+
+    return corpus
+
+
+def game_string(game):
+    return ';'.join([get_game_type_string(game['m'], game['l'], game['p']), game['state'],
+                     get_turn_string(len(game['moves'])), ';'.join(game['moves'])])
+
+
+def bga_actions(game):
+    """ Returns the game's actions the way bga_scraping.parse_replay() returns them, with the logs.html args
+    """
+    actions = []
+    for i, move in enumerate(game['moves'], start=1):
+        if move == hive_engine.PASS_MOVE:
+            actions.append({'move_number': i, 'type': 'message', 'log': '${player_name} passes', 'args': {}})
+        else:
+            actions.append({'move_number': i, 'type': 'tokenPlayed', 'log': '${player_name} moves ${notation}',
+                            'args': {'notation': move}, 'notation': move, 'type_copied': ''})
+
+    end = len(game['moves']) + 1
+    if game['surrounded'] and game['state'] != hive_engine.DRAW:
+        actions.append({'move_number': end, 'type': 'queenSurr', 'log': '', 'args': {'winner': game['winner']}})
+    elif not game['surrounded'] and game['state'] == hive_engine.DRAW:
+        actions += [{'move_number': end, 'type': 'offerDraw', 'log': '', 'args': {}},
+                    {'move_number': end + 1, 'type': 'acceptDraw', 'log': '', 'args': {}}]
+
+    return actions
+
+
+def table_row(game):
+    """ Returns the game's row for hive_db.insert_many_table_data()
+    """
+    actions = [{key: value for key, value in action.items() if key != 'args'} for action in bga_actions(game)]
+    return (game['table_id'], game['white'], game['black'], game['winner'], game['m'], game['l'], game['p'], actions)
+
+
+def bga_responses(game):
+    """ Returns the game's tableinfos and logs responses, as BGA sends them
+    """
+    options = {str(option): {'value': '2' if used else '1'} for option, used in zip((100, 101, 102), (game['m'], game['l'], game['p']))}
+    table = {'status': 1, 'data': {'id': game['table_id'], 'options': options}}
+
+    logs = {}
+    for action in bga_actions(game):
+        logs.setdefault(action['move_number'], []).append({key: action[key] for key in ('type', 'log', 'args')})
+    replay = {'status': 1, 'data': {'players': [{'id': game['white'], 'color': BGA_WHITE}, {'id': game['black'], 'color': BGA_BLACK}],
+                                    'logs': [{'move_id': move_id, 'data': data} for move_id, data in logs.items()]}}
+
+    return json.dumps(table).encode(), json.dumps(replay).encode()
+
+
+def entomology_response(game):
+    """ Returns the game's json data the way entomology serves it, moves in its raw 'dropb'/'move' format
+    """
+    variant = ''.join(bug.lower() for bug, used in zip('lmp', (game['l'], game['m'], game['p'])) if used)
+    placed = set()
+    moves = []
+    for i, move in enumerate(game['moves']):
+        if move == hive_engine.PASS_MOVE:
+            moves.append(move)
+            continue
+
+        piece, _, ref = move.partition(' ')
+        kind = f'move {piece[1]}' if piece in placed else 'dropb'
+        moves.append(f'{kind} {piece} N {i} {ref or "."}')
+        placed.add(piece)
+
+    return json.dumps({'variant': variant, 'ranked': 1, 'tournament': 0, 'white': {'name': f'white{game["white"]}'},
+                       'black': {'name': f'black{game["black"]}'}, 'result': ENTOMOLOGY_RESULTS[game['state']],
+                       'moves': moves}).encode()
+
+
+def write_corpus(corpus, directory):
+    """ Writes the corpus' GameStrings to directory, and its recorded BGA and entomology responses to a replay archive
+        in directory/archive. Returns (GameStrings path, archive). Only the Base+MLP games are recorded as entomology
+        games, the only ones its crawler keeps, under table_ids 0 and up.
+    """
+    path = os.path.join(directory, 'BoardGameArena_Synthetic.txt')
+    with open(path, 'w') as f:
+        f.writelines(game_string(game) + '\n' for game in corpus)
+
+    archive = replay_archive.ReplayArchive(os.path.join(directory, 'archive'))
+    for i, game in enumerate(corpus):
+        table, replay = bga_responses(game)
+        archive.put(game['table_id'], replay_archive.KIND_BGA_TABLE, table)
+        archive.put(game['table_id'], replay_archive.KIND_BGA_REPLAY, replay)
+        if game['m'] and game['l'] and game['p']:
+            archive.put(i, replay_archive.KIND_ENTOMOLOGY, entomology_response(game))
+
+    return path, archive
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else None
+
+
+def bench_inserts(db, corpus):
+    """ Inserts the corpus in WRITER_BATCH_SIZE transactions, like TableWriter
+    """
+    rows = [table_row(game) for game in corpus]
+    start = time.perf_counter()
+    for i in range(0, len(rows), hive_db.WRITER_BATCH_SIZE):
+        if not db.insert_many_table_data(rows[i:i + hive_db.WRITER_BATCH_SIZE]):
+            raise RuntimeError(f'failed to insert the batch of tables starting at {rows[i][0]}')
+    seconds = time.perf_counter() - start
+
+    return {'tables': len(rows), 'actions': sum(len(row[7]) for row in rows), 'seconds': seconds, 'tables_per_s': rate(len(rows), seconds)}
+
+
+def bench_queries(db, corpus, seed):
+    """ Times every hot read: whole table scans once, per-player and per-table lookups QUERY_SAMPLES times
+    """
+    rng = random.Random(seed)
+    players = [game['white'] for game in rng.sample(corpus, min(QUERY_SAMPLES, len(corpus)))]
+    tables = [game['table_id'] for game in rng.sample(corpus, min(QUERY_SAMPLES, len(corpus)))]
+    calls = {
+        'get_unique_table_ids': [()],
+        'iter_table_moves': [()],
+        'get_frontier': [(FRONTIER_SIZE,)],
+        'get_player_stats': [(player_id,) for player_id in players],
+        'get_player_tables': [(player_id,) for player_id in players],
+        'get_moves_list': [(table_id,) for table_id in tables],
+    }
+
+    results = {}
+    for name, args in calls.items():
+        if name == 'iter_table_moves':
+            function = lambda: sum(1 for _ in db.iter_table_moves(include_bots=True))
+        else:
+            function = getattr(db, name)
+        start = time.perf_counter()
+        for call_args in args:
+            function(*call_args)
+        seconds = time.perf_counter() - start
+        results[name] = {'calls': len(args), 'seconds': seconds, 'ms_per_call': 1000 * seconds / len(args)}
+
+    return results
+
+
+def bench_export(db, corpus, directory, workers):
+    """ Exports every game type of the corpus with generate_game_strings.export() and its pool of workers,
+        the way generate_game_strings does. Every exported GameString must be the one the game was generated from.
+    """
+    expected = {game['table_id']: game_string(game) for game in corpus}
+    path = os.path.join(directory, 'export.txt')
+    games, mismatched, seconds = 0, 0, 0.0
+    # the workers read through the module level handle, pointed at the corpus DB for the duration
+    with hive_db.use_db(db.db_name):
+        for m, l, p in sorted({(game['m'], game['l'], game['p']) for game in corpus}):
+            filters = {'include_bots': True, 'uses_m': m, 'uses_l': l, 'uses_p': p, 'include_bga': True, 'include_bs': True}
+            table_ids = db.get_table_ids(**filters)
+            # export() prints every game it writes
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                _, elapsed = timed(export, path, 'w', filters, table_ids, workers)
+            seconds += elapsed
+
+            with open(path, 'r') as f, open(table_ids_path(path), 'r') as ids:
+                for line, table_id in zip(f, ids):
+                    games += 1
+                    mismatched += expected[int(table_id)] != line.rstrip('\n')
+
+    return {'games': games, 'mismatched': mismatched, 'workers': workers, 'seconds': seconds,
+            'games_per_s': rate(games, seconds)}
+
+
+def bench_reparse(archive, kind, reparse):
+    """ Parses every archived response of a kind back into a hive_db row
+    """
+    table_ids = archive.get_table_ids(kind)
+    rows, seconds = timed(lambda: [reparse(archive, table_id) for table_id in table_ids])
+    parsed = sum(1 for row in rows if row)
+
+    return {'games': len(table_ids), 'parsed': parsed, 'seconds': seconds, 'games_per_s': rate(len(table_ids), seconds)}
+
+
+def bench_engine(path):
+    """ Replays every GameString of the corpus with the rules engine
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    _, seconds = timed(lambda: [hive_engine.check_game_string(line) for line in lines])
+    return {'games': len(lines), 'seconds': seconds, 'games_per_s': rate(len(lines), seconds)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def run(games, seed, directory, archive_path=None, workers=DEFAULT_WORKERS):
+    """ Generates a fresh corpus in directory and runs every benchmark on it. Returns the report.
+        With archive_path, the parsers are benchmarked on that (real) replay archive instead of the synthetic one.
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    # keep the benchmark's DB metrics out of the real ones
+    metrics.METRICS_DIR = os.path.join(directory, 'metrics')
+
+    corpus, generate_seconds = timed(generate_corpus, games, seed)
+    (path, archive), write_seconds = timed(write_corpus, corpus, directory)
+    with open(path, 'rb') as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    print(f'Generated {games} games ({sum(len(game["moves"]) for game in corpus)} moves) in {generate_seconds:.1f}s')
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'corpus': {'games': games, 'seed': seed, 'moves': sum(len(game['moves']) for game in corpus),
+                   'surrounded': sum(1 for game in corpus if game['surrounded']), 'sha256': checksum,
+                   'generate_seconds': generate_seconds, 'write_seconds': write_seconds},
+        'results': {},
+    }
+    results = report['results']
+
+    with hive_db.HiveDB(os.path.join(directory, 'hivemind.db')) as db:
+        results['db_insert'] = bench_inserts(db, corpus)
+        results['db_queries'] = bench_queries(db, corpus, seed)
+        results['export'] = bench_export(db, corpus, directory, workers)
+    results['engine_check'] = bench_engine(path)
+
+    if archive_path:
+        archive = replay_archive.ReplayArchive(archive_path)
+    # the scrapers import accounts.py and selenium at module level, a missing one only skips its benchmark
+    for name, kind, reparse in [('bga_parse', replay_archive.KIND_BGA_REPLAY, replay_archive.reparse_bga),
+                                ('entomology_parse', replay_archive.KIND_ENTOMOLOGY, replay_archive.reparse_entomology)]:
+        try:
+            results[name] = bench_reparse(archive, kind, reparse)
+        except ImportError as e:
+            print(f'Skipping {name}: {e}')
+            results[name] = {'skipped': str(e)}
+
+    return report
+
+
+def rates(results, prefix=''):
+    """ Returns {name: (value, higher is better)} for every throughput and latency of a report's results
+    """
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(rates(value, f'{prefix}{key}.'))
+        elif key.endswith('_per_s') and value is not None:
+            values[prefix + key] = (value, True)
+        elif key == 'ms_per_call':
+            values[prefix + key] = (value, False)
+
+    return values
+
+
+def compare(old, new, tolerance):
+    """ Prints every metric of two reports side by side. Returns the number slower than old by more than tolerance.
+    """
+    if old['corpus']['sha256'] != new['corpus']['sha256']:
+        print('WARNING: the reports were run on different corpora, compare them with the same --games and --seed')
+
+    regressions = 0
+    old_rates, new_rates = rates(old['results']), rates(new['results'])
+    for name, (value, higher_is_better) in new_rates.items():
+        if name not in old_rates:
+            continue
+
+        ratio = value / old_rates[name][0] if old_rates[name][0] else float('inf')
+        slower = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+        regressions += slower
+        print(f'{name:40} {old_rates[name][0]:12.2f} {value:12.2f} {ratio:7.2f}x{"  REGRESSION" if slower else ""}')
+
+    return regressions
+
+
+# python -m scripts.benchmark run [--games 1000 --seed 0] | compare OLD.json NEW.json
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['run', 'compare'])
+    parser.add_argument('reports', nargs='*', help='the two reports to compare, oldest first')
+    parser.add_argument('--games', type=int, default=DEFAULT_GAMES, help='synthetic games generated')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='seed of the synthetic corpus')
+    parser.add_argument('--dir', default=BENCH_DIR, help='directory the corpus is generated in, replaced on every run')
+    parser.add_argument('--archive', help='benchmark the parsers on this replay archive instead of the synthetic responses')
+    parser.add_argument('--report', help=f'report path, {BENCH_DIR}/report_<date>.json by default')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='processes exporting the corpus')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown compare reports as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        if len(args.reports) != 2:
+            parser.error('compare takes two reports')
+        with open(args.reports[0], 'r') as old, open(args.reports[1], 'r') as new:
+            sys.exit(1 if compare(json.load(old), json.load(new), args.tolerance) else 0)
+
+    report = run(args.games, args.seed, os.path.join(args.dir, 'corpus'), args.archive, args.workers)
+    path = args.report or os.path.join(args.dir, f'report_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, (value, _) in rates(report['results']).items():
+        print(f'{name:40} {value:12.2f}')
+    print(f'Report written to {path}')
@@ -0,0 +1,312 @@
+import aiohttp
+import asyncio
+import json
+import time
+
+from collections import deque
+from db import hive_db
+from accounts import ACCOUNTS
+from scripts import bga_scraping
+from scripts import http_cache
+from scripts import http_client
+from db import metrics
+from scripts.bga_scraping import BASE, LOGIN, RANKING, GAMES, TABLE, ARCHIVE, REPLAY, GAME_ID, MAX_HISTORY_PAGES, MAX_TABLE_ATTEMPTS, RANKED_PLAYERS, PLAYERS_PER_RUN, STAGES
+
+MAX_CONCURRENT_REQUESTS = 4  # requests in flight per account
+HISTORY_PAGE_WINDOW = 4      # match history pages requested ahead at once
+REPLAY_RESET = 88200         # an account's replay limit resets 24 hours after depletion, plus a 30min buffer
+KEEPALIVE_TIMEOUT = 60       # seconds an idle connection is kept open for the account's next request
+
+
+class AsyncAccount:
+    """ A logged in BGA account whose requests are bounded to `concurrency` in flight at once
+    """
+
+    def __init__(self, http, email, token, concurrency=MAX_CONCURRENT_REQUESTS, base=BASE):
+        self.http = http
+        self.email = email
+        self.base = base
+        self.limit = asyncio.Semaphore(concurrency)
+        self.replays = 0
+        self.history_pages = 0
+        self.depleted = False
+
+        # pass token along the headers (needed for later calls)
+        self.headers = {'X-Request-Token': token, 'X-Requested-With': 'XMLHttpRequest'}
+
+    async def request(self, path, params):
+        """ Returns the (status, body) of a GET through http_client's rate limiters, retries and circuit breaker.
+            Its latency is recorded under the path's stage, including any wait for a rate limiter.
+        """
+        async with self.limit:
+            with metrics.timer(STAGES.get(path, path)):
+                return await http_client.request(self.http, 'GET', self.base + path, self.email, params=params, headers=self.headers)
+
+    async def get_json(self, path, params):
+        _, content = await self.request(path, params)
+        # BGA answers json with a text/html content type
+        return json.loads(content)
+
+    async def get_cached(self, path, params):
+        """ Returns the raw response body through the shared response cache, storing only responses without an error
+        """
+        cache = http_cache.get_cache()
+        content = cache.get(self.base + path, params)
+        if content is not None:
+            return content
+
+        status, content = await self.request(path, params)
+        if status == 200 and 'error' not in json.loads(content):
+            cache.put(self.base + path, params, content)
+
+        return content
+
+    async def get(self, path, params):
+        await self.request(path, params)
+
+    async def close(self):
+        await self.http.close()
+
+
+async def login(email, password, concurrency=MAX_CONCURRENT_REQUESTS, base=BASE):
+    # must be a verified bga account with >=2 games and >24 hours old
+    http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT))
+
+    # request to a login page needed to produce request_token
+    with metrics.timer(STAGES[LOGIN]):
+        _, content = await http_client.request(http, 'GET', base + '/account', email)
+        token = bga_scraping.parse_request_token(content)
+        await http_client.request(http, 'POST', base + LOGIN, email, data=bga_scraping.login_form(email, password, token))
+
+    return AsyncAccount(http, email, token, concurrency, base)
+
+
+async def get_players_by_rank(acct, num_players=10):
+    """ Returns the num_players highest ranking players' ids for the current season, best first
+    """
+    pages = await asyncio.gather(*(acct.get_json(RANKING, {'game': GAME_ID, 'mode': 'arena', 'start': start})
+                                   for start in range(0, num_players, 10)))
+
+    players = [player_id for j in pages for player_id in bga_scraping.parse_ranking_page(j)]
+    return list(dict.fromkeys(players))[:num_players]
+
+
+async def get_player_tables(acct, player_id, start, end, known=frozenset(), watermark=None):
+    """ Returns (table ids, newest table id, complete) for player_id's match history between start and end:
+        every non forfeit table id, the newest id seen, and whether the history was searched to its end.
+        Pages are requested HISTORY_PAGE_WINDOW at a time instead of waiting on each one. With a (table_id, timestamp)
+        watermark they're requested one at a time instead, since the search stops at the first page without any new table.
+    """
+    params = bga_scraping.history_params(player_id, bga_scraping.player_history_start(start, watermark), end)
+    table_ids = set()
+    newest = watermark[0] if watermark else None
+    window_size = 1 if watermark else HISTORY_PAGE_WINDOW
+    page = 1
+    while page <= MAX_HISTORY_PAGES:
+        window = range(page, min(page + window_size, MAX_HISTORY_PAGES + 1))
+        pages = await asyncio.gather(*(acct.get_json(GAMES, {**params, 'page': n}) for n in window))
+        acct.history_pages += len(pages)
+
+        for j in pages:
+            ids = bga_scraping.parse_history_page(j)
+            if ids is None:
+                return table_ids, newest, True
+            table_ids.update(ids)
+
+            page_ids = bga_scraping.history_page_table_ids(j)
+            newest = max([newest or 0, *page_ids])
+            if bga_scraping.is_known_history_page(page_ids, known, watermark and watermark[0]):
+                return table_ids, newest, True
+
+        page += len(window)
+
+    print(f'over {MAX_HISTORY_PAGES} pages...')
+    return table_ids, newest, False
+
+
+async def get_top_arena_tables(acct, player_ids, months_ago=12):
+    """ Returns a set of unique table ids for given player_ids' games within the last months_ago months.
+        Each player is marked as searched along with how many of their tables were new, and gets a new watermark
+        if their history was searched to its end. The new tables are queued in pending_tables first, so the ones
+        a run doesn't get to are scraped by the next one.
+    """
+    exclusion_set = hive_db.get_unique_table_ids()
+    watermarks = hive_db.get_history_watermarks(player_ids)
+    now = int(time.time())
+    start = bga_scraping.history_start(months_ago)
+
+    histories = await asyncio.gather(*(get_player_tables(acct, player_id, start, now, exclusion_set, watermarks.get(player_id))
+                                       for player_id in player_ids))
+    print(f'searched the match history of {len(player_ids)} players in {acct.history_pages} pages')
+
+    # exclude tables we already have in our DB
+    new_tables = []
+    for player_id, (table_ids, newest, complete) in zip(player_ids, histories):
+        new_tables.append(table_ids - exclusion_set)
+        hive_db.searched_player(player_id, len(new_tables[-1]))
+        hive_db.add_pending_tables(new_tables[-1])
+        if complete:
+            hive_db.set_history_watermark(player_id, newest, now)
+
+    return set().union(*new_tables)
+
+
+async def analyze_table_data(acct, table_id):
+    """ Same contract as bga_scraping.analyze_table_data(): the table's data tuple,
+        None if the account is unable to access further replays, or the table_id if it should be skipped.
+    """
+    table = await acct.get_cached(TABLE, {'table': table_id})
+    expansions = bga_scraping.parse_table_info(json.loads(table), table_id)
+    if not isinstance(expansions, tuple):
+        return expansions
+
+    # a cached replay costs no replay quota
+    params = {'table': table_id, 'translated': 'true'}
+    replay = http_cache.get_cache().get(acct.base + REPLAY, params)
+    if replay is None:
+        # seemingly required to produce log
+        await acct.get(ARCHIVE, {'table': table_id})
+        replay = await acct.get_cached(REPLAY, params)
+        if 'error' not in json.loads(replay):
+            acct.replays += 1
+
+    j = json.loads(replay)
+    bga_scraping.archive_replay(table_id, table, j, replay)
+
+    return bga_scraping.parse_replay(j, table_id, acct.email, *expansions)
+
+
+def account_due(email, now):
+    """ Returns True if the account's replay limit is not depleted. Its quota is reset once REPLAY_RESET has passed
+        since it was depleted, or since its window started for an account that never got depleted.
+    """
+    account = hive_db.get_account(email)
+    if not account:
+        return True
+
+    _, _, _, window_start, depleted_timestamp = account
+    if depleted_timestamp:
+        if now - depleted_timestamp < REPLAY_RESET:
+            return False
+    elif not window_start or now - window_start < REPLAY_RESET:
+        return True
+
+    hive_db.reset_account_quota(email)
+    return True
+
+
+async def login_accounts(accounts):
+    """ Logs in every account whose replay limit is available, all at once
+    """
+    now = int(time.time())
+    due = [(email, password) for email, password in accounts if account_due(email, now)]
+
+    results = await asyncio.gather(*(login(email, password) for email, password in due), return_exceptions=True)
+    for (email, _), result in zip(due, results):
+        if isinstance(result, Exception):
+            print(f'Failed to log in {email}: ', result)
+
+    return [acct for acct in results if isinstance(acct, AsyncAccount)]
+
+
+def print_schedule(accounts):
+    """ Prints each account's remaining replay quota and when it can next be used
+    """
+    for email, _ in accounts:
+        account = hive_db.get_account(email)
+        if not account:
+            continue
+
+        _, used, limit, _, depleted_timestamp = account
+        remaining = max(0, limit - used) if limit else 'unknown'
+        if depleted_timestamp:
+            next_run = time.strftime('%Y-%m-%d %H:%M', time.localtime(depleted_timestamp + REPLAY_RESET))
+            print(f'  {email}: depleted after {used} replays, next run at {next_run}')
+        else:
+            print(f'  {email}: {used} replays used, {remaining} remaining')
+
+
+async def scrape_tables(accts, table_ids, writer):
+    """ Spreads table_ids over every account in parallel, each with up to MAX_CONCURRENT_REQUESTS tables in flight.
+        Returns the table_ids that are still left once every account can't access further replays.
+        Skipped tables leave pending_tables, and the ones that failed with an error stay there for the next runs.
+    """
+    queue = deque(table_ids)
+    skipped, failed = [], []
+
+    async def worker(acct):
+        while queue and not acct.depleted:
+            table_id = queue.popleft()
+            metrics.gauge('bga_queue', len(queue))
+            try:
+                result = await analyze_table_data(acct, table_id)
+            except http_client.CircuitOpenError as e:
+                # BGA is failing, hand the table back and wait for the circuit to let requests through again
+                print(e)
+                metrics.count('bga_errors')
+                queue.append(table_id)
+                await asyncio.sleep(http_client.breaker(http_client.host_of(acct.base)).wait_time())
+                continue
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f'Exception raised for table_id {table_id}: ', e)
+                metrics.count('bga_errors')
+                failed.append(table_id)
+                continue
+
+            if not result:
+                # hand the table over to an account that still has replays left
+                acct.depleted = True
+                queue.append(table_id)
+            elif result == table_id: # this table should be ignored for whichever reason (missing replay, corrupted, etc.)
+                skipped.append(table_id)
+            else:
+                writer.add(table_id, *result)
+
+    # tables handed back by a depleted account after the others ran dry need another round
+    while queue and any(not acct.depleted for acct in accts):
+        await asyncio.gather(*(worker(acct) for acct in accts if not acct.depleted for _ in range(MAX_CONCURRENT_REQUESTS)))
+
+    for acct in accts:
+        print(f'{"account depleted" if acct.depleted else "finished"}... used {acct.replays} replays with {acct.email}', flush=True)
+        hive_db.update_account_quota(acct.email, acct.replays, acct.depleted)
+    hive_db.delete_pending_tables(skipped)
+    hive_db.fail_pending_tables(failed, MAX_TABLE_ATTEMPTS)
+
+    return list(queue)
+
+
+async def main():
+    accts = await login_accounts(ACCOUNTS)
+    if not accts:
+        print('No accounts with replays available')
+        print_schedule(ACCOUNTS)
+        return
+
+    print(f'logged in {len(accts)} accounts', flush=True)
+    writer = hive_db.TableWriter()
+
+    ranked = await get_players_by_rank(accts[0], RANKED_PLAYERS)
+    hive_db.set_player_ranks(ranked)
+    player_ids = hive_db.get_frontier(PLAYERS_PER_RUN)
+    print(f'found the top {len(ranked)} ranking player IDs, searching the {len(player_ids)} best players of the frontier', flush=True)
+
+    new_tables = await get_top_arena_tables(accts[0], player_ids)
+    # the tables earlier runs left behind come first, along with the new ones
+    table_ids = hive_db.get_pending_tables()
+    print(f'proccessing {len(table_ids)} table IDs, {len(new_tables)} of them new:', flush=True)
+
+    remaining = await scrape_tables(accts, table_ids, writer)
+    await asyncio.gather(*(acct.close() for acct in accts))
+
+    writer.flush()
+    print(f'SCRAPING COMPLETED')
+    print(f'  processed {len(table_ids) - len(remaining)} tables')
+    print(f'  {len(remaining)} ids remaining:')
+    print(f'    {remaining}')
+    print_schedule(ACCOUNTS)
+
+
+# concurrent alternative to main.py, safe to run hourly since each account is only used once its replay limit resets
+if __name__ == '__main__':
+    asyncio.run(main())
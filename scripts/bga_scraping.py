@@ -1,9 +1,12 @@
 import json
-import requests
 import time
 
 from db import hive_db
 from accounts import ACCOUNTS
+from scripts import http_cache
+from scripts import http_client
+from db import metrics
+from scripts import replay_archive
 from bs4 import BeautifulSoup
 import datetime
 
@@ -17,26 +20,46 @@ TABLE = '/table/table/tableinfos.html'
 ARCHIVE = '/gamereview/gamereview/requestTableArchive.html'
 REPLAY = '/archive/archive/logs.html'
 GAME_ID = 79
+MAX_HISTORY_PAGES = 500
+RANKED_PLAYERS = 50    # arena ranking refreshed on every run, to weight the frontier towards the best players
+PLAYERS_PER_RUN = 10   # players searched per run, the best of the frontier in hive_db
+HISTORY_OVERLAP = 86400  # seconds of a player's history searched again before their watermark, for late results
+MAX_TABLE_ATTEMPTS = 3   # scrapes of a pending table failing with an error before it's given up on
 
 DEPLETED = 'You have reached a limit (replay)'
 NO_ACCESS = 'Sorry, you need to be registered more than 24 hours and have played at least 2 games to access this feature.'
 EMPTY_ARCHIVE = 'Unfortunately the replay for this game has been lost'
 
+# latency histogram of every request kind, see db/metrics.py
+STAGES = {LOGIN: 'bga_login', RANKING: 'bga_ranking', GAMES: 'bga_history_page', TABLE: 'bga_tableinfos',
+          ARCHIVE: 'bga_archive', REPLAY: 'bga_replay_log'}
+
 sess_gen = None
 
 
+def parse_request_token(content):
+    """ Returns the request_token embedded in the /account login page
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    return soup.find(id='request_token')['value']
+
+
+def login_form(email, password, token):
+    return {'email': email, 'password': password, 'rememberme': 'off', 'redirect': 'join', 'form_id': 'loginform', 'request_token': token}
+
+
 def session_generator():
     # must be a verified bga account with >=2 games and >24 hours old
     for email, password in ACCOUNTS:
-        sess = requests.Session()
+        sess = http_client.Session(account=email)
         sess.email = email
 
         # request to a login page needed to produce request_token
-        resp = sess.get(BASE + '/account')
-        soup = BeautifulSoup(resp.content, 'html.parser')
-        token = soup.find(id='request_token')['value']
-        login_info = {'email': email, 'password': password, 'rememberme': 'off', 'redirect': 'join', 'form_id': 'loginform', 'request_token': token}
-        sess.post(BASE + LOGIN, data=login_info)
+        with metrics.timer(STAGES[LOGIN]):
+            resp = sess.get(BASE + '/account')
+            token = parse_request_token(resp.content)
+            sess.post(BASE + LOGIN, data=login_form(email, password, token))
 
         # pass token along the headers (needed for later calls)
         sess.headers['X-Request-Token'] = token
@@ -55,95 +78,178 @@ def get_next_session():
     return next(sess_gen, None)
 
 
+def history_start(months_ago):
+    """ Returns the timestamp months_ago months (of 30 days) before now
+    """
+    return int((datetime.datetime.now() - datetime.timedelta(days=30 * months_ago)).timestamp())
+
+
+def history_params(player_id, start, end):
+    """ Returns the query params for the first page of player_id's finished games between start and end
+    """
+    return {'page': 0,
+            'player': player_id,
+            'game_id': GAME_ID,
+            'start_date': start,
+            'end_date': end,
+            'finished': 1,
+            'updateStats': 0
+           }
+
+
+def parse_history_page(j):
+    """ Returns the ids of the tables on a page of match history that were not forfeit,
+        or None once the history has no more pages
+    """
+    tables = j['data']['tables']
+    if len(tables) == 0:
+        return
+
+    # get tables that were not forfeit
+    return [int(table['table_id']) for table in tables if table['concede'] != '1']
+
+
+def history_page_table_ids(j):
+    """ Returns the ids of every table on a page of match history, forfeit or not
+    """
+    return [int(table['table_id']) for table in j['data']['tables']]
+
+
+def is_known_history_page(table_ids, known, watermark):
+    """ Returns True if every table on a page of match history is stored already or no newer than the player's
+        watermark, in which case the older pages after it have nothing new either
+    """
+    return watermark is not None and all(table_id in known or table_id <= watermark for table_id in table_ids)
+
+
+def player_history_start(start, watermark):
+    """ Returns the start of a player's history search, only a little before the end of their last complete search
+    """
+    if not watermark:
+        return start
+
+    return max(start, watermark[1] - HISTORY_OVERLAP)
+
+
 def get_top_arena_tables(sess, player_ids, months_ago=12):
-    """ Returns a set of unique table ids for given player_ids' games within the last months_ago months
+    """ Returns a set of unique table ids for given player_ids' games within the last months_ago months.
+        Each player is marked as searched along with how many of their tables were new. A player's history is only
+        searched after their watermark, newest first, stopping at the first page without any new table.
+        The new tables are queued in pending_tables before the watermark moves past them, so the ones a run
+        doesn't get to are scraped by the next one.
     """
 
     all_tables = set()
     exclusion_set = hive_db.get_unique_table_ids()
+    watermarks = hive_db.get_history_watermarks(player_ids)
     now = int(time.time())
-    start = int((datetime.datetime.now() - datetime.timedelta(months=months_ago)).timestamp())
+    start = history_start(months_ago)
+    pages = 0
     #TODO: start_date, end_date = get_current_season_timestamps(sess)
 
     for player_id in player_ids:
         # now that we have a valid token, search every page of this player's match history
-        params = {'page': 0,
-                  'player': player_id,
-                  'game_id': GAME_ID,
-                  'start_date': start,
-                  'end_date': now,
-                  'finished': 1,
-                  'updateStats': 0
-                 }
+        watermark = watermarks.get(player_id)
+        params = history_params(player_id, player_history_start(start, watermark), now)
         table_ids = set()
+        newest = watermark[0] if watermark else None
+        complete = False
         while True:
-            if (params['page'] > 500):
-                print('over 500 pages...')
+            if (params['page'] > MAX_HISTORY_PAGES):
+                print(f'over {MAX_HISTORY_PAGES} pages...')
                 break
             params['page'] += 1
-            resp = sess.get(BASE + GAMES, params=params)
-
-            tables = resp.json()['data']['tables']
-            if len(tables) == 0:
+            pages += 1
+            with metrics.timer(STAGES[GAMES]):
+                resp = sess.get(BASE + GAMES, params=params)
+
+            j = resp.json()
+            ids = parse_history_page(j)
+            if ids is None:
+                complete = True
                 break
 
-            # get tables that were not forfeit
-            ids = [int(table['table_id']) for table in tables if table['concede'] != '1']
             table_ids.update(ids)
+            page_ids = history_page_table_ids(j)
+            newest = max([newest or 0, *page_ids])
+            if is_known_history_page(page_ids, exclusion_set, watermark and watermark[0]):
+                complete = True
+                break
 
         # exclude tables we already have in our DB
         table_ids = table_ids - exclusion_set
         all_tables.update(table_ids)
+        hive_db.searched_player(player_id, len(table_ids))
+        hive_db.add_pending_tables(table_ids)
+        if complete:
+            hive_db.set_history_watermark(player_id, newest, now)
 
+    print(f'searched the match history of {len(player_ids)} players in {pages} pages')
     return all_tables
 
 
+def parse_ranking_page(j):
+    """ Returns the player ids on a page of the arena ranking, highest rank first
+    """
+    return [int(player['id']) for player in j['data']['ranks']]
+
+
 def get_players_by_rank(sess, num_players=10):
-    """ Returns the 10 highest ranking players' ids for the current season
+    """ Returns the num_players highest ranking players' ids for the current season, best first
     """
 
-    players = set()
+    players = []
     params = {'game': GAME_ID, 'mode': 'arena'}
 
     # paginate 10 at a time
     for start in range(0, num_players, 10):
         params['start'] = start
-        resp = sess.get(BASE + RANKING, params=params)
+        with metrics.timer(STAGES[RANKING]):
+            resp = sess.get(BASE + RANKING, params=params)
 
-        for player in resp.json()['data']['ranks']:
+        for player_id in parse_ranking_page(resp.json()):
             if len(players) >= num_players:
                 break
-            players.add(int(player['id']))
+            if player_id not in players:
+                players.append(player_id)
 
     return players
 
 
-def get_expansion_info(sess, table_id):
-    """ Returns a 3 boolean tuple describing whether the given table_id has expansions:
-        (mosquito, ladybug, pillbug)
+def parse_table_info(j, table_id):
+    """ Returns the (mosquito, ladybug, pillbug) booleans from a tableinfos response.
+        Returns None if error, or the table_id if this table should be skipped.
     """
-    if not sess:
-        return
-    
-    # get general info from table
-    resp = sess.get(BASE + TABLE, params={'id': table_id})
-
-    j = resp.json()
     if 'error' in j:
         print(f'Unknown error: {j["error"]}')
+        metrics.count('bga_errors')
         return
-    
+
     try:
         m = j['data']['options']['100']['value'] == '2'
         l = j['data']['options']['101']['value'] == '2'
         p = j['data']['options']['102']['value'] == '2'
     except:
-        print(f'Unknown error: {j["error"]}')
+        print(f'Unknown table options for table {table_id}: {j.get("data")}')
+        metrics.count('bga_skips')
         return table_id
-    
+
     return (m, l, p)
 
 
+def get_expansion_info(sess, table_id):
+    """ Returns a 3 boolean tuple describing whether the given table_id has expansions:
+        (mosquito, ladybug, pillbug)
+    """
+    if not sess:
+        return
+    
+    # get general info from table
+    resp = http_cache.get_cache().fetch(sess, BASE + TABLE, {'id': table_id}, http_cache.has_no_error)
+
+    return parse_table_info(resp.json(), table_id)
+
+
 def analyze_table_data(sess, table_id):
     """ Returns all information about this table_id's replay in the form of:
         (player_id_white, player_id_black, winner, expansion booleans, every move history for this table_id game)
@@ -154,48 +260,71 @@ def analyze_table_data(sess, table_id):
         return
     
     # get general info from table
-    resp = sess.get(BASE + TABLE, params={'table': table_id})
+    cache = http_cache.get_cache()
+    with metrics.timer(STAGES[TABLE]):
+        resp = cache.fetch(sess, BASE + TABLE, {'table': table_id}, http_cache.has_no_error)
+
+    expansions = parse_table_info(resp.json(), table_id)
+    if not isinstance(expansions, tuple):
+        return expansions
+
+    # a cached replay costs no replay quota
+    params = {'table': table_id, 'translated': 'true'}
+    replay = cache.get(BASE + REPLAY, params)
+    if replay is None:
+        # seemingly required to produce log
+        with metrics.timer(STAGES[ARCHIVE]):
+            sess.get(BASE + ARCHIVE, params={'table': table_id})
+        with metrics.timer(STAGES[REPLAY]):
+            replay = cache.fetch(sess, BASE + REPLAY, params, http_cache.has_no_error).content
+
+    j = json.loads(replay)
+    archive_replay(table_id, resp.content, j, replay)
+
+    return parse_replay(j, table_id, sess.email, *expansions)
 
-    j = resp.json()
+
+def archive_replay(table_id, table_content, j, replay_content):
+    """ Keeps the raw tableinfos and logs responses of every replay we could access, for replay_archive's reparse
+    """
     if 'error' in j:
-        print(f'Unknown error: {j["error"]}')
         return
-    
-    try:
-        m = j['data']['options']['100']['value'] == '2'
-        l = j['data']['options']['101']['value'] == '2'
-        p = j['data']['options']['102']['value'] == '2'
-    except:
-        print(f'Unknown error: {j["error"]}')
-        return table_id
-    
 
+    archive = replay_archive.get_archive()
+    archive.put_new(table_id, replay_archive.KIND_BGA_TABLE, table_content)
+    archive.put_new(table_id, replay_archive.KIND_BGA_REPLAY, replay_content)
 
-    # seemingly required to produce log
-    sess.get(BASE + ARCHIVE, params={'table': table_id})
-    resp = sess.get(BASE + REPLAY, params={'table': table_id, 'translated': 'true'})
 
-    j = resp.json()
+def parse_replay(j, table_id, email, m, l, p):
+    """ Returns (player_id_white, player_id_black, winner, m, l, p, actions) from a logs.html response.
+        Returns None if the account can't access further replays, or the table_id if this table should be skipped.
+    """
     if 'error' in j:
         if j['error'] == DEPLETED:
-            print('Account replay access depleted.', sess.email)
+            print('Account replay access depleted.', email)
+            metrics.count('bga_depletions')
             return
         elif j['error'] == NO_ACCESS:
-            print('Account cannot access any replays.', sess.email)
+            print('Account cannot access any replays.', email)
+            metrics.count('bga_depletions')
             return
         elif EMPTY_ARCHIVE in j['error']:
             print(f'Skipping table {table_id}, the replay has been lost or corrupted')
+            metrics.count('bga_skips')
             return table_id
         elif 'disabled for your account' in j['error']:
-            print('Account banned: ', sess.email)
+            print('Account banned: ', email)
+            metrics.count('bga_depletions')
             return
         else:
             print(f'Unknown error: {j["error"]}')
+            metrics.count('bga_errors')
             return table_id
 
     if 'data' not in j:
-        print(f'Response from table_id {table_id} does not contain data:', sess.email)
+        print(f'Response from table_id {table_id} does not contain data:', email)
         print(j)
+        metrics.count('bga_errors')
         return
     
     # GENERAL LAYOUT OF THE RESPONSE JSON:
@@ -256,11 +385,13 @@ def analyze_table_data(sess, table_id):
         elif len(num_winners) > 1:
             winner = 1 #tie (aka sacrifice victory)
 
+        metrics.count('bga_replays')
         return (player_white, player_black, winner, m, l, p, all_actions)
 
     except Exception as e:
         print(f'Error analyzing replay for table {table_id}: ', e)
         print(e.__traceback__.tb_lineno)
+        metrics.count('bga_errors')
         return
 
 
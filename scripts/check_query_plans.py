@@ -0,0 +1,11 @@
+import os
+import sys
+
+import pytest
+
+
+# verify that every hot query in hive_db is served by an index rather than a full table scan,
+# see tests/test_query_plans.py
+if __name__ == "__main__":
+    tests = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'test_query_plans.py')
+    sys.exit(pytest.main(['-q', tests]))
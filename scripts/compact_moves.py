@@ -0,0 +1,118 @@
+from db import hive_db
+from db import move_codec
+from itertools import product
+from scripts.generate_game_strings import build_game_string, build_compact_game_string
+
+import sys
+import time
+
+BATCH_SIZE = 1000
+
+
+def build_games_table():
+    """ Packs the UHP moves of every table with a finished game into the games table.
+        Tables with a notation the codec can't encode are reported and keep only their actions rows.
+        Returns the number of games written and the skipped table_ids.
+    """
+    count = 0
+    rows = []
+    skipped = []
+    for m, l, p in product([True, False], repeat=3):
+        for table, moves in hive_db.iter_table_moves(include_bots=True, uses_m=m, uses_l=l, uses_p=p):
+            game_string = build_game_string(table, moves)
+            if not game_string:
+                continue
+
+            _, state_string, _, moves_string = game_string.split(';', 3)
+            try:
+                packed = move_codec.encode_moves_string(moves_string)
+            except ValueError as e:
+                print(f'Skipping table {table[0]}, its moves cannot be packed: {e}', file=sys.stderr)
+                skipped.append(table[0])
+                continue
+
+            rows.append((table[0], move_codec.GAME_STATES.index(state_string), packed))
+            if len(rows) >= BATCH_SIZE:
+                hive_db.insert_compact_games(rows)
+                count += len(rows)
+                rows = []
+
+    hive_db.insert_compact_games(rows)
+
+    return count + len(rows), skipped
+
+
+def verify_games_table(skipped=()):
+    """ Returns the table_ids whose packed games row doesn't decode back to the game string built from actions,
+        ignoring the skipped table_ids that were left unpacked
+    """
+    skipped = set(skipped)
+    mismatches = []
+    for m, l, p in product([True, False], repeat=3):
+        compact = hive_db.iter_compact_games(include_bots=True, uses_m=m, uses_l=l, uses_p=p)
+        expected = {}
+        for table, moves in hive_db.iter_table_moves(include_bots=True, uses_m=m, uses_l=l, uses_p=p):
+            game_string = build_game_string(table, moves)
+            if game_string and table[0] not in skipped:
+                expected[table[0]] = game_string
+
+        for table, state, moves in compact:
+            if table[0] in skipped:
+                continue
+            if build_compact_game_string(table, state, moves) != expected.pop(table[0], None):
+                mismatches.append(table[0])
+        mismatches.extend(expected)
+
+    return mismatches
+
+
+def table_sizes(names):
+    """ Returns the bytes used on disk by the given tables and their indexes
+    """
+    con = hive_db.get_db().con
+    placeholders = ','.join('?' * len(names))
+    query = f'''
+            SELECT SUM(pgsize) FROM dbstat WHERE name IN ({placeholders})
+            OR name IN (SELECT name FROM sqlite_schema WHERE type = 'index' AND tbl_name IN ({placeholders}))
+            '''
+
+    return con.execute(query, names + names).fetchone()[0] or 0
+
+
+def time_scan(scan):
+    start = time.perf_counter()
+    count = sum(1 for _ in scan())
+
+    return count, time.perf_counter() - start
+
+
+# fill the compact games table from the actions table and report the size and scan speed difference
+if __name__ == "__main__":
+    start = time.perf_counter()
+    count, skipped = build_games_table()
+    print(f'Packed {count} games in {time.perf_counter() - start:.1f}s')
+    if skipped:
+        print(f'{len(skipped)} games could not be packed and keep only their actions: {skipped[:20]}', file=sys.stderr)
+
+    mismatches = verify_games_table(skipped)
+    if mismatches:
+        print(f'{len(mismatches)} games do not round-trip: {mismatches[:20]}', file=sys.stderr)
+        sys.exit(1)
+    print('Every packed game decodes to its original game string')
+
+    actions_size = table_sizes(['actions'])
+    games_size = table_sizes(['games'])
+    print(f'actions: {actions_size / 2**20:.1f}MB, games: {games_size / 2**20:.1f}MB ({actions_size / max(games_size, 1):.1f}x smaller)')
+
+    def scan_actions():
+        for table, moves in hive_db.iter_table_moves(include_bots=True):
+            yield build_game_string(table, moves)
+
+    def scan_games():
+        for table, state, moves in hive_db.iter_compact_games(include_bots=True):
+            yield build_compact_game_string(table, state, moves)
+
+    actions_count, actions_time = time_scan(scan_actions)
+    games_count, games_time = time_scan(scan_games)
+    print(f'game strings from actions: {actions_count} in {actions_time:.2f}s, from games: {games_count} in {games_time:.2f}s '
+          f'({actions_time / max(games_time, 1e-9):.1f}x faster)')
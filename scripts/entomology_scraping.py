@@ -1,7 +1,10 @@
+import argparse
 import json
+import multiprocessing
+import random
+import re
 import signal
 import sys
-import time
 
 from ctypes import c_uint32
 from bs4 import BeautifulSoup
@@ -16,19 +19,39 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 import db.hive_db as hive_db
+from scripts import http_cache
+from scripts import http_client
+from db import metrics
+from scripts import replay_archive
 
 
 BASE = 'https://entomology.gitlab.io/'
 BOARD = 'hive.html'
+MOVES_KEY = 'moves'
+PIECE = re.compile(r'[wb][QSBGAMLP][1-3]?')
+REFERENCE = re.compile(r'[-/\\]?[wb][QSBGAMLP][1-3]?[-/\\]?')
+NON_PIECE_MOVES = ['pass', 'resign', 'offer-draw', 'accept-draw', 'decline-draw']
+RESULTS_QUEUE_SIZE = 1000 # games a parallel crawl's workers can get ahead of the writer
+DECODER_SAMPLE = 20       # games diffed against chrome before a crawl trusts the decoder
 
 index = 0
+writer = None
+
+
+class DecodeError(ValueError):
+    """ Raised for a game whose moves could neither be decoded from its json data nor rendered in the browser
+    """
 
 
 def finish(sig, frame):
+    # commit any buffered tables and failures before recording progress
+    if writer:
+        writer.flush()
     with open('entomology_uuids.txt', 'w') as f:
         if index != 0:
             f.write(str(index + 1))
     print(f'FINISHED! Last index reached: {index}', flush=True)
+    print_failures()
     if sig or frame:
         sys.exit(0)
 
@@ -53,30 +76,47 @@ def construct_xhr(uuid):
     return "/".join(parts)
 
 
-def analyze_table_data(driver: webdriver.Chrome, sess: Session,
-                      uuid, variant='lmp', ranked=True, tournament=False):
-    # first, check if the game's json data matches the given requirements
-    resp = sess.get(BASE + construct_xhr(uuid))
+def fetch_game(sess: Session, uuid, table_id=None):
+    """ Returns the game's json data, or None if the response is empty.
+        Games fetched for a table_id are kept in the replay archive, whatever their variant.
+    """
+    # finished games never change, so any successful response can be served from the cache
+    with metrics.timer('entomology_game'):
+        resp = http_cache.get_cache().fetch(sess, BASE + construct_xhr(uuid))
     resp.raise_for_status()
     j = resp.json()
 
-    if j:
-        if variant and ('variant' not in j or j['variant'] != variant):
-            print(f'Skipping table {uuid}, incorrect variant: {j["variant"] if "variant" in j else ""}')
-            return
-
-        if ranked and ('ranked' not in j or j['ranked'] != 1):
-            print(f'Skipping table {uuid}, not a ranked game')
-            return
-
-        if tournament and ('tournament' not in j or j['tournament'] != 1):
-            print(f'Skipping table {uuid}, not a tournament game')
-            return
-    else:
+    if not j:
         print(f'Invalid response for table: {uuid}, {resp.status_code}, {j}')
         return
-    
-    # game metadata
+
+    if table_id is not None:
+        replay_archive.get_archive().put_new(table_id, replay_archive.KIND_ENTOMOLOGY, resp.content)
+
+    return j
+
+
+def check_game(j, uuid, variant='lmp', ranked=True, tournament=False):
+    """ Returns True if the game's json data matches the given requirements
+    """
+    if variant and ('variant' not in j or j['variant'] != variant):
+        print(f'Skipping table {uuid}, incorrect variant: {j["variant"] if "variant" in j else ""}')
+        return False
+
+    if ranked and ('ranked' not in j or j['ranked'] != 1):
+        print(f'Skipping table {uuid}, not a ranked game')
+        return False
+
+    if tournament and ('tournament' not in j or j['tournament'] != 1):
+        print(f'Skipping table {uuid}, not a tournament game')
+        return False
+
+    return True
+
+
+def game_metadata(j, variant='lmp'):
+    """ Returns (white, black, winner, uses_mosquito, uses_ladybug, uses_pillbug) from the game's json data
+    """
     winner = j['result'] if 'result' in j else ''
     white = j['white']['name'] if 'white' in j and 'name' in j['white'] else ''
     black = j['black']['name'] if 'black' in j and 'name' in j['black'] else ''
@@ -84,6 +124,52 @@ def analyze_table_data(driver: webdriver.Chrome, sess: Session,
     uses_ladybug = variant and 'l' in j['variant']
     uses_pillbug = variant and 'p' in j['variant']
 
+    return (white, black, winner, uses_mosquito, uses_ladybug, uses_pillbug)
+
+
+def decode_move(move):
+    """ Returns the notation hive.html displays for one raw move of the game's json data, or None if unrecognized.
+        Piece moves end with the destination relative to another piece, or '.' for the very first placement:
+        'dropb wQ N 13 .' -> 'wQ', 'move B bA1 M 12 wQ-' -> 'bA1 wQ-'. Already decoded MoveStrings pass through.
+    """
+    if not isinstance(move, str):
+        return
+
+    tokens = move.split()
+    pieces = [i for i, token in enumerate(tokens) if PIECE.fullmatch(token)]
+    if not pieces:
+        return move.strip() if move.strip().lower() in NON_PIECE_MOVES else None
+
+    piece = tokens[pieces[0]]
+    ref = tokens[-1] if len(tokens) > pieces[0] + 1 else '.'
+    if ref == '.':
+        return piece
+
+    if REFERENCE.fullmatch(ref):
+        return f'{piece} {ref}'
+
+
+def decode_moves(j):
+    """ Builds the same action_list as render_moves() straight from the game's json data, without a browser.
+        Returns None if any move can't be decoded.
+    """
+    if not isinstance(j.get(MOVES_KEY), list):
+        return
+
+    action_list = []
+    for num, move in enumerate(j[MOVES_KEY]):
+        notation = decode_move(move)
+        if notation is None:
+            return
+
+        action_list.append({'notation': notation, 'move_number': num + 1})
+
+    return action_list
+
+
+def render_moves(driver: webdriver.Chrome, uuid):
+    """ Returns the action_list scraped from hive.html rendered in the browser, or None if it has no moves list
+    """
     # now load the game's processed movelist from the raw html response
     url = BASE + BOARD + "?game=" + uuid
     driver.get(url)
@@ -107,21 +193,295 @@ def analyze_table_data(driver: webdriver.Chrome, sess: Session,
         print(f'Error finding moves list for: {uuid}')
         return None
     
-    return (white, black, winner, uses_mosquito, uses_ladybug, uses_pillbug, action_list)
+    return action_list
 
 
-if __name__ == '__main__':
-    # CTRL-C catcher
-    signal.signal(signal.SIGINT, finish)
+def analyze_table_data(driver: webdriver.Chrome, sess: Session,
+                      uuid, variant='lmp', ranked=True, tournament=False, table_id=None, decode=True):
+    """ Returns (white, black, winner, uses_mosquito, uses_ladybug, uses_pillbug, action_list) for the game,
+        or None if it doesn't match the requirements. The moves are decoded from the game's json data,
+        and only rendered with the driver (if one is given) when decoding fails, or for every game without decode.
+        Raises DecodeError if neither gets the moves, so the caller can record the game instead of losing it.
+    """
+    # first, check if the game's json data matches the given requirements
+    j = fetch_game(sess, uuid, table_id)
+    if not j or not check_game(j, uuid, variant, ranked, tournament):
+        metrics.count('entomology_skips')
+        return
+
+    action_list = decode_moves(j) if decode else None
+    if action_list is None and driver:
+        with metrics.timer('entomology_render'):
+            action_list = render_moves(driver, uuid)
+
+    if action_list is None:
+        raise DecodeError(f'could not {"decode or render" if driver else "decode"} the moves list of {uuid}')
+
+    metrics.count('entomology_games')
+    return (*game_metadata(j, variant), action_list)
 
-    # setup selenium chrome driver and a requests Session
-    driver = new_webdriver()
-    sess = Session()
+
+def verify_decoder(driver: webdriver.Chrome, sess: Session, uuids, variant='lmp'):
+    """ Diffs decode_moves() against the moves rendered by the browser for each uuid.
+        Returns the number of games where they (match, differ).
+    """
+    matched, mismatched = 0, 0
+    for uuid in uuids:
+        j = fetch_game(sess, uuid)
+        if not j or not check_game(j, uuid, variant, ranked=False):
+            continue
+
+        decoded = decode_moves(j)
+        rendered = render_moves(driver, uuid)
+        if decoded == rendered:
+            matched += 1
+            continue
+
+        mismatched += 1
+        if decoded is None:
+            print(f'MISMATCH {uuid}: could not decode {j.get(MOVES_KEY)}')
+            continue
+
+        for move_number, (ours, theirs) in enumerate(zip(decoded, rendered or []), start=1):
+            if ours != theirs:
+                print(f'MISMATCH {uuid} at move {move_number}: decoded {ours["notation"]!r}, rendered {theirs["notation"]!r}')
+                break
+        else:
+            print(f'MISMATCH {uuid}: decoded {len(decoded)} moves, rendered {len(rendered or [])}')
+
+    print(f'Decoder verification: {matched} games match, {mismatched} differ')
+    return matched, mismatched
+
+
+def decoder_agrees(driver: webdriver.Chrome, sess: Session, uuid_list):
+    """ Returns True if decode_moves() matches the moves chrome renders on a random sample of DECODER_SAMPLE games.
+        Until it does, a crawl with chrome renders every game instead of trusting the decoder.
+    """
+    matched, mismatched = verify_decoder(driver, sess, random.sample(uuid_list, min(DECODER_SAMPLE, len(uuid_list))))
+    if mismatched or not matched:
+        print('The decoder could not be verified, rendering every game in chrome', flush=True)
+        return False
+
+    return True
+
+
+def plan_shards(list_size, num_shards):
+    """ Splits the uuid indexes past the existing shards into num_shards new shards,
+        and returns every shard that still has indexes left to crawl
+    """
+    shards = hive_db.get_crawl_shards()
+    start = max((end_index for _, _, end_index, _ in shards), default=0)
+    if start < list_size:
+        size = -(-(list_size - start) // num_shards)
+        hive_db.add_crawl_shards([(i, min(i + size, list_size)) for i in range(start, list_size, size)])
+        shards = hive_db.get_crawl_shards()
+
+    return [shard for shard in shards if shard[3] < shard[2]]
+
+
+def record_failure(writer, table_id, reason):
+    """ Keeps a game that failed in crawl_failures, where --retry-failed picks it up again
+    """
+    print(f'FAILED table_id {table_id}: {reason}', flush=True)
+    metrics.count('entomology_failures')
+    writer.fail(table_id, reason)
+
+
+def print_failures():
+    failures = hive_db.get_crawl_failures()
+    if failures:
+        print(f'{len(failures)} games failed and were not stored, retry them with --retry-failed', flush=True)
+
+
+def crawl_worker(tasks, results, uuid_list, selenium=False, decode=True):
+    """ Worker process with its own Session (and driver): crawls each (shard_id, next_index, end_index) task
+        and sends (shard_id, index, results, error) for every uuid to the writer process, where error
+        is why a game failed, or None
+    """
+    # CTRL-C is handled by the writer process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sess = http_client.Session()
+    driver = new_webdriver() if selenium else None
+    failures = 0
+
+    while (task := tasks.get()) is not None:
+        shard_id, i, end_index = task
+        while i < end_index:
+            try:
+                results.put((shard_id, i, analyze_table_data(driver, sess, uuid_list[i], 'lmp', ranked=True, tournament=False,
+                                                             table_id=c_uint32(i).value, decode=decode), None))
+
+            except (DecodeError, JSONDecodeError, HTTPError) as e:
+                # move on, the writer records this uuid as failed
+                print(f'Exception raised for uuid {uuid_list[i]}: ' + str(e), flush=True)
+                metrics.count('entomology_errors')
+                results.put((shard_id, i, None, f'{type(e).__name__}: {e}'))
+
+            except WebDriverException as e:
+                # retry this uuid with a new driver
+                print(e)
+                print('Attempting to establish new connection...', flush=True)
+                metrics.count('entomology_errors')
+                http_client.record_failure(BASE)
+                http_client.wait_for_host(BASE, failures)
+                failures += 1
+                driver.quit()
+                driver = new_webdriver()
+                continue
+
+            except RequestException as e:
+                # the session already retried, retry this uuid once the host is back
+                print(e)
+                print('Attempting to establish new connection...', flush=True)
+                metrics.count('entomology_errors')
+                http_client.wait_for_host(BASE, failures)
+                failures += 1
+                continue
+
+            failures = 0
+            i += 1
+
+    if driver:
+        driver.quit()
+    # worker processes exit without running atexit handlers
+    metrics.flush()
+    results.put(None)
+
+
+def results_depth(results):
+    """ Returns the games waiting on the writer in a results queue, or -1 where qsize() isn't implemented (macOS)
+    """
+    try:
+        return results.qsize()
+    except NotImplementedError:
+        return -1
+
+
+def crawl_parallel(uuid_list, workers, num_shards, selenium=False, decode=True):
+    """ Crawls the uuid_list with a pool of worker processes while this process does every insert.
+        Each shard's progress is committed together with its tables, so a restart resumes every shard where it stopped.
+    """
+    shards = plan_shards(len(uuid_list), num_shards)
+    print(f'Crawling {sum(end - next for _, _, end, next in shards)} uuids left in {len(shards)} shards with {workers} workers', flush=True)
+
+    tasks, results = multiprocessing.Queue(), multiprocessing.Queue(maxsize=RESULTS_QUEUE_SIZE)
+    for shard_id, _, end_index, next_index in shards:
+        tasks.put((shard_id, next_index, end_index))
+    for _ in range(workers):
+        tasks.put(None)
+
+    procs = [multiprocessing.Process(target=crawl_worker, args=(tasks, results, uuid_list, selenium, decode), daemon=True)
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+
+    writer = hive_db.TableWriter()
+    running = workers
+    try:
+        while running:
+            message = results.get()
+            if message is None:
+                running -= 1
+                continue
+
+            shard_id, i, result, error = message
+            metrics.gauge('entomology_results_queue', results_depth(results))
+            # simply using the index as the unique primary key in the database
+            uuid_key = c_uint32(i).value
+            if result:
+                writer.add(uuid_key, *result)
+                print(f'Inserted table_id: {uuid_key}, num_moves: {len(result[-1])}')
+            elif error:
+                record_failure(writer, uuid_key, error)
+            writer.checkpoint(shard_id, i + 1)
+
+    except KeyboardInterrupt:
+        print('Interrupted, committing progress...', flush=True)
+
+    finally:
+        writer.flush()
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+
+    remaining = plan_shards(len(uuid_list), num_shards)
+    print(f'FINISHED! {len(remaining)} shards left to crawl', flush=True)
+    print_failures()
+
+
+def retry_failures(driver, sess, uuid_list, decode=True):
+    """ Crawls every entomology game recorded in crawl_failures again. The ones that get through are stored and leave the table.
+    """
+    failures = [failure for failure in hive_db.get_crawl_failures() if hive_db.table_source(failure[0]) == 'entomology']
+    print(f'Retrying {len(failures)} failed games', flush=True)
+
+    writer = hive_db.TableWriter()
+    skipped = []
+    for table_id, _, _ in failures:
+        try:
+            results = analyze_table_data(driver, sess, uuid_list[table_id], 'lmp', ranked=True, tournament=False, table_id=table_id, decode=decode)
+        except (DecodeError, JSONDecodeError, HTTPError) as e:
+            record_failure(writer, table_id, f'{type(e).__name__}: {e}')
+            continue
+
+        if results:
+            writer.add(table_id, *results)
+            print(f'Inserted table_id: {table_id}, num_moves: {len(results[-1])}')
+        else:
+            # it doesn't match the requirements, there's nothing to retry
+            skipped.append(table_id)
+
+    writer.flush()
+    hive_db.delete_crawl_failures(skipped)
+    print_failures()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-selenium', action='store_true', help='only decode the moves, without rendering hive.html in chrome '
+                                                                     'for games that fail to decode. Use it once --verify passes.')
+    parser.add_argument('--verify', type=int, metavar='N', help='diff the decoder against chrome on a random sample of N games, then exit')
+    parser.add_argument('--retry-failed', action='store_true', help='crawl the games that failed in earlier runs again, then exit')
+    parser.add_argument('--workers', type=int, default=0, help='crawl with this many worker processes, resuming from the shard checkpoints in the DB')
+    parser.add_argument('--shards', type=int, default=64, help='number of shards to split new uuid indexes into for --workers')
+    args = parser.parse_args()
 
     uuid_list = []
     with open('entomology_uuids.json', 'r') as f:
         uuid_list = json.load(f)
 
+    if args.verify:
+        driver = new_webdriver()
+        _, mismatched = verify_decoder(driver, http_client.Session(), random.sample(uuid_list, min(args.verify, len(uuid_list))))
+        driver.quit()
+        sys.exit(1 if mismatched else 0)
+
+    # a rate limited requests Session, plus a selenium chrome driver to fall back on rendering unless told not to.
+    # The decoder's format is inferred from the json data, so with chrome it is only trusted once it agrees
+    # with the rendered moves on a sample, otherwise every game is rendered.
+    selenium = not args.no_selenium
+    driver = new_webdriver() if selenium else None
+    sess = http_client.Session()
+    decode = not driver or decoder_agrees(driver, sess, uuid_list)
+    if args.workers:
+        if driver:
+            driver.quit()
+        crawl_parallel(uuid_list, args.workers, args.shards, selenium, decode)
+        sys.exit(0)
+
+    if args.retry_failed:
+        retry_failures(driver, sess, uuid_list, decode)
+        if driver:
+            driver.quit()
+        sys.exit(0)
+
+    # CTRL-C catcher
+    signal.signal(signal.SIGINT, finish)
+
+    writer = hive_db.TableWriter()
+    failures = 0
+
     list_size = len(uuid_list)
     try:
         with open('entomology_uuids.txt', 'r') as f:
@@ -147,34 +507,40 @@ if __name__ == '__main__':
                     print(f'Skipping table_id {uuid_key}, already in Database')
                     continue
 
-                results = analyze_table_data(driver, sess, uuid_list[i], 'lmp', ranked=True, tournament=False)
+                results = analyze_table_data(driver, sess, uuid_list[i], 'lmp', ranked=True, tournament=False, table_id=uuid_key, decode=decode)
+                failures = 0
                 if results:
-                    hive_db.insert_table_data(uuid_key, *results)
+                    writer.add(uuid_key, *results)
                     exclusion_set.add(uuid_key)
                     print(f'Inserted table_id: {uuid_key}, num_moves: {len(results[-1])}')
 
-        except JSONDecodeError as e:
+        except (DecodeError, JSONDecodeError) as e:
             print(f'Exception raised for uuid {uuid_list[i]}: ' + str(e))
-            time.sleep(1)
+            metrics.count('entomology_errors')
 
-            # skip over this uuid
+            # skip over this uuid, but keep it for --retry-failed
+            record_failure(writer, c_uint32(index).value, f'{type(e).__name__}: {e}')
             index += 1
             continue
 
         except HTTPError as e:
             print('HTTPError: ' + str(e))
-            time.sleep(1)
+            metrics.count('entomology_errors')
 
-            # skip over this uuid
+            # skip over this uuid, but keep it for --retry-failed
+            record_failure(writer, c_uint32(index).value, f'{type(e).__name__}: {e}')
             index += 1
             continue
         
         except WebDriverException as e:
             # write current progress to disk and attempt to create a new connection
             print(e)
-            print('Attempting to establish new connection in 1 minute...')
+            print('Attempting to establish new connection...')
+            metrics.count('entomology_errors')
             finish(None, None)
-            time.sleep(60)
+            http_client.record_failure(BASE)
+            http_client.wait_for_host(BASE, failures)
+            failures += 1
 
             if driver:
                 driver.quit()
@@ -183,12 +549,13 @@ if __name__ == '__main__':
             continue
 
         except RequestException as e:
+            # the session already retried, wait for the host to come back
             print(e)
-            print('Attempting to establish new connection in 1 minute...')
+            print('Attempting to establish new connection...')
+            metrics.count('entomology_errors')
             finish(None, None)
-            time.sleep(60)
-
-            sess = Session()
+            http_client.wait_for_host(BASE, failures)
+            failures += 1
             continue
 
 
@@ -0,0 +1,205 @@
+import argparse
+import glob
+import mmap
+import os
+import random
+import struct
+import sys
+from array import array
+
+from db import move_codec
+from db.sources import SOURCES, table_source
+from scripts.uhp import get_game_type_string, get_turn_string, table_ids_path
+
+# Binary sidecar of a game_strings/ export, memory-mapped so training jobs get random access to any game or
+# position without parsing or loading the text. After the header, the file holds these little endian arrays:
+#   offsets   uint64[games + 1]  index of each game's first move in moves, then the total
+#   table_ids uint64[games]      NO_TABLE_ID if the export has no .tables file (0 is a valid entomology id)
+#   game_of   uint32[positions]  game index of each position, i.e. of the move played from it
+#   moves     uint16[positions]  db/move_codec.py codes
+#   flags     uint8[games]       FLAG_* expansion bits, plus the index of the table's source in db/sources.py SOURCES
+#   states    uint8[games]       index of the GameStateString in move_codec.GAME_STATES
+SIDECAR_SUFFIX = '.games'
+MAGIC = b'HVGS'
+VERSION = 2
+HEADER = struct.Struct('<4sHHQQ')  # magic, version, reserved, games, positions
+
+FLAG_MOSQUITO = 1
+FLAG_LADYBUG = 2
+FLAG_PILLBUG = 4
+SOURCE_SHIFT = 3
+UNKNOWN_SOURCE = len(SOURCES)
+NO_TABLE_ID = 2**64 - 1  # largest uint64
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + SIDECAR_SUFFIX
+
+
+def game_flags(game_type, source):
+    expansions = game_type.partition('+')[2]
+    return (('M' in expansions) * FLAG_MOSQUITO | ('L' in expansions) * FLAG_LADYBUG | ('P' in expansions) * FLAG_PILLBUG
+            | source << SOURCE_SHIFT)
+
+
+def build_sidecar(path, source=None):
+    """ Packs every GameString of an export into its sidecar. Each game's source comes from the table_id in the
+        export's .tables file, or is the given source name for exports without one. Returns the sidecar's path.
+    """
+    table_ids = []
+    if os.path.exists(table_ids_path(path)):
+        with open(table_ids_path(path), 'r') as f:
+            table_ids = [int(line) for line in f if line.strip()]
+
+    offsets, ids, game_of, flags, states = array('Q', [0]), array('Q'), array('I'), array('B'), array('B')
+    moves = bytearray()
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            game_type, state, _, moves_string = line.rstrip('\n').split(';', 3)
+            game = len(states)
+            table_id = table_ids[game] if game < len(table_ids) else NO_TABLE_ID
+            if table_id != NO_TABLE_ID:
+                game_source = SOURCES.index(table_source(table_id))
+            else:
+                game_source = SOURCES.index(source) if source else UNKNOWN_SOURCE
+
+            blob = move_codec.encode_moves_string(moves_string)
+            moves += blob
+            offsets.append(offsets[-1] + len(blob) // 2)
+            ids.append(table_id)
+            game_of.extend([game] * (len(blob) // 2))
+            flags.append(game_flags(game_type, game_source))
+            states.append(move_codec.GAME_STATES.index(state))
+
+    if table_ids and len(table_ids) != len(states):
+        print(f'{path} has {len(states)} games but {len(table_ids)} table_ids')
+
+    if sys.byteorder != 'little':
+        for values in (offsets, ids, game_of):
+            values.byteswap()
+
+    tmp_path = sidecar_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(states), len(game_of)))
+        for values in (offsets, ids, game_of):
+            f.write(values.tobytes())
+        f.write(moves)
+        f.write(flags.tobytes())
+        f.write(states.tobytes())
+    os.replace(tmp_path, sidecar_path(path))
+
+    return sidecar_path(path)
+
+
+class GameDataset:
+    """ Read-only view of an export's sidecar: game i and position j are both O(1) lookups into the memory map,
+        so only the pages actually touched are ever read from disk.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError('game sidecars are little endian')
+
+        self.path = path if path.endswith(SIDECAR_SUFFIX) else sidecar_path(path)
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.games, self.positions = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{self.path} is not a version {VERSION} game sidecar')
+
+        view = memoryview(self.map)
+        start = HEADER.size
+        sections = [('offsets', 'Q', self.games + 1), ('table_ids', 'Q', self.games), ('game_of', 'I', self.positions),
+                    ('moves', 'H', self.positions), ('flags', 'B', self.games), ('states', 'B', self.games)]
+        for name, fmt, count in sections:
+            end = start + count * struct.calcsize(fmt)
+            setattr(self, name, view[start:end].cast(fmt))
+            start = end
+
+    def __len__(self):
+        return self.games
+
+    def close(self):
+        for name in ('offsets', 'table_ids', 'game_of', 'moves', 'flags', 'states'):
+            getattr(self, name).release()
+        self.map.close()
+
+    def move_codes(self, i):
+        """ Returns the move codes of game i as a zero-copy memoryview
+        """
+        return self.moves[self.offsets[i]:self.offsets[i + 1]]
+
+    def game(self, i):
+        """ Returns (table_id, source, (m, l, p), GameStateString, MoveStrings) for game i, table_id being None
+            if the export had no .tables file
+        """
+        flags = self.flags[i]
+        source = flags >> SOURCE_SHIFT
+        table_id = self.table_ids[i]
+        return (table_id if table_id != NO_TABLE_ID else None, SOURCES[source] if source < UNKNOWN_SOURCE else None,
+                (bool(flags & FLAG_MOSQUITO), bool(flags & FLAG_LADYBUG), bool(flags & FLAG_PILLBUG)),
+                move_codec.GAME_STATES[self.states[i]], list(map(move_codec.decode_move, self.move_codes(i))))
+
+    def game_string(self, i):
+        _, _, expansions, state, moves = self.game(i)
+
+        return ';'.join([get_game_type_string(*expansions), state, get_turn_string(len(moves)), ';'.join(moves)])
+
+    def position(self, j):
+        """ Returns the (game index, ply) of global position j, the position before that game's ply-th move
+        """
+        game = self.game_of[j]
+        return game, j - self.offsets[game]
+
+    def select(self, m=None, l=None, p=None, sources=None):
+        """ Returns the indexes of the games matching every given expansion flag and one of the given sources
+        """
+        source_ids = {SOURCES.index(source) for source in sources} if sources else None
+        wanted = [(FLAG_MOSQUITO, m), (FLAG_LADYBUG, l), (FLAG_PILLBUG, p)]
+
+        return array('I', (i for i, flags in enumerate(self.flags)
+                           if all(value is None or bool(flags & flag) == value for flag, value in wanted)
+                           and (source_ids is None or flags >> SOURCE_SHIFT in source_ids)))
+
+    def iter_games(self, games=None, shuffle=False, seed=None):
+        """ Yields (game index, move codes) for the given game indexes, every game by default
+        """
+        order = list(range(self.games) if games is None else games)
+        if shuffle:
+            random.Random(seed).shuffle(order)
+
+        for i in order:
+            yield i, self.move_codes(i)
+
+    def iter_positions(self, games=None, shuffle=False, seed=None):
+        """ Yields (game index, ply, move code) for every position of the given games,
+            shuffled across games rather than within each one if asked
+        """
+        if games is None:
+            order = list(range(self.positions))
+        else:
+            order = [j for i in games for j in range(self.offsets[i], self.offsets[i + 1])]
+        if shuffle:
+            random.Random(seed).shuffle(order)
+
+        for j in order:
+            game = self.game_of[j]
+            yield game, j - self.offsets[game], self.moves[j]
+
+
+# python -m scripts.game_dataset [game_strings files], builds the sidecar of every export by default
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='GameString files to build sidecars for, every file in game_strings/ by default')
+    parser.add_argument('--source', choices=SOURCES, help='source of every game in exports without a .tables file')
+    args = parser.parse_args()
+
+    for path in args.paths or sorted(glob.glob('game_strings/*.txt')):
+        dataset = GameDataset(build_sidecar(path, args.source))
+        counts = {source: len(dataset.select(sources=[source])) for source in SOURCES}
+        print(f'{dataset.path}: {dataset.games} games, {dataset.positions} positions, by source {counts}')
+        dataset.close()
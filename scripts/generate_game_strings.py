@@ -1,28 +1,20 @@
 from datetime import datetime
 from db import hive_db
+from db import move_codec
+from scripts import hive_engine
+from scripts.uhp import get_game_type_string, get_turn_string, table_ids_path
+from db import metrics
 
 import argparse
+import multiprocessing
+import os
 import sys
 
-# parser = argparse.ArgumentParser()
-
-# parser.add_argument('args', nargs='*', help='Arguments to process')
-# parser.add_argument('-v', '--verbose', action=argparse.BooleanOptionalAction, default=False, type=bool)
-# args = parser.parse_args()
-# print('Arguments:', args.args)
-
 
 # UHP strings for final output
-UHP_BASE_GAME = 'Base'
-UHP_WHITE_WINS = 'WhiteWins'
-UHP_BLACK_WINS = 'BlackWins'
-UHP_DRAW = 'Draw'
 UHP_PASS_MOVE = 'pass'
 
-# expected string formats from BoardSpace games
-BS_WHITE_WINS = 'white wins'
-BS_BLACK_WINS = 'black wins'
-BS_DRAW = 'draw'
+# expected string formats from BoardSpace games, see hive_db.game_result() for their results
 BS_OFFER_DRAW = 'offer-draw'
 BS_ACCEPT_DRAW = 'accept-draw'
 BS_DECLINE_DRAW = 'decline-draw'
@@ -36,96 +28,208 @@ BGA_ACCEPT_DRAW = 'acceptDraw'
 BGA_VICTORY = 'queenSurr'
 
 FOLDER_PATH = './game_strings/'
+EXPORT_CHUNK_SIZE = 1000  # tables converted by an export worker at once
+
+def build_game_string(table, moves):
+    """ Returns the UHP GameString for a row of the tables table and its ordered moves list,
+        or None if no finished game can be constructed from them
+    """
+    id, white, black, winner, m, l, p = table
+
+    # generate GameTypeString from expansions
+    game_type_string = get_game_type_string(m, l, p)
+
+    # generate MoveStrings
+    moves_to_join = []
+    if not moves:
+        print(f"No actions found for table: {id}", file=sys.stderr)
+        return
+
+    for i, move in enumerate(moves):
+        move_num, notation, table_id, move_type, type_copied, _ = move
+
+        if not notation:
+            if move_type == BGA_PASS:
+                moves_to_join.append(UHP_PASS_MOVE)
+            elif move_type in [BGA_ACCEPT_DRAW, BGA_OFFER_DRAW, BGA_VICTORY]:
+                pass
+            elif move_type == BGA_DEFAULT_MOVE:
+                print(f'Expected move notation for move {move_num} at table {table_id}', file=sys.stderr)
+            else:
+                print(f'Unknown move {move_num} for table {table_id}', file=sys.stderr)
+        elif notation in [BS_OFFER_DRAW, BS_ACCEPT_DRAW, BS_DECLINE_DRAW, BS_RESIGN]:
+            pass
+        else:
+            moves_to_join.append(notation.strip('[]').strip())
+
+    moves_string = ';'.join(moves_to_join)
+
+    # generate GameStateString from the winner, or an accepted draw
+    state_string = hive_db.game_result(white, black, winner, [(move[0], move[1], move[3]) for move in moves])
+    if not state_string:
+        print(f"Can't find a winner from ({winner}) for table: {id}", file=sys.stderr)
+        return
+
+    # generate TurnString from moves
+    turn_string = get_turn_string(len(moves_to_join))
+
+    return ';'.join([game_type_string, state_string, turn_string, moves_string])
+
+
+def build_compact_game_string(table, state, moves):
+    """ Returns the UHP GameString for a row of the tables table and its packed games row
+    """
+    _, _, _, _, m, l, p = table
+    moves_to_join = move_codec.decode_moves(moves)
+
+    return ';'.join([get_game_type_string(m, l, p), move_codec.GAME_STATES[state],
+                     get_turn_string(len(moves_to_join)), ';'.join(moves_to_join)])
+
+
+def exported_table_ids(path):
+    """ Returns the set of table_ids an export's .tables file lists, empty if it has none
+    """
+    if not os.path.exists(table_ids_path(path)):
+        return set()
+
+    with open(table_ids_path(path), 'r') as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def export_chunk(task):
+    """ Worker entry point: builds and checks the game strings of a (filters, sorted table_ids, dedupe, seq_range)
+        chunk. Returns the (table_id, game_string, game key) of every exported game in table_id order,
+        where the key identifies the game up to symmetry if dedupe is set, and is None otherwise.
+    """
+    filters, table_ids, dedupe, seq_range = task
+    if dedupe:
+        # numpy is only needed to dedupe
+        from scripts import position_index
+
+    games = []
+    wanted = set(table_ids)
+    # stream every table with its moves in one ordered scan instead of querying actions per table,
+    # the range also holding the tables left out of table_ids (e.g. already in an incremental export)
+    for table, moves in hive_db.iter_table_moves(**filters, table_range=(table_ids[0], table_ids[-1]), seq_range=seq_range):
+        if table[0] not in wanted:
+            continue
+
+        game_string = build_game_string(table, moves)
+        if not game_string:
+            continue
+
+        # replay the moves so no illegal game makes it into the export
+        try:
+            hive_engine.check_game_string(game_string)
+        except ValueError as e:
+            print(f'Skipping illegal game for table {table[0]}: {e}', file=sys.stderr)
+            continue
+
+        key = position_index.game_key(position_index.hash_game_string(game_string)[0]) if dedupe else None
+        games.append((table[0], game_string, key))
+
+    return games
+
+
+def export(path, mode, filters, table_ids, workers=1, watermark=None, exported=0, dedupe=False, seq_range=None):
+    """ Writes the game strings of table_ids to path and its .tables file, EXPORT_CHUNK_SIZE tables per task
+        in a pool of worker processes. Chunks are written in table_id order whatever order they finish in.
+        Each chunk only reads the tables written within seq_range, if given.
+        With a watermark key, the games written so far are recorded after every chunk, the watermark staying at
+        seq_range's start until the whole range is exported.
+        With dedupe, games identical to one already in the file up to symmetry are dropped. Returns the games written.
+    """
+    tasks = [(filters, table_ids[i:i + EXPORT_CHUNK_SIZE], dedupe, seq_range) for i in range(0, len(table_ids), EXPORT_CHUNK_SIZE)]
+
+    count, duplicates = 0, 0
+    with open(path, mode) as f, open(table_ids_path(path), mode) as ids, multiprocessing.Pool(workers) as pool:
+        seen = set()
+        if dedupe and mode == 'a':
+            from scripts import position_index
+            with open(path, 'r') as existing:
+                lines = existing.readlines()
+            seen.update(pool.imap(position_index.game_key_of, lines, chunksize=EXPORT_CHUNK_SIZE))
+
+        chunks = pool.imap(export_chunk, tasks)
+        for _ in tasks:
+            # time spent waiting on the workers, while writing is timed separately
+            with metrics.timer('export_chunk'):
+                games = next(chunks)
+
+            with metrics.timer('export_write'):
+                for table_id, game_string, key in games:
+                    if key is not None:
+                        if key in seen:
+                            duplicates += 1
+                            metrics.count('export_duplicates')
+                            continue
+                        seen.add(key)
+
+                    f.write(game_string + '\n')
+                    ids.write(f'{table_id}\n')
+                    print(f'[{exported + count}] Successfully added game string for table {table_id}')
+                    count += 1
+                    metrics.count('export_games')
+
+                if watermark:
+                    # only checkpoint what is on disk, an interrupted export resumes by skipping the tables its file lists
+                    f.flush()
+                    ids.flush()
+                    hive_db.set_export_watermark(watermark, seq_range[0] if seq_range else 0, path, exported + count)
+
+    if dedupe:
+        print(f'Dropped {duplicates} duplicate games')
+
+    return count
+
+
+def run_export(filters, name, watermark=None, workers=1, dedupe=False):
+    """ Exports the filtered tables to a new file in FOLDER_PATH, or with a watermark key appends the tables written
+        since the previous run with that key to its file. Returns (path, games written).
+    """
+    # an incremental export keeps appending to the file its watermark points at
+    row = hive_db.get_export_watermark(watermark) if watermark else None
+    if row and os.path.exists(row[2]):
+        _, last_seq, path, exported, _ = row
+        mode = 'a'
+        print(f'Appending game strings of the tables written since sequence {last_seq} to {path}:')
+    else:
+        last_seq, exported, mode = 0, 0, 'x'
+        path = f'{FOLDER_PATH}GameStrings_{name}_{datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")}.txt'
+        print(f'Creating game strings:')
+
+    # select by insertion sequence rather than table_id, tables aren't stored in table_id order.
+    # Tables written during the export are left to the next run.
+    seq_range = (last_seq, hive_db.get_last_seq()) if watermark else None
+    table_ids = hive_db.get_table_ids(**filters, seq_range=seq_range)
+    if mode == 'a':
+        # a table written again after it was exported (e.g. reparsed) keeps its line, as do an interrupted run's tables
+        table_ids = sorted(set(table_ids) - exported_table_ids(path))
+    with metrics.timer('export'):
+        count = export(path, mode, filters, table_ids, workers, watermark, exported, dedupe, seq_range)
+    if watermark:
+        hive_db.set_export_watermark(watermark, seq_range[1], path, exported + count)
+
+    print(f'EXPORT COMPLETED: {count} games added from {len(table_ids)} tables, {exported + count} in {path}')
+    return path, count
+
 
 # create UHP-compliant game strings out of tables db
 # https://github.com/jonthysell/Mzinga/wiki/UniversalHiveProtocol#gamestring
 if __name__ == "__main__":
-    # TODO use argparse
-    file_path = f'GameStrings_{"Base+MLP"}{"+NoBots" if 1 else "+Bots"}_{datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")}.txt'
-    with open(FOLDER_PATH + file_path, 'x') as f:
-
-        tables = hive_db.get_all_table_data(include_bots=False, uses_m=True, uses_l=True, uses_p=True, include_bga=True, include_bs=False)
-        print(f'Creating {len(tables)} game strings:')
-
-        count = 0
-        for id, white, black, winner, m, l, p in tables:
-            # generate GameTypeString from expansions
-            game_type_string = UHP_BASE_GAME
-            if m or l or p:
-                game_type_string += '+'
-            if m:
-                game_type_string += 'M'
-            if l:
-                game_type_string += 'L'
-            if p:
-                game_type_string += 'P'
-
-            # generate GameStateString from the winner
-            state_string = ''
-            if isinstance(winner, str): # BoardSpace uses a string for the winner
-                if winner == BS_WHITE_WINS:
-                    state_string = UHP_WHITE_WINS
-                elif winner == BS_BLACK_WINS:
-                    state_string = UHP_BLACK_WINS
-                elif winner == BS_DRAW:
-                    state_string = UHP_DRAW
-            elif isinstance(winner, int): # BoardGameArena uses an ID for a winner
-                if winner == 0:
-                    # this means the game ended in a mutually agreed draw
-                    state_string = UHP_DRAW
-                elif winner == 1:
-                    # an actual draw via double queen surrender
-                    state_string = UHP_DRAW
-                elif winner == white:
-                    state_string = UHP_WHITE_WINS
-                elif winner == black:
-                    state_string = UHP_BLACK_WINS
-                else:
-                    print(f"Can't find a winner from ({winner}) for table: {id}", file=sys.stderr)
-                    continue
-
-            # generate MoveStrings
-            moves_to_join = []
-            moves = hive_db.get_moves_list(id)
-            if not moves:
-                print(f"No actions found for table: {id}", file=sys.stderr)
-                continue
-
-            for i, move in enumerate(moves):
-                move_num, notation, table_id, move_type, type_copied, _ = move                
-
-                if not notation:
-                    if move_type == BGA_ACCEPT_DRAW:
-                        state_string = UHP_DRAW
-                    elif move_type == BGA_PASS:
-                        moves_to_join.append(UHP_PASS_MOVE)
-                    elif move_type == BGA_OFFER_DRAW or move_type == BGA_VICTORY:
-                        pass
-                    elif move_type == BGA_DEFAULT_MOVE:
-                        print(f'Expected move notation for move {move_num} at table {table_id}', file=sys.stderr)
-                    else:
-                        print(f'Unknown move {move_num} for table {table_id}', file=sys.stderr)
-                elif notation == BS_ACCEPT_DRAW:
-                    state_string = UHP_DRAW
-                elif notation in [BS_OFFER_DRAW, BS_DECLINE_DRAW, BS_RESIGN]:
-                    pass
-                else:
-                    moves_to_join.append(notation.strip('[]').strip())
-
-            moves_string = ';'.join(moves_to_join)
-
-            # ensure we have a finished game state after going through moves list
-            if not state_string:
-                print(f"Can't find a winner from ({winner}) for table: {id}", file=sys.stderr)
-                continue
-
-            # generate TurnString from moves
-            num_moves = len(moves_to_join)
-            turn_num = (num_moves // 2) + 1
-            turn_string = 'White' if num_moves % 2 == 0 else 'Black'
-            turn_string = f'{turn_string}[{turn_num}]'
-
-            # join all parts and save to disk
-            f.write(';'.join([game_type_string, state_string, turn_string, moves_string]) + '\n')
-            print(f'[{count}] Successfully added game string for table {id}')
-            count += 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expansions', default='MLP', help='expansion bugs of the exported games, e.g. MLP, or "" for the base game')
+    parser.add_argument('--bots', action='store_true', help='include games played against bots')
+    parser.add_argument('--source', choices=['bga', 'bs', 'all'], default='bga', help='export BoardGameArena tables, every other table, or both')
+    parser.add_argument('--incremental', action='store_true', help='append only the tables added since the last incremental export with the same filters')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='converter processes')
+    parser.add_argument('--dedupe', action='store_true', help='drop games identical to an exported one up to symmetry, see scripts/position_index.py')
+    args = parser.parse_args()
+
+    m, l, p = ('M' in args.expansions), ('L' in args.expansions), ('P' in args.expansions)
+    filters = {'include_bots': args.bots, 'uses_m': m, 'uses_l': l, 'uses_p': p,
+               'include_bga': args.source != 'bs', 'include_bs': args.source != 'bga'}
+    name = f'{get_game_type_string(m, l, p)}{"+Bots" if args.bots else "+NoBots"}{"+Dedupe" if args.dedupe else ""}'
+    watermark = f'{name}+{args.source}' if args.incremental else None
+
+    run_export(filters, name, watermark, args.workers, args.dedupe)
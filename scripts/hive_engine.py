@@ -0,0 +1,690 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+
+from db.move_codec import BUGS, COLORS, DIRECTION_OFFSETS, GAME_STATES, PASS_MOVE, format_move, parse_move
+
+# Hive rules for the Base game and its Mosquito, Ladybug and Pillbug expansions, checked one UHP MoveString at a time.
+# https://github.com/jonthysell/Mzinga/wiki/UniversalHiveProtocol
+#
+# Cells are axial (q, r) coordinates packed into a single int, q * ROW + r, so a neighbour is one addition away.
+# Games never span more than ROW / 2 cells in any direction. NEIGHBORS lists the six neighbouring offsets in
+# circular order, so the two cells shared by a cell and its neighbour i are its neighbours i - 1 and i + 1.
+ROW = 256
+DELTAS = [q * ROW + r for q, r in DIRECTION_OFFSETS]
+NEIGHBORS = DELTAS[1:]
+# (neighbour, shared neighbour, shared neighbour) offsets for each of the six steps out of a cell
+STEPS = [(NEIGHBORS[i], NEIGHBORS[i - 1], NEIGHBORS[(i + 1) % 6]) for i in range(6)]
+
+BASE_GAME = 'Base'
+EXPANSION_BUGS = 'MLP'
+PIECES_BY_COLOR = {color: [color + bug for bug in BUGS] for color in COLORS}
+QUEEN_DEADLINE = 4  # each player's queen must be placed by their 4th turn
+CHECK_CHUNK_SIZE = 500  # games handed to a checker process at once
+
+NOT_STARTED, IN_PROGRESS, DRAW, WHITE_WINS, BLACK_WINS = GAME_STATES
+
+
+class IllegalMove(ValueError):
+    pass
+
+
+def axial(cell):
+    """ Returns the (q, r) coordinates of a packed cell
+    """
+    q = (cell + ROW // 2) // ROW
+    return q, cell - q * ROW
+
+
+def parse_game_type(game_type):
+    """ Returns the set of expansion bug letters in a GameTypeString, e.g. 'Base+MLP' -> {'M', 'L', 'P'}
+    """
+    base, _, expansions = game_type.partition('+')
+    if base != BASE_GAME or any(bug not in EXPANSION_BUGS for bug in expansions):
+        raise ValueError(f'invalid GameTypeString: {game_type!r}')
+
+    return set(expansions)
+
+
+def articulation_points(cells):
+    """ Returns the cells whose removal splits the hive in two, with an iterative Tarjan lowlink search
+    """
+    start = next(iter(cells), None)
+    if start is None:
+        return set()
+
+    cut = set()
+    order = {start: 0}
+    low = {start: 0}
+    root_children = 0
+    # (cell, parent, neighbours left to visit)
+    stack = [(start, None, iter(NEIGHBORS))]
+    while stack:
+        cell, parent, todo = stack[-1]
+        for d in todo:
+            other = cell + d
+            if other not in cells:
+                continue
+            if other not in order:
+                order[other] = low[other] = len(order)
+                stack.append((other, cell, iter(NEIGHBORS)))
+                break
+            if other != parent:
+                low[cell] = min(low[cell], order[other])
+        else:
+            stack.pop()
+            if parent is None:
+                continue
+            low[parent] = min(low[parent], low[cell])
+            if parent == start:
+                root_children += 1
+            elif low[cell] >= order[parent]:
+                cut.add(parent)
+
+    if root_children > 1:
+        cut.add(start)
+
+    return cut
+
+
+class GameState:
+    """ A game in progress. play() applies one MoveString at a time, raising IllegalMove if the rules forbid it.
+    """
+
+    def __init__(self, expansions=()):
+        self.expansions = set(expansions)
+        self.stacks = {}      # cell -> pieces on it, bottom first
+        self.positions = {}   # piece -> cell
+        self.turn = 0         # moves played so far, passes included
+        self.last_moved = ''  # piece moved on the previous turn
+        self.thrown = False   # whether the previous turn moved last_moved with a pillbug
+        self.state = NOT_STARTED
+        self._cut = None      # articulation points of the current position, None until searched
+
+    def copy(self):
+        game = GameState(self.expansions)
+        game.stacks = {cell: list(stack) for cell, stack in self.stacks.items()}
+        game.positions = dict(self.positions)
+        game.turn, game.last_moved, game.thrown, game.state = self.turn, self.last_moved, self.thrown, self.state
+        game._cut = self._cut
+
+        return game
+
+    def to_move(self):
+        return COLORS[self.turn % 2]
+
+    def height(self, cell):
+        stack = self.stacks.get(cell)
+        return len(stack) if stack else 0
+
+    def top(self, cell):
+        stack = self.stacks.get(cell)
+        return stack[-1] if stack else None
+
+    def _lift(self, piece):
+        cell = self.positions[piece]
+        stack = self.stacks[cell]
+        stack.pop()
+        if not stack:
+            del self.stacks[cell]
+
+        return cell
+
+    def _drop(self, piece, cell):
+        self.stacks.setdefault(cell, []).append(piece)
+        self.positions[piece] = cell
+
+    def _is_connected(self):
+        """ One Hive rule: True if every occupied cell is reachable from any other one
+        """
+        stacks = self.stacks
+        start = next(iter(stacks), None)
+        if start is None:
+            return True
+
+        seen = {start}
+        todo = [start]
+        while todo:
+            cell = todo.pop()
+            for d in NEIGHBORS:
+                other = cell + d
+                if other in stacks and other not in seen:
+                    seen.add(other)
+                    todo.append(other)
+
+        return len(seen) == len(stacks)
+
+    def _keeps_hive(self, cell):
+        """ True if the hive stays in one piece once the (already lifted) piece on cell is gone.
+            Neighbours forming a single unbroken arc around the cell stay connected through each other.
+        """
+        if cell in self.stacks:
+            return True
+
+        ring = [cell + d in self.stacks for d in NEIGHBORS]
+        arcs = sum(1 for i in range(6) if ring[i] and not ring[i - 1])
+        return arcs <= 1 or self._is_connected()
+
+    def _can_step(self, cell, step, level):
+        """ Freedom To Move for a piece at `level` stepping from cell to one of its neighbours, on the hive or not.
+            It must not squeeze between two stacks higher than both ends of the step, and must keep touching the hive.
+        """
+        d, side_a, side_b = step
+        stacks = self.stacks
+        to_level = len(stacks.get(cell + d, ()))
+        side_a, side_b = len(stacks.get(cell + side_a, ())), len(stacks.get(cell + side_b, ()))
+        if min(side_a, side_b) > max(level, to_level):
+            return False
+
+        return level > 0 or to_level > 0 or side_a > 0 or side_b > 0
+
+    def _slides(self, cell):
+        """ Empty cells a ground piece can crawl to in one step from cell
+        """
+        stacks = self.stacks
+        # exactly one of the two shared cells is occupied: any less loses the hive, any more is a gate
+        return [cell + d for d, a, b in STEPS if cell + d not in stacks and (cell + a in stacks) != (cell + b in stacks)]
+
+    def _queen_moves(self, cell, target=None):
+        return set(self._slides(cell))
+
+    def _beetle_moves(self, cell, target=None):
+        level = self.height(cell)
+        steps = STEPS if target is None or target - cell not in NEIGHBORS else [STEPS[NEIGHBORS.index(target - cell)]]
+        return {cell + step[0] for step in steps if self._can_step(cell, step, level)}
+
+    def _grasshopper_moves(self, cell, target=None):
+        moves = set()
+        for d in NEIGHBORS:
+            to = cell + d
+            if to not in self.stacks:
+                continue
+            while to in self.stacks:
+                to += d
+            moves.add(to)
+
+        return moves
+
+    def _spider_moves(self, cell, target=None):
+        paths = [(cell,)]
+        for _ in range(3):
+            paths = [path + (to,) for path in paths for to in self._slides(path[-1]) if to not in path]
+
+        return {path[-1] for path in paths}
+
+    def _ant_moves(self, cell, target=None):
+        """ Every cell an ant crawls to from cell. With a target, stops as soon as it is found.
+        """
+        stacks = self.stacks
+        seen = {cell}
+        todo = [cell]
+        while todo:
+            at = todo.pop()
+            for d, a, b in STEPS:
+                to = at + d
+                if to in seen or to in stacks or (at + a in stacks) == (at + b in stacks):
+                    continue
+                if to == target:
+                    return {to}
+                seen.add(to)
+                todo.append(to)
+
+        seen.discard(cell)
+        return seen
+
+    def _ladybug_moves(self, cell, target=None):
+        """ Every cell a ladybug reaches from cell. With a target, only the steps down onto it are tried.
+        """
+        last_steps = STEPS if target is None else [step for step in STEPS if target - step[0] in self.stacks]
+        moves = set()
+        for step in STEPS:
+            first = cell + step[0]
+            if first not in self.stacks or not self._can_step(cell, step, 0):
+                continue
+            for step2 in STEPS:
+                second = first + step2[0]
+                if second == cell or second not in self.stacks or not self._can_step(first, step2, self.height(first)):
+                    continue
+                for step3 in last_steps:
+                    to = second + step3[0]
+                    if target is not None and to != target:
+                        continue
+                    if to != cell and to not in self.stacks and self._can_step(second, step3, self.height(second)):
+                        moves.add(to)
+
+        return moves
+
+    def _mosquito_moves(self, cell, target=None):
+        # on top of the hive a mosquito can only move like a beetle
+        if self.height(cell):
+            return self._beetle_moves(cell, target)
+
+        moves = set()
+        copied = {self.stacks[cell + d][-1][1] for d in NEIGHBORS if cell + d in self.stacks}
+        for bug in copied - {'M'}:
+            moves |= BUG_MOVES[bug](self, cell, target)
+            if target in moves:
+                break
+
+        return moves
+
+    def piece_moves(self, piece, cell, target=None):
+        """ Cells the piece can move to from cell by itself, with the piece already lifted off the board.
+            With a target, the search may stop early and skip moves that can't reach it.
+        """
+        return BUG_MOVES[piece[1]](self, cell, target)
+
+    def throwers(self, color):
+        """ Cells of the pieces able to use the pillbug's ability for color this turn:
+            its own pillbug, or its own mosquito on the ground next to a pillbug
+        """
+        cells = []
+        for piece in (color + 'P', color + 'M'):
+            cell = self.positions.get(piece)
+            if cell is None or self.top(cell) != piece or (self.thrown and piece == self.last_moved):
+                continue
+            if piece[1] == 'M' and (self.height(cell) > 1 or
+                                    not any(self.top(cell + d) in ('wP', 'bP') for d in NEIGHBORS)):
+                continue
+            cells.append(cell)
+
+        return cells
+
+    def _can_throw(self, throwers, piece, start, to):
+        """ True if one of the throwers can move piece from start onto itself and down to `to`.
+            The piece is already lifted off the board.
+        """
+        if piece == self.last_moved or to == start or start in self.stacks or to in self.stacks:
+            return False
+
+        for thrower in throwers:
+            if to - thrower not in NEIGHBORS or start - thrower not in NEIGHBORS:
+                continue
+
+            # up from start onto the thrower, then down from the thrower onto `to`
+            up = STEPS[NEIGHBORS.index(thrower - start)]
+            down = STEPS[NEIGHBORS.index(to - thrower)]
+            if self._can_step(start, up, 0) and self._can_step(thrower, down, self.height(thrower)):
+                return True
+
+        return False
+
+    def _check_placement(self, piece, to):
+        if self.turn == 0:
+            return
+
+        if to in self.stacks:
+            raise IllegalMove('placement on top of another piece')
+
+        tops = [self.stacks[to + d][-1] for d in NEIGHBORS if to + d in self.stacks]
+        if not tops:
+            raise IllegalMove('placement away from the hive')
+        if self.turn > 1 and any(top[0] != piece[0] for top in tops):
+            raise IllegalMove('placement next to an opponent piece')
+
+    def articulation_points(self):
+        """ Cells that can't be emptied without breaking the hive. Searched once, then updated by every move
+            that changes the occupied cells, see _update_cut().
+        """
+        if self._cut is None:
+            self._cut = articulation_points(self.stacks)
+
+        return self._cut
+
+    def _splits(self, cell):
+        """ True if emptying cell breaks the hive, i.e. its neighbours can't all reach each other without it
+        """
+        stacks = self.stacks
+        targets = {cell + d for d in NEIGHBORS if cell + d in stacks}
+        if len(targets) <= 1:
+            return False
+
+        start = targets.pop()
+        seen = {cell, start}
+        todo = deque([start])
+        while todo and targets:
+            current = todo.popleft()
+            for d in NEIGHBORS:
+                other = current + d
+                if other in stacks and other not in seen:
+                    seen.add(other)
+                    targets.discard(other)
+                    todo.append(other)
+
+        return bool(targets)
+
+    def _update_cut(self, cell, added):
+        """ Updates the articulation points after cell got occupied (added) or emptied, in a hive connected
+            before and after. When the cell's neighbours form a single arc, only the cells on it can change:
+            - a lone neighbour, which a new cell makes a cut point (unless they're the whole hive), and which may stop
+              being one when the cell is emptied
+            - a neighbour inside the arc, whose two sides a new cell joins, and which an emptied cell may leave as their only link
+            Any other cut point stays one and no other cell becomes one, so those few are checked with _splits().
+            A cell between several arcs closes or opens a ring, which can change cells anywhere on it: search again.
+        """
+        if self._cut is None:
+            return
+
+        ring = [cell + d in self.stacks for d in NEIGHBORS]
+        if sum(1 for i in range(6) if ring[i] and not ring[i - 1]) > 1:
+            self._cut = None
+            return
+
+        # copies share the set
+        cut = set(self._cut)
+        if sum(ring) == 1:
+            neighbour = cell + NEIGHBORS[ring.index(True)]
+            if added and len(self.stacks) > 2:
+                cut.add(neighbour)
+            candidates = [neighbour] if not added and neighbour in cut else []
+        elif sum(ring) < 6:
+            candidates = [cell + NEIGHBORS[i] for i in range(6) if ring[i] and ring[i - 1] and ring[(i + 1) % 6]
+                          and (cell + NEIGHBORS[i] in cut) == added]
+        else:
+            candidates = []
+
+        cut.discard(cell)
+        for other in candidates:
+            if self._splits(other):
+                cut.add(other)
+            else:
+                cut.discard(other)
+        self._cut = cut
+
+    def _placements(self, color):
+        in_hand = [piece for piece in PIECES_BY_COLOR[color]
+                   if piece not in self.positions and (piece[1] not in EXPANSION_BUGS or piece[1] in self.expansions)]
+        if color + 'Q' in in_hand and self.turn // 2 + 1 >= QUEEN_DEADLINE:
+            in_hand = [color + 'Q']
+
+        stacks = self.stacks
+        if self.turn == 0:
+            cells = [0]
+        elif self.turn == 1:
+            cells = [cell + d for cell in stacks for d in NEIGHBORS]
+        else:
+            edge = {cell + d for cell, stack in stacks.items() if stack[-1][0] == color for d in NEIGHBORS} - stacks.keys()
+            cells = [cell for cell in edge if all(stacks[cell + d][-1][0] == color for d in NEIGHBORS if cell + d in stacks)]
+
+        return [(piece, cell) for piece in in_hand for cell in cells]
+
+    def legal_moves(self):
+        """ Returns every (piece, cell) move the player to move can make, placements of every piece in hand included.
+            An empty list means the only legal move is a pass.
+        """
+        if self.state not in (NOT_STARTED, IN_PROGRESS):
+            return []
+
+        color = self.to_move()
+        moves = self._placements(color)
+        if color + 'Q' not in self.positions:
+            return moves
+
+        cut = self.articulation_points()
+        throwers = self.throwers(color)
+        for piece, cell in list(self.positions.items()):
+            stack = self.stacks[cell]
+            if stack[-1] != piece or (len(stack) == 1 and cell in cut):
+                continue
+
+            self._lift(piece)
+            if piece[0] == color and not (self.thrown and piece == self.last_moved):
+                moves += [(piece, to) for to in self.piece_moves(piece, cell)]
+
+            if cell not in self.stacks:
+                for thrower in throwers:
+                    if thrower == cell or cell - thrower not in NEIGHBORS:
+                        continue
+                    moves += [(piece, thrower + d) for d in NEIGHBORS
+                              if self._can_throw([thrower], piece, cell, thrower + d)]
+            self._drop(piece, cell)
+
+        return list(dict.fromkeys(moves))
+
+    def move_string(self, piece, cell):
+        """ Returns a MoveString for moving (or placing) piece onto cell in the current position
+        """
+        if not self.stacks:
+            return piece
+
+        stack = self.stacks.get(cell)
+        if stack and stack[-1] != piece:
+            return format_move(piece, stack[-1], 0)
+
+        for direction, d in enumerate(DELTAS[1:], start=1):
+            ref_stack = self.stacks.get(cell - d)
+            if ref_stack and ref_stack != [piece]:
+                ref = ref_stack[-1] if ref_stack[-1] != piece else ref_stack[-2]
+                return format_move(piece, ref, direction)
+
+        raise IllegalMove(f'{piece} has no neighbour to move next to')
+
+    def resolve(self, notation):
+        """ Returns the (piece, cell) a MoveString refers to in the current position
+        """
+        piece, ref, direction = parse_move(notation)
+        if ref:
+            if ref not in self.positions:
+                raise IllegalMove(f'reference piece {ref} is not on the board')
+            return piece, self.positions[ref] + DELTAS[direction]
+        elif self.turn == 0:
+            return piece, 0
+
+        raise IllegalMove('missing reference piece')
+
+    def play(self, notation):
+        """ Applies a MoveString, raising IllegalMove if it breaks the rules
+        """
+        if self.state not in (NOT_STARTED, IN_PROGRESS):
+            raise IllegalMove('move after the game has ended')
+
+        color = self.to_move()
+        if notation == PASS_MOVE:
+            if self.legal_moves():
+                raise IllegalMove('passing with a legal move available')
+            self._end_turn('', False)
+            return
+
+        piece, to = self.resolve(notation)
+        if piece[1] in EXPANSION_BUGS and piece[1] not in self.expansions:
+            raise IllegalMove(f'{piece} is not part of this game type')
+
+        queen_placed = color + 'Q' in self.positions
+        if piece not in self.positions:
+            if piece[0] != color:
+                raise IllegalMove('placing an opponent piece')
+            if not queen_placed and piece[1] != 'Q' and self.turn // 2 + 1 >= QUEEN_DEADLINE:
+                raise IllegalMove('queen not placed by the 4th turn')
+
+            self._check_placement(piece, to)
+            self._drop(piece, to)
+            self._update_cut(to, True)
+            self._end_turn(piece, False)
+            return
+
+        if not queen_placed:
+            raise IllegalMove('moving before the queen is placed')
+
+        start = self.positions[piece]
+        if self.stacks[start][-1] != piece:
+            raise IllegalMove(f'{piece} is covered')
+        if to == start:
+            raise IllegalMove(f'{piece} does not move')
+
+        self._lift(piece)
+        if not self._keeps_hive(start):
+            self._drop(piece, start)
+            raise IllegalMove(f'moving {piece} breaks the hive')
+
+        frozen = self.thrown and piece == self.last_moved
+        thrown = piece[0] != color or frozen or to not in self.piece_moves(piece, start, to)
+        if thrown:
+            # a mosquito can copy the very pillbug it throws, so look for throwers with the piece still in place
+            self._drop(piece, start)
+            throwers = self.throwers(color)
+            self._lift(piece)
+            if not self._can_throw(throwers, piece, start, to):
+                self._drop(piece, start)
+                raise IllegalMove(f'{piece} cannot move there')
+
+        # the piece is off the board here, so the hive goes through two connected positions: without start, then with to
+        if start not in self.stacks:
+            self._update_cut(start, False)
+        occupied = to in self.stacks
+        self._drop(piece, to)
+        if not occupied:
+            self._update_cut(to, True)
+        self._end_turn(piece, thrown)
+
+    def _surrounded(self, queen):
+        cell = self.positions.get(queen)
+        stacks = self.stacks
+        return cell is not None and all(cell + d in stacks for d in NEIGHBORS)
+
+    def _end_turn(self, piece, thrown):
+        self.turn += 1
+        self.last_moved = piece
+        self.thrown = thrown
+
+        # a surrounded queen takes at least 7 occupied cells
+        if len(self.stacks) < 7:
+            self.state = IN_PROGRESS
+            return
+
+        white_lost, black_lost = self._surrounded('wQ'), self._surrounded('bQ')
+        if white_lost and black_lost:
+            self.state = DRAW
+        elif white_lost:
+            self.state = BLACK_WINS
+        elif black_lost:
+            self.state = WHITE_WINS
+        else:
+            self.state = IN_PROGRESS
+
+
+BUG_MOVES = {
+    'Q': GameState._queen_moves,
+    'S': GameState._spider_moves,
+    'B': GameState._beetle_moves,
+    'G': GameState._grasshopper_moves,
+    'A': GameState._ant_moves,
+    'M': GameState._mosquito_moves,
+    'L': GameState._ladybug_moves,
+    'P': GameState._queen_moves,
+}
+
+
+def check_game_string(game_string):
+    """ Replays a GameString, raising IllegalMove (or ValueError if it is malformed) at the first broken rule.
+        Returns the final GameState, whose state must match the GameStateString once a queen is surrounded.
+    """
+    game_type, state, turn, moves = game_string.rstrip('\n').split(';', 3)
+    game = GameState(parse_game_type(game_type))
+    moves = moves.split(';') if moves else []
+    for i, move in enumerate(moves):
+        try:
+            game.play(move)
+        except IllegalMove as e:
+            raise IllegalMove(f'move {i + 1} {move!r}: {e}') from None
+
+    if game.state not in (NOT_STARTED, IN_PROGRESS) and game.state != state:
+        raise IllegalMove(f'game state is {state} but the position is {game.state}')
+    if turn != f'{"White" if game.turn % 2 == 0 else "Black"}[{game.turn // 2 + 1}]':
+        raise IllegalMove(f'turn string {turn} does not match {len(moves)} moves')
+
+    return game
+
+
+def check_legal_moves(game_string):
+    """ Generates the legal moves of every position in a GameString, raising IllegalMove if a played move
+        is missing from them. Returns the number of positions.
+    """
+    game_type, _, _, moves = game_string.rstrip('\n').split(';', 3)
+    game = GameState(parse_game_type(game_type))
+    for i, move in enumerate(moves.split(';') if moves else []):
+        legal = game.legal_moves()
+        if move != PASS_MOVE and game.resolve(move) not in legal:
+            raise IllegalMove(f'move {i + 1} {move!r} is not among the {len(legal)} generated moves')
+        game.play(move)
+
+    return game.turn
+
+
+def bench_legal_moves(paths):
+    """ Runs check_legal_moves() over every GameString in the given files and prints positions per second
+    """
+    positions, mismatched = 0, 0
+    start = time.time()
+    for path in paths:
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    positions += check_legal_moves(line)
+                except ValueError as e:
+                    mismatched += 1
+                    print(f'{path}:{line_number}: {e}')
+
+    elapsed = time.time() - start
+    print(f'{positions} positions generated, {mismatched} games mismatched, {positions / elapsed if elapsed else 0:.0f} positions/s')
+    return mismatched
+
+
+def check_lines(task):
+    """ Worker entry point: checks a (path, first line number, lines) chunk and returns its error messages
+    """
+    path, first_line, lines = task
+    errors = []
+    for line_number, line in enumerate(lines, start=first_line):
+        if not line.strip():
+            continue
+        try:
+            check_game_string(line)
+        except ValueError as e:
+            errors.append(f'{path}:{line_number}: {e}')
+
+    return errors
+
+
+def check_files(paths, workers=1):
+    """ Checks every GameString in the given files with a pool of worker processes, printing the illegal ones.
+        Returns the number of illegal games.
+    """
+    tasks = []
+    games = 0
+    for path in paths:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        games += sum(1 for line in lines if line.strip())
+        tasks += [(path, i + 1, lines[i:i + CHECK_CHUNK_SIZE]) for i in range(0, len(lines), CHECK_CHUNK_SIZE)]
+
+    illegal = 0
+    start = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        for errors in pool.imap(check_lines, tasks):
+            illegal += len(errors)
+            for error in errors:
+                print(error)
+
+    elapsed = time.time() - start
+    print(f'{games} games checked, {illegal} illegal, {games / elapsed if elapsed else 0:.0f} games/s with {workers} workers')
+    return illegal
+
+
+# python -m scripts.hive_engine [game_strings files], every exported file by default
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='GameString files to check, every file in game_strings/ by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='checker processes')
+    parser.add_argument('--legal-moves', action='store_true', help='benchmark legal move generation at every position instead')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob('game_strings/*.txt'))
+    if args.legal_moves:
+        sys.exit(1 if bench_legal_moves(paths) else 0)
+    sys.exit(1 if check_files(paths, args.workers) else 0)
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from urllib.parse import urlencode
+
+CACHE_DIR = 'cache/http'
+CACHE_TTL = 90 * 24 * 60 * 60   # seconds before a cached response is refetched
+CACHE_MAX_BYTES = 4 * 2**30     # compressed bytes kept on disk before the least recently used are evicted
+EVICT_INTERVAL = 1000           # responses stored between eviction passes
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses(
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created INTEGER NOT NULL,
+    last_access INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_blob ON responses(blob);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access);
+'''
+
+
+class CachedResponse:
+    """ The parts of requests.Response the scrapers use, served from the cache
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class ResponseCache:
+    """ On-disk cache of raw response bodies keyed by URL and params.
+        Bodies are zlib compressed and stored under the sha256 of their content, so identical payloads are kept once.
+        Entries expire after ttl seconds, and the least recently used are evicted beyond max_bytes.
+    """
+
+    def __init__(self, path=CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.puts = 0
+        os.makedirs(path, exist_ok=True)
+
+        self.con = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.executescript(CACHE_SCHEMA)
+
+    @staticmethod
+    def key(url, params=None):
+        request = url + '?' + urlencode(sorted((params or {}).items()))
+
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _blob_path(self, blob):
+        return os.path.join(self.path, blob[:2], blob + '.z')
+
+    def get(self, url, params=None):
+        """ Returns the cached body for this request, or None if it is missing or expired
+        """
+        key = self.key(url, params)
+        now = int(time.time())
+        with closing(self.con.cursor()) as cur:
+            cur.execute('SELECT blob, created FROM responses WHERE key = ?', [key])
+            row = cur.fetchone()
+            if not row or now - row[1] > self.ttl:
+                return
+
+            try:
+                with open(self._blob_path(row[0]), 'rb') as f:
+                    content = zlib.decompress(f.read())
+            except (OSError, zlib.error):
+                return
+
+            with self.con:
+                cur.execute('UPDATE responses SET last_access = ? WHERE key = ?', [now, key])
+
+            return content
+
+    def put(self, url, params, content):
+        blob = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(blob)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f'{blob_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(content))
+            os.replace(tmp_path, blob_path)
+
+        now = int(time.time())
+        with self.con, closing(self.con.cursor()) as cur:
+            cur.execute('INSERT OR REPLACE INTO responses(key, url, blob, size, created, last_access) VALUES(?,?,?,?,?,?)',
+                        [self.key(url, params), url, blob, os.path.getsize(blob_path), now, now])
+
+        self.puts += 1
+        if self.puts % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def size(self):
+        with closing(self.con.cursor()) as cur:
+            cur.execute('SELECT SUM(size) FROM (SELECT DISTINCT blob, size FROM responses)')
+
+            return cur.fetchone()[0] or 0
+
+    def evict(self):
+        """ Drops expired entries, then the least recently used ones until the cache fits in max_bytes
+        """
+        expired = int(time.time()) - self.ttl
+        with self.con, closing(self.con.cursor()) as cur:
+            cur.execute('SELECT blob FROM responses WHERE created < ?', [expired])
+            dropped = {row[0] for row in cur.fetchall()}
+            cur.execute('DELETE FROM responses WHERE created < ?', [expired])
+
+            total = self.size()
+            if total > self.max_bytes:
+                cur.execute('SELECT key, blob, size FROM responses ORDER BY last_access ASC')
+                rows = cur.fetchall()
+                refs = {}
+                for _, blob, _ in rows:
+                    refs[blob] = refs.get(blob, 0) + 1
+
+                for key, blob, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    self.con.execute('DELETE FROM responses WHERE key = ?', [key])
+                    dropped.add(blob)
+                    # a shared blob only frees its bytes once the last request using it is gone
+                    refs[blob] -= 1
+                    if not refs[blob]:
+                        total -= size
+
+            # blobs are shared by every request with identical content, only remove unreferenced ones
+            for blob in dropped:
+                if not cur.execute('SELECT 1 FROM responses WHERE blob = ?', [blob]).fetchone():
+                    try:
+                        os.remove(self._blob_path(blob))
+                    except OSError:
+                        pass
+
+    def fetch(self, sess, url, params=None, cacheable=None):
+        """ sess.get() through the cache. Successful responses are only stored if cacheable(resp) is true.
+        """
+        content = self.get(url, params)
+        if content is not None:
+            return CachedResponse(content)
+
+        resp = sess.get(url, params=params)
+        if resp.status_code == 200:
+            try:
+                store = cacheable(resp) if cacheable else True
+            except ValueError:
+                store = False
+
+            if store:
+                self.put(url, params, resp.content)
+
+        return resp
+
+
+# one cache handle per process, since the parallel crawlers fork after import
+_caches = {}
+
+
+def get_cache():
+    if os.getpid() not in _caches:
+        _caches[os.getpid()] = ResponseCache()
+
+    return _caches[os.getpid()]
+
+
+def has_no_error(resp):
+    """ Cache policy for BGA json: errors such as a depleted replay limit must be requested again
+    """
+    return 'error' not in resp.json()
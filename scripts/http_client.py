@@ -0,0 +1,274 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Request layer shared by every scraper. Each host and each account gets a token bucket whose rate adapts to the
+# server: it backs off by half on throttling (429/503) and creeps back up on success. Transient failures are retried
+# with jittered exponential backoff, and a host failing CIRCUIT_FAILURES times in a row gets no requests at all
+# until CIRCUIT_RESET seconds have passed, when a single trial request decides whether it recovered.
+HOST_RATES = {                      # requests per second a host starts at, and never exceeds
+    'boardgamearena.com': 4.0,
+    'entomology.gitlab.io': 8.0,
+}
+DEFAULT_RATE = 4.0
+ACCOUNT_RATE = 2.0                  # requests per second a single account starts at, on top of its host's limit
+MIN_RATE = 0.2                      # throttling never slows a bucket below one request per 5 seconds
+THROTTLE_COOLDOWN = 1.0             # seconds after halving a rate during which further throttling is the same episode
+RATE_INCREASE = 0.05                # requests per second added back after every success
+BURST = 4                           # requests a bucket can send at once after being idle
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0                  # seconds, doubled after every failed attempt
+BACKOFF_MAX = 60.0
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET = 60.0
+TIMEOUT = 30                        # seconds before a request is considered failed
+POOL_SIZE = 16                      # keep-alive connections kept per host
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """ Raised instead of sending a request to a host whose circuit is open
+    """
+
+
+class TokenBucket:
+    """ Token bucket with an adaptive rate: halved on throttling, at most once per THROTTLE_COOLDOWN so the requests
+        already in flight don't halve it again, and increased by RATE_INCREASE on success
+    """
+
+    def __init__(self, rate, max_rate=None, burst=BURST):
+        self.rate = rate
+        self.max_rate = max_rate or rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_throttle = None
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Takes a token, and returns how many seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.last_throttle is None or now - self.last_throttle >= THROTTLE_COOLDOWN:
+                self.rate = max(MIN_RATE, self.rate / 2)
+                self.last_throttle = now
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+
+class CircuitBreaker:
+    """ Opens after CIRCUIT_FAILURES consecutive failures, then lets one trial request through every CIRCUIT_RESET seconds
+    """
+
+    def __init__(self, failures=CIRCUIT_FAILURES, reset=CIRCUIT_RESET):
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        """ Returns how many seconds remain before the circuit lets a request through, 0 if it's closed
+        """
+        with self.lock:
+            if self.opened is None:
+                return 0.0
+
+            return max(0.0, self.opened + self.reset - time.monotonic())
+
+    def check(self, host):
+        """ Raises CircuitOpenError if the circuit is open, or else lets a request through.
+            Once the reset time has passed, only one trial request goes through until it succeeds or fails.
+        """
+        with self.lock:
+            if self.opened is None:
+                return
+
+            now = time.monotonic()
+            if now < self.opened + self.reset:
+                raise CircuitOpenError(f'circuit open for {host}, retry in {self.opened + self.reset - now:.0f}s')
+
+            # half open: hold the circuit for another period unless this trial request succeeds
+            self.opened = now
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened = time.monotonic()
+
+
+# limiters are shared by every session of a process, so the per-host limit holds across accounts
+_limiters = {}
+
+
+def _limiter(key, factory):
+    pid_limiters = _limiters.setdefault(os.getpid(), {})
+    if key not in pid_limiters:
+        pid_limiters[key] = factory()
+
+    return pid_limiters[key]
+
+
+def host_of(url):
+    return urlsplit(url).hostname or ''
+
+
+def host_bucket(host):
+    rate = HOST_RATES.get(host, DEFAULT_RATE)
+    return _limiter(('host', host), lambda: TokenBucket(rate))
+
+
+def account_bucket(host, account):
+    return _limiter(('account', host, account), lambda: TokenBucket(ACCOUNT_RATE))
+
+
+def breaker(host):
+    return _limiter(('breaker', host), CircuitBreaker)
+
+
+def backoff_delay(attempt):
+    """ Full jitter exponential backoff: a random delay up to BACKOFF_BASE * 2**attempt, capped at BACKOFF_MAX
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(headers, attempt):
+    """ Returns the server's Retry-After delay in seconds if it sent one, or else a backoff_delay()
+    """
+    value = headers.get('Retry-After', '') if headers else ''
+    if value.isdigit():
+        return min(BACKOFF_MAX, float(value))
+
+    return backoff_delay(attempt)
+
+
+def _buckets(host, account):
+    buckets = [host_bucket(host)]
+    if account:
+        buckets.append(account_bucket(host, account))
+
+    return buckets
+
+
+def _wait(host, account):
+    """ Returns the seconds to wait before the next request to host: its circuit must let it through,
+        then both its host's and its account's buckets must have a token
+    """
+    breaker(host).check(host)
+    return max(bucket.reserve() for bucket in _buckets(host, account))
+
+
+def _record(host, account, status):
+    """ Updates the host's circuit and the buckets with a response status, None for a connection error or timeout.
+        Returns True if the request should be retried.
+    """
+    if status is None or status >= 500:
+        breaker(host).failed()
+    else:
+        breaker(host).succeeded()
+
+    for bucket in _buckets(host, account):
+        if status in THROTTLE_STATUSES:
+            bucket.throttled()
+        elif status is not None and status < 400:
+            bucket.succeeded()
+
+    return status is None or status in RETRY_STATUSES
+
+
+def record_failure(url):
+    """ Records a failure against url's host that happened outside this layer, e.g. its page failing to render in a browser
+    """
+    breaker(host_of(url)).failed()
+
+
+def wait_for_host(url, attempt=0):
+    """ Sleeps until it makes sense to try url's host again after a failed request: until its circuit lets requests
+        through, and at least a backoff_delay(attempt)
+    """
+    time.sleep(max(breaker(host_of(url)).wait_time(), backoff_delay(attempt)))
+
+
+class Session(requests.Session):
+    """ requests.Session sending every request through the rate limiters, retries and circuit breaker of its host,
+        and of its account if it has one. Connections are kept alive in a pool of POOL_SIZE per host.
+        Raises the last error, or returns the last response, once MAX_RETRIES retries have failed.
+    """
+
+    def __init__(self, account=None):
+        super().__init__()
+        self.account = account
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', TIMEOUT)
+        host = host_of(url)
+        for attempt in range(MAX_RETRIES + 1):
+            delay = _wait(host, self.account)
+            if delay:
+                time.sleep(delay)
+
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not _record(host, self.account, None) or attempt == MAX_RETRIES:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if not _record(host, self.account, resp.status_code) or attempt == MAX_RETRIES:
+                return resp
+            time.sleep(retry_after(resp.headers, attempt))
+
+
+async def request(http, method, url, account=None, **kwargs):
+    """ Sends an aiohttp request through the same rate limiters, retries and circuit breaker as Session.
+        Returns (status, body bytes), or raises the last error once MAX_RETRIES retries have failed.
+    """
+    import aiohttp
+
+    host = host_of(url)
+    for attempt in range(MAX_RETRIES + 1):
+        delay = _wait(host, account)
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            async with http.request(method, url, timeout=aiohttp.ClientTimeout(total=TIMEOUT), **kwargs) as resp:
+                status, headers, content = resp.status, resp.headers, await resp.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if not _record(host, account, None) or attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+
+        if not _record(host, account, status) or attempt == MAX_RETRIES:
+            return status, content
+        await asyncio.sleep(retry_after(headers, attempt))
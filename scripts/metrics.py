@@ -0,0 +1,136 @@
+import argparse
+import glob
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from db.metrics import BUCKETS, METRICS_DIR, load, prune
+
+# Reads the metrics every process records through db/metrics.py: merges their files into a per-stage summary,
+# or serves them to a Prometheus scraper.
+SERVE_PORT = 9108
+
+
+def merge(snapshots):
+    """ Returns (histograms, counters, gauges, elapsed) over every process: histograms and counters are summed,
+        gauges (e.g. queue depths) too but only over the processes still running, and elapsed is the seconds
+        between the earliest start and the latest update
+    """
+    histograms, counters, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        for stage, histogram in snapshot['histograms'].items():
+            total = histograms.setdefault(stage, {'buckets': [0] * (len(BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+            total['max'] = max(total['max'], histogram['max'])
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snapshot['gauges'].items() if snapshot['alive'] else ():
+            gauges[name] = gauges.get(name, 0) + value
+
+    elapsed = max((s['updated'] for s in snapshots), default=0) - min((s['started'] for s in snapshots), default=0)
+    return histograms, counters, gauges, elapsed
+
+
+def quantile(histogram, q):
+    """ Returns the upper bound of the bucket holding the q quantile of a histogram
+    """
+    rank = q * histogram['count']
+    seen = 0
+    for bound, n in zip(BUCKETS + [histogram['max']], histogram['buckets']):
+        seen += n
+        if seen >= rank:
+            return min(bound, histogram['max'])
+
+    return histogram['max']
+
+
+def summary(snapshots):
+    """ Returns the merged metrics as text lines, stages sorted by total time spent so the bottleneck comes first
+    """
+    histograms, counters, gauges, elapsed = merge(snapshots)
+    hours = elapsed / 3600 if elapsed > 0 else None
+
+    alive = sum(1 for snapshot in snapshots if snapshot['alive'])
+    lines = [f'{len(snapshots)} processes ({alive} running) over {elapsed:.0f}s',
+             f'{"stage":24} {"count":>9} {"total s":>10} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}']
+    for stage, h in sorted(histograms.items(), key=lambda item: -item[1]['sum']):
+        lines.append(f'{stage:24} {h["count"]:9} {h["sum"]:10.1f} {1000 * h["sum"] / h["count"]:9.1f} '
+                     f'{1000 * quantile(h, 0.5):9.1f} {1000 * quantile(h, 0.95):9.1f} {1000 * h["max"]:9.1f}')
+    for name, value in sorted(counters.items()):
+        rate = f' ({value / hours:.0f}/hour)' if hours else ''
+        lines.append(f'{name}: {value}{rate}')
+    for name, value in sorted(gauges.items()):
+        lines.append(f'{name}: {value} (gauge)')
+
+    return lines
+
+
+def prometheus(snapshots):
+    """ Returns the merged metrics in the Prometheus text exposition format
+    """
+    histograms, counters, gauges, _ = merge(snapshots)
+    lines = []
+    for stage, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ['+Inf'], h['buckets']):
+            cumulative += n
+            lines.append(f'hivemind_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'hivemind_stage_seconds_sum{{stage="{stage}"}} {h["sum"]}')
+        lines.append(f'hivemind_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+    lines += [f'hivemind_{name}_total {value}' for name, value in sorted(counters.items())]
+    lines += [f'hivemind_{name} {value}' for name, value in sorted(gauges.items())]
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves /metrics in the Prometheus text format and /metrics.json as the merged snapshot of every process
+    """
+    directory = METRICS_DIR
+    since = None
+
+    def do_GET(self):
+        snapshots = load(self.directory, self.since)
+        if self.path == '/metrics':
+            body, content_type = prometheus(snapshots).encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            histograms, counters, gauges, elapsed = merge(snapshots)
+            body = json.dumps({'elapsed': elapsed, 'histograms': histograms, 'counters': counters, 'gauges': gauges}).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# python -m scripts.metrics [show | serve --port 9108 | prune | clear] [--since HOURS]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['show', 'serve', 'prune', 'clear'], default='show')
+    parser.add_argument('--dir', default=METRICS_DIR, help='directory the processes write their metrics to')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help='port serving /metrics and /metrics.json')
+    parser.add_argument('--since', type=float, metavar='HOURS', help='only the processes that updated their metrics in the last HOURS')
+    args = parser.parse_args()
+    since = args.since * 3600 if args.since else None
+
+    if args.command == 'show':
+        print('\n'.join(summary(load(args.dir, since))))
+    elif args.command == 'serve':
+        MetricsHandler.directory, MetricsHandler.since = args.dir, since
+        print(f'Serving the metrics in {args.dir}/ on http://localhost:{args.port}/metrics')
+        ThreadingHTTPServer(('', args.port), MetricsHandler).serve_forever()
+    elif args.command == 'prune':
+        print(f'Deleted the metrics of {prune(args.dir)} finished processes')
+    else:
+        for path in glob.glob(os.path.join(args.dir, '*.json')):
+            os.remove(path)
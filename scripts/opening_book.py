@@ -0,0 +1,263 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from db import hive_db
+from db import move_codec
+from scripts import hive_engine
+from scripts.generate_game_strings import build_game_string, exported_table_ids, get_game_type_string, table_ids_path
+
+# Opening book: a trie of the first BOOK_DEPTH moves of every finished game, with the results of the games
+# through each node. Moves are replayed so every node's MoveString is written the same way whichever reference
+# piece the source used, then stored as their db/move_codec.py code.
+#
+# On disk the trie is a set of little endian arrays in breadth first order. The children of node i are the nodes
+# child_offsets[i] to child_offsets[i + 1] - 1, sorted by move code, so a lookup is a binary search per move.
+BOOK_DIR = 'index'
+BOOK_DEPTH = 20
+MAGIC = b'HVOB'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ')  # magic, version, depth, nodes, games
+RESULTS = {hive_engine.WHITE_WINS: 0, hive_engine.BLACK_WINS: 1, hive_engine.DRAW: 2}
+
+
+class Node:
+    __slots__ = ('move', 'results', 'children')
+
+    def __init__(self, move=0):
+        self.move = move
+        self.results = [0, 0, 0]  # white wins, black wins, draws
+        self.children = {}
+
+
+def canonical_moves(game_string, depth=BOOK_DEPTH):
+    """ Returns the move codes of a GameString's first depth moves, each rewritten by the rules engine,
+        and its GameStateString. Raises ValueError if they are illegal.
+    """
+    game_type, state, _, moves = game_string.split(';', 3)
+    game = hive_engine.GameState(hive_engine.parse_game_type(game_type))
+
+    codes = []
+    for move in (moves.split(';') if moves else [])[:depth]:
+        if move != move_codec.PASS_MOVE:
+            move = game.move_string(*game.resolve(move))
+        game.play(move)
+        codes.append(move_codec.encode_move(move))
+
+    return codes, state
+
+
+def add_game(root, codes, state):
+    node = root
+    node.results[RESULTS[state]] += 1
+    for code in codes:
+        node = node.children.setdefault(code, Node(code))
+        node.results[RESULTS[state]] += 1
+
+
+def write_book(path, root, depth, games):
+    """ Flattens the trie breadth first into arrays and writes them to path
+    """
+    moves, white, black, draws, child_offsets = array('H'), array('I'), array('I'), array('I'), array('I', [1])
+    queue = [root]
+    for node in queue:
+        moves.append(node.move)
+        white.append(node.results[0])
+        black.append(node.results[1])
+        draws.append(node.results[2])
+        children = [node.children[code] for code in sorted(node.children)]
+        child_offsets.append(child_offsets[-1] + len(children))
+        queue += children
+
+    if sys.byteorder != 'little':
+        for values in (moves, white, black, draws, child_offsets):
+            values.byteswap()
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, depth, len(queue), games))
+        for values in (child_offsets, white, black, draws, moves):
+            f.write(values.tobytes())
+    os.replace(tmp_path, path)
+
+
+class OpeningBook:
+    """ Read-only, memory-mapped view of a book written by write_book()
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError('opening books are little endian')
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.depth, self.nodes, self.games = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} opening book')
+
+        view = memoryview(self.map)
+        start = HEADER.size
+        for name, fmt, count in [('child_offsets', 'I', self.nodes + 1), ('white', 'I', self.nodes),
+                                 ('black', 'I', self.nodes), ('draws', 'I', self.nodes), ('moves', 'H', self.nodes)]:
+            end = start + count * struct.calcsize(fmt)
+            setattr(self, name, view[start:end].cast(fmt))
+            start = end
+
+    def close(self):
+        for name in ('child_offsets', 'white', 'black', 'draws', 'moves'):
+            getattr(self, name).release()
+        self.map.close()
+
+    def child(self, node, code):
+        """ Returns the child of node reached by the move code, or None
+        """
+        lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.moves[mid] < code:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.child_offsets[node + 1] and self.moves[lo] == code:
+            return lo
+
+    def find(self, codes):
+        """ Returns the node reached by a sequence of move codes from the root, or None
+        """
+        node = 0
+        for code in codes:
+            node = self.child(node, code)
+            if node is None:
+                return
+
+        return node
+
+    def results(self, node):
+        return self.white[node], self.black[node], self.draws[node]
+
+    def continuations(self, node):
+        """ Returns (MoveString, white wins, black wins, draws) for every move played from node, most played first
+        """
+        children = range(self.child_offsets[node], self.child_offsets[node + 1])
+        return sorted(((move_codec.decode_move(self.moves[child]), *self.results(child)) for child in children),
+                      key=lambda continuation: -sum(continuation[1:]))
+
+    def lookup(self, game_type, moves):
+        """ Returns the node of a ';' separated MoveStrings prefix, written any way the rules engine accepts, or None
+        """
+        codes, _ = canonical_moves(f'{game_type};InProgress;;{moves}', self.depth)
+        return self.find(codes)
+
+
+def book_path(name):
+    return os.path.join(BOOK_DIR, f'book_{name}.bin')
+
+
+def read_trie(book):
+    """ Rebuilds the mutable trie of a book, to add new games to it
+    """
+    nodes = [Node(book.moves[i]) for i in range(book.nodes)]
+    for i, node in enumerate(nodes):
+        node.results = list(book.results(i))
+        node.children = {nodes[child].move: nodes[child] for child in range(book.child_offsets[i], book.child_offsets[i + 1])}
+
+    return nodes[0]
+
+
+def update_book(filters, name, depth=BOOK_DEPTH, rebuild=False):
+    """ Adds every finished game of the filtered tables written since the book's watermark, or all of them
+        with rebuild, and rewrites the book along with the .tables file listing its tables. Returns its path.
+        The book is rebuilt if any of its tables was written again since, as their old games can't be taken out.
+    """
+    path = book_path(name)
+    watermark = f'book:{name}'
+    # tables written during the update are left to the next one
+    last_seq = hive_db.get_last_seq()
+    row = None if rebuild else hive_db.get_export_watermark(watermark)
+    if row and os.path.exists(row[2]) and os.path.exists(table_ids_path(path)):
+        table_ids = exported_table_ids(path)
+        rewritten = table_ids.intersection(hive_db.get_written_table_ids((row[1], last_seq)))
+        if rewritten:
+            print(f'{len(rewritten)} tables of {path} were written again, rebuilding it')
+            row = None
+    else:
+        row = None
+
+    if row:
+        _, first_seq, _, games, _ = row
+        book = OpeningBook(path)
+        if book.depth != depth:
+            raise ValueError(f'{path} is {book.depth} moves deep, rebuild it to change the depth')
+        root = read_trie(book)
+        book.close()
+    else:
+        first_seq, games, root, table_ids = 0, 0, Node(), set()
+
+    added, skipped = 0, 0
+    for table, moves in hive_db.iter_table_moves(**filters, seq_range=(first_seq, last_seq)):
+        game_string = build_game_string(table, moves)
+        if not game_string:
+            continue
+
+        try:
+            codes, state = canonical_moves(game_string, depth)
+        except ValueError as e:
+            print(f'Skipping illegal game for table {table[0]}: {e}', file=sys.stderr)
+            skipped += 1
+            continue
+
+        if state in RESULTS:
+            add_game(root, codes, state)
+            table_ids.add(table[0])
+            added += 1
+
+    write_book(path, root, depth, games + added)
+    with open(table_ids_path(path), 'w') as f:
+        f.writelines(f'{table_id}\n' for table_id in sorted(table_ids))
+    hive_db.set_export_watermark(watermark, last_seq, path, games + added)
+    print(f'Added {added} games to {path} ({skipped} illegal), {games + added} games in the book')
+
+    return path
+
+
+# python -m scripts.opening_book update [--rebuild] | query "wG1;bG1 wG1-"
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'query'])
+    parser.add_argument('moves', nargs='?', default='', help="';' separated MoveStrings to look up")
+    parser.add_argument('--expansions', default='MLP', help='expansion bugs of the games in the book, e.g. MLP, or "" for the base game')
+    parser.add_argument('--bots', action='store_true', help='include games played against bots')
+    parser.add_argument('--source', choices=['bga', 'bs', 'all'], default='bga', help='BoardGameArena tables, every other table, or both')
+    parser.add_argument('--depth', type=int, default=BOOK_DEPTH, help='moves of every game kept in the book')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the book from every table instead of adding new ones')
+    args = parser.parse_args()
+
+    m, l, p = ('M' in args.expansions), ('L' in args.expansions), ('P' in args.expansions)
+    game_type = get_game_type_string(m, l, p)
+    name = f'{game_type}{"+Bots" if args.bots else "+NoBots"}+{args.source}'
+
+    if args.command == 'update':
+        filters = {'include_bots': args.bots, 'uses_m': m, 'uses_l': l, 'uses_p': p,
+                   'include_bga': args.source != 'bs', 'include_bs': args.source != 'bga'}
+        update_book(filters, name, args.depth, args.rebuild)
+    else:
+        book = OpeningBook(book_path(name))
+        start = time.perf_counter()
+        node = book.lookup(game_type, args.moves)
+        elapsed = time.perf_counter() - start
+        if node is None:
+            print(f'{args.moves!r} is not in the book ({elapsed * 1000:.3f}ms)')
+            sys.exit(1)
+
+        white, black, draws = book.results(node)
+        print(f'{white + black + draws} games: {white} white wins, {black} black wins, {draws} draws ({elapsed * 1000:.3f}ms)')
+        for move, white, black, draws in book.continuations(node):
+            total = white + black + draws
+            print(f'  {move}: {total} games, white {white / total:.0%}, black {black / total:.0%}, draw {draws / total:.0%}')
@@ -0,0 +1,24 @@
+from db import hive_db
+from scripts.generate_game_strings import get_game_type_string
+
+import argparse
+import time
+
+
+# rebuilds the player_stats table from every stored table (needed once on databases from before schema version 7),
+# or prints a player's results by color and expansions
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild', 'show'])
+    parser.add_argument('player_id', nargs='?', help='BGA player id, or BoardSpace player name, to show')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        start = time.time()
+        rows = hive_db.rebuild_player_stats()
+        print(f'REBUILD COMPLETED in {time.time() - start:.1f}s, {rows} player_stats rows')
+    else:
+        player_id = int(args.player_id) if args.player_id.isdigit() else args.player_id
+        for color, m, l, p, games, wins, losses, draws, average_moves in hive_db.get_player_stats(player_id) or []:
+            print(f'{color:5} {get_game_type_string(m, l, p):10} {games} games: {wins / games:.0%} wins, '
+                  f'{losses / games:.0%} losses, {draws / games:.0%} draws, {average_moves:.1f} moves on average')
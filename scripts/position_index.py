@@ -0,0 +1,339 @@
+import argparse
+import glob
+import hashlib
+import multiprocessing
+import os
+import struct
+import time
+from itertools import product
+
+import numpy as np
+
+from db.move_codec import COLORS
+from scripts import hive_engine
+
+# Zobrist hashes of every position in the corpus, identical for positions that only differ by a translation,
+# one of the 12 rotations and reflections of the hex grid, or by swapping the colours (and the side to move).
+#
+# A position's key XORs one ZOBRIST value per piece, picked by its colour and bug type, its level in the stack and its
+# cell once the hive is moved into the corner of a BOARD_SIZE x BOARD_SIZE grid, plus keys for the side to move and
+# the game type. Every symmetry needs its own translation, so hashes are computed for a whole game's positions at once
+# in numpy rather than updated move by move. The canonical key is the smallest of the 24 variants.
+INDEX_PATH = 'index/positions.idx'
+INDEX_CHUNK_SIZE = 500  # games hashed by an index worker at once
+BOARD_SIZE = 32         # every axial coordinate of a 28 piece hive spans at most 27 cells
+LEVELS = 8              # beetles and a mosquito stack at most 6 high
+KIND_BUGS = 'QSBGAMLP'
+KINDS = len(COLORS) * len(KIND_BUGS)
+COLOR_SWAP = len(KIND_BUGS)  # xor with a kind to swap its colour
+
+
+def _symmetries():
+    """ Returns the (a, b, c, d) of every (q, r) -> (a * q + b * r, c * q + d * r) symmetry of the hex grid:
+        the 6 rotations, then the same after the q <-> r reflection
+    """
+    rotations = [(1, 0, 0, 1)]
+    for _ in range(5):
+        a, b, c, d = rotations[-1]
+        rotations.append((-c, -d, a + c, b + d))  # rotate by 60 degrees: (q, r) -> (-r, q + r)
+
+    return rotations + [(b, a, d, c) for a, b, c, d in rotations]
+
+
+def _keys(count, salt):
+    """ Returns count 64 bit keys derived from blake2b, so every build of the index agrees on them
+    """
+    digests = b''.join(hashlib.blake2b(struct.pack('<I', i), digest_size=8, salt=salt).digest() for i in range(count))
+    return np.frombuffer(digests, dtype='<u8').astype(np.uint64)
+
+
+SYMMETRIES = np.array(_symmetries(), dtype=np.int64)
+ZOBRIST = _keys(KINDS * LEVELS * BOARD_SIZE * BOARD_SIZE, b'pieces')
+BLACK_TO_MOVE, *EXPANSION_KEYS = _keys(1 + len(hive_engine.EXPANSION_BUGS), b'state')
+
+# hash table slots: key 0 marks an empty slot
+ENTRY = np.dtype([('key', '<u8'), ('count', '<u4'), ('white_wins', '<u4'), ('black_wins', '<u4'), ('draws', '<u4'),
+                  ('first_game', '<u8')])
+MAGIC = b'HVPI'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQQ')  # magic, version, reserved, slots, entries, positions
+
+
+def kind(piece):
+    return COLORS.index(piece[0]) * len(KIND_BUGS) + KIND_BUGS.index(piece[1])
+
+
+def replay_stones(game_string):
+    """ Replays a GameString and returns its positions before every move as numpy arrays:
+        (position, kind, level, q, r) for every piece of every position, the side to move per position,
+        and the game's GameTypeString and GameStateString.
+    """
+    game_type, state, _, moves = game_string.rstrip('\n').split(';', 3)
+    game = hive_engine.GameState(hive_engine.parse_game_type(game_type))
+
+    stones, to_move = [], []
+    for position, move in enumerate(moves.split(';') if moves else []):
+        for cell, stack in game.stacks.items():
+            q, r = hive_engine.axial(cell)
+            stones += [(position, kind(piece), level, q, r) for level, piece in enumerate(stack)]
+
+        to_move.append(game.turn % 2)
+        game.play(move)
+
+    return np.array(stones, dtype=np.int64).reshape(-1, 5).T, np.array(to_move, dtype=np.int64), game_type, state
+
+
+def hash_positions(stones, to_move, game_type):
+    """ Returns the canonical key of every position, and whether that key was reached by swapping the colours
+    """
+    positions = len(to_move)
+    if not positions:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    position, kinds, level, q, r = stones
+    symmetries = len(SYMMETRIES)
+
+    # (symmetries, stones) coordinates, each symmetry's hive moved into the corner of the grid
+    a, b, c, d = (SYMMETRIES[:, i:i + 1] for i in range(4))
+    sym_q, sym_r = a * q + b * r, c * q + d * r
+    rows = np.arange(symmetries)[:, None] * positions + position
+    lo_q = np.full(symmetries * positions, np.iinfo(np.int64).max)
+    lo_r = np.full(symmetries * positions, np.iinfo(np.int64).max)
+    np.minimum.at(lo_q, rows.ravel(), sym_q.ravel())
+    np.minimum.at(lo_r, rows.ravel(), sym_r.ravel())
+    cells = (sym_q - lo_q[rows]) * BOARD_SIZE + (sym_r - lo_r[rows])
+
+    state = np.bitwise_xor.reduce(np.array([EXPANSION_KEYS[hive_engine.EXPANSION_BUGS.index(bug)]
+                                            for bug in hive_engine.parse_game_type(game_type)] or [np.uint64(0)], dtype=np.uint64))
+
+    # the second half of the variants swaps every piece's colour and the side to move
+    hashes = np.zeros((2, symmetries * positions), dtype=np.uint64)
+    for swap in (0, 1):
+        zobrist = ZOBRIST[((kinds ^ (COLOR_SWAP * swap)) * LEVELS + level) * BOARD_SIZE * BOARD_SIZE + cells]
+        np.bitwise_xor.at(hashes[swap], rows.ravel(), zobrist.ravel())
+        hashes[swap] ^= np.tile(np.where(to_move ^ swap, BLACK_TO_MOVE, np.uint64(0)), symmetries) ^ state
+
+    variants = hashes.reshape(2 * symmetries, positions)
+    best = variants.argmin(axis=0)
+    keys = variants[best, np.arange(positions)]
+
+    # 0 marks an empty slot in the on-disk table
+    return np.where(keys == 0, np.uint64(1), keys), best >= symmetries
+
+
+def hash_game_string(game_string):
+    """ Returns (canonical keys, colour swapped, GameStateString) for every position of a GameString
+    """
+    stones, to_move, game_type, state = replay_stones(game_string)
+
+    return (*hash_positions(stones, to_move, game_type), state)
+
+
+def game_key(keys):
+    """ Returns one key for a game's whole sequence of positions, equal for games that are the same up to symmetry
+    """
+    return int.from_bytes(hashlib.blake2b(keys.astype('<u8').tobytes(), digest_size=8).digest(), 'little')
+
+
+def game_key_of(game_string):
+    """ game_key() of a GameString, or None if it can't be replayed
+    """
+    try:
+        return game_key(hash_game_string(game_string)[0])
+    except ValueError:
+        return
+
+
+def hash_chunk(task):
+    """ Worker entry point: hashes a chunk of (game id, GameString) pairs.
+        Returns the keys, white win, black win and draw flags (from the canonical colours' point of view) and game ids
+        of every position.
+    """
+    keys, white, black, draws, games = [], [], [], [], []
+    for game_id, game_string in task:
+        try:
+            game_keys, swapped, state = hash_game_string(game_string)
+        except ValueError as e:
+            print(f'Skipping game {game_id}: {e}')
+            continue
+
+        keys.append(game_keys)
+        white_wins = np.full(len(game_keys), state == hive_engine.WHITE_WINS)
+        black_wins = np.full(len(game_keys), state == hive_engine.BLACK_WINS)
+        white.append(np.where(swapped, black_wins, white_wins))
+        black.append(np.where(swapped, white_wins, black_wins))
+        draws.append(np.full(len(game_keys), state == hive_engine.DRAW))
+        games.append(np.full(len(game_keys), game_id, dtype=np.uint64))
+
+    if not keys:
+        return [np.zeros(0, dtype=dtype) for dtype in (np.uint64, bool, bool, bool, np.uint64)]
+
+    return [np.concatenate(arrays) for arrays in (keys, white, black, draws, games)]
+
+
+def iter_file_games(paths):
+    """ Yields (line index, GameString) for every game in the given exports, numbered across the files in order
+    """
+    game_id = 0
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield game_id, line
+                    game_id += 1
+
+
+def iter_db_games():
+    """ Yields (table_id, GameString) for every finished game in the DB
+    """
+    # importing hive_db opens the DB, only load it when indexing from it
+    from db import hive_db
+    from scripts.generate_game_strings import build_game_string
+
+    for m, l, p in product([True, False], repeat=3):
+        for table, moves in hive_db.iter_table_moves(include_bots=True, uses_m=m, uses_l=l, uses_p=p):
+            game_string = build_game_string(table, moves)
+            if game_string:
+                yield table[0], game_string
+
+
+def iter_chunks(games, size=INDEX_CHUNK_SIZE):
+    chunk = []
+    for game in games:
+        chunk.append(game)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_table(path, keys, white, black, draws, games):
+    """ Aggregates every position's key and result into an open addressing hash table with linear probing, at most
+        half full, and writes it to path
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    entries = np.zeros(len(unique), dtype=ENTRY)
+    entries['key'] = unique
+    entries['count'] = np.bincount(inverse, minlength=len(unique))
+    entries['white_wins'] = np.bincount(inverse, weights=white, minlength=len(unique))
+    entries['black_wins'] = np.bincount(inverse, weights=black, minlength=len(unique))
+    entries['draws'] = np.bincount(inverse, weights=draws, minlength=len(unique))
+    entries['first_game'] = np.iinfo(np.uint64).max
+    np.minimum.at(entries['first_game'], inverse, games)
+
+    slots = 1 << max(10, (2 * len(unique) - 1).bit_length())
+    table = np.zeros(slots, dtype=ENTRY)
+
+    # insert every entry at once, probing the ones that collided one slot further each round
+    pending = np.arange(len(unique))
+    probe = (unique & np.uint64(slots - 1)).astype(np.int64)
+    while len(pending):
+        free = table['key'][probe] == 0
+        slot, first = np.unique(probe[free], return_index=True)
+        placed = pending[free][first]
+        table[slot] = entries[placed]
+
+        left = np.ones(len(pending), dtype=bool)
+        left[np.flatnonzero(free)[first]] = False
+        pending, probe = pending[left], (probe[left] + 1) & (slots - 1)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, slots, len(unique), len(keys)))
+        table.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def build(games, path=INDEX_PATH, workers=1):
+    """ Hashes every (game id, GameString) in a pool of worker processes and writes the index to path
+    """
+    start = time.time()
+    parts = []
+    with multiprocessing.Pool(workers) as pool:
+        for part in pool.imap(hash_chunk, iter_chunks(games)):
+            parts.append(part)
+
+    keys, white, black, draws, game_ids = (np.concatenate([part[i] for part in parts]) if parts else np.zeros(0)
+                                           for i in range(5))
+    write_table(path, keys.astype(np.uint64), white, black, draws, game_ids.astype(np.uint64))
+
+    index = PositionIndex(path)
+    print(f'Indexed {index.positions} positions of {len(np.unique(game_ids))} games into {index.entries} distinct '
+          f'positions ({1 - index.entries / max(index.positions, 1):.1%} duplicates) in {time.time() - start:.1f}s')
+    return index
+
+
+class PositionIndex:
+    """ Read-only view of an index built by build(), memory-mapped so lookups only touch the slots they probe
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, _, self.slots, self.entries, self.positions = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} position index')
+
+        self.table = np.memmap(path, dtype=ENTRY, mode='r', offset=HEADER.size, shape=(self.slots,))
+
+    def lookup(self, key):
+        """ Returns the entry of a canonical key, or None if the position never occurred
+        """
+        slot = int(key) & (self.slots - 1)
+        while True:
+            entry = self.table[slot]
+            if entry['key'] == key:
+                return entry
+            if entry['key'] == 0:
+                return
+            slot = (slot + 1) & (self.slots - 1)
+
+    def occurrences(self, game_string):
+        """ Returns (count, white wins, black wins, draws) for every position of a GameString, with the results seen
+            from its own colours
+        """
+        keys, swapped, _ = hash_game_string(game_string)
+        stats = []
+        for key, swap in zip(keys, swapped):
+            entry = self.lookup(key)
+            if entry is None:
+                stats.append((0, 0, 0, 0))
+            elif swap:
+                stats.append((int(entry['count']), int(entry['black_wins']), int(entry['white_wins']), int(entry['draws'])))
+            else:
+                stats.append((int(entry['count']), int(entry['white_wins']), int(entry['black_wins']), int(entry['draws'])))
+
+        return stats
+
+    def most_common(self, n=10):
+        used = self.table[self.table['key'] != 0]
+        return used[np.argsort(used['count'])[::-1][:n]]
+
+
+# python -m scripts.position_index build [game_strings files] | build --db | query GameString | stats
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build', 'query', 'stats'])
+    parser.add_argument('args', nargs='*', help='GameString files to index (every export by default), or the GameString to query')
+    parser.add_argument('--db', action='store_true', help='index every finished game in the actions table instead of exports')
+    parser.add_argument('--index', default=INDEX_PATH, help='index file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='hashing processes')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(iter_db_games() if args.db else iter_file_games(args.args or sorted(glob.glob('game_strings/*.txt'))),
+              args.index, args.workers)
+    elif args.command == 'query':
+        index = PositionIndex(args.index)
+        for game_string in args.args:
+            moves = game_string.split(';', 3)[3].split(';')
+            for move, (count, white, black, draws) in zip(moves, index.occurrences(game_string)):
+                print(f'before {move}: seen {count} times, {white} white wins, {black} black wins, {draws} draws')
+    else:
+        index = PositionIndex(args.index)
+        print(f'{index.positions} positions, {index.entries} distinct, {index.slots} slots. Most common, results in their canonical colours:')
+        for entry in index.most_common():
+            print(f'  {entry["key"]:016x}: {entry["count"]} times, {entry["white_wins"]} white wins, '
+                  f'{entry["black_wins"]} black wins, {entry["draws"]} draws, first in game {entry["first_game"]}')
@@ -0,0 +1,248 @@
+import argparse
+import fcntl
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from contextlib import closing
+
+import db.hive_db as hive_db
+
+ARCHIVE_DIR = 'archive'
+SEGMENT_BYTES = 256 * 2**20  # a new segment file is started once the current one reaches this size
+REPARSE_CHUNK_SIZE = 500     # archived tables handed to a reparse worker at once
+
+# raw responses kept per table, a BGA table needs both its tableinfos and logs responses to be parsed
+KIND_BGA_TABLE = 1
+KIND_BGA_REPLAY = 2
+KIND_ENTOMOLOGY = 3
+
+# every record in a segment is framed as (kind, table_id, compressed size) followed by the zlib compressed body,
+# so the index can always be rebuilt by scanning the segments
+FRAME_HEADER = struct.Struct('<BqI')
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records(
+    table_id INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    archived INTEGER NOT NULL,
+    PRIMARY KEY(table_id, kind)
+);
+'''
+
+
+class ReplayArchive:
+    """ Append-only store of every raw replay response, so parsing can be re-run without re-scraping.
+        Records are appended to numbered segment files, and an sqlite index maps (table_id, kind) to the latest copy.
+    """
+
+    def __init__(self, path=ARCHIVE_DIR):
+        self.path = path
+        self.segment = 0
+        self.files = {}
+        os.makedirs(path, exist_ok=True)
+
+        self.con = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.executescript(INDEX_SCHEMA)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'segment-{segment:05d}.bin')
+
+    def has(self, table_id, kind):
+        with closing(self.con.cursor()) as cur:
+            cur.execute('SELECT 1 FROM records WHERE table_id = ? AND kind = ?', [table_id, kind])
+            return cur.fetchone() is not None
+
+    def put(self, table_id, kind, content):
+        """ Appends a raw response body, replacing any earlier copy in the index
+        """
+        body = zlib.compress(content)
+
+        # the crawlers append from several processes at once, so only one writes to the segments at a time
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            while os.path.exists(self._segment_path(self.segment + 1)):
+                self.segment += 1
+            if os.path.exists(self._segment_path(self.segment)) and os.path.getsize(self._segment_path(self.segment)) >= SEGMENT_BYTES:
+                self.segment += 1
+
+            with open(self._segment_path(self.segment), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(FRAME_HEADER.pack(kind, table_id, len(body)) + body)
+
+        with self.con, closing(self.con.cursor()) as cur:
+            cur.execute('INSERT OR REPLACE INTO records(table_id, kind, segment, offset, size, archived) VALUES(?,?,?,?,?,?)',
+                        [table_id, kind, self.segment, offset + FRAME_HEADER.size, len(body), int(time.time())])
+
+    def put_new(self, table_id, kind, content):
+        """ put() unless this table's response is already archived, since finished replays never change
+        """
+        if not self.has(table_id, kind):
+            self.put(table_id, kind, content)
+
+    def _read(self, segment, offset, size):
+        if segment not in self.files:
+            self.files[segment] = open(self._segment_path(segment), 'rb')
+
+        return zlib.decompress(os.pread(self.files[segment].fileno(), size, offset))
+
+    def get(self, table_id, kind):
+        """ Returns the latest raw body archived for this table, or None
+        """
+        with closing(self.con.cursor()) as cur:
+            cur.execute('SELECT segment, offset, size FROM records WHERE table_id = ? AND kind = ?', [table_id, kind])
+            row = cur.fetchone()
+
+        return self._read(*row) if row else None
+
+    def get_table_ids(self, kind):
+        with closing(self.con.cursor()) as cur:
+            cur.execute('SELECT table_id FROM records WHERE kind = ? ORDER BY table_id', [kind])
+            return [row[0] for row in cur.fetchall()]
+
+    def rebuild_index(self):
+        """ Re-creates the index from the segment files, the last copy of every record wins
+        """
+        segments = sorted(int(name[8:13]) for name in os.listdir(self.path) if name.startswith('segment-'))
+        with self.con, closing(self.con.cursor()) as cur:
+            cur.execute('DELETE FROM records')
+            for segment in segments:
+                with open(self._segment_path(segment), 'rb') as f:
+                    while header := f.read(FRAME_HEADER.size):
+                        if len(header) < FRAME_HEADER.size:
+                            break
+                        kind, table_id, size = FRAME_HEADER.unpack(header)
+                        offset = f.tell()
+                        if len(f.read(size)) < size:
+                            print(f'Truncated record for table_id {table_id} in segment {segment}')
+                            break
+                        cur.execute('INSERT OR REPLACE INTO records(table_id, kind, segment, offset, size, archived) VALUES(?,?,?,?,?,?)',
+                                    [table_id, kind, segment, offset, size, int(os.path.getmtime(self._segment_path(segment)))])
+
+        return len(segments)
+
+
+# one archive handle per process, since the parallel crawlers fork after import
+_archives = {}
+
+
+def get_archive():
+    if os.getpid() not in _archives:
+        _archives[os.getpid()] = ReplayArchive()
+
+    return _archives[os.getpid()]
+
+
+def reparse_bga(archive, table_id):
+    """ Returns the table's row for hive_db from its archived tableinfos and logs responses, or None
+    """
+    # the scrapers import accounts.py and requests at module level, only load them where needed
+    from scripts import bga_scraping
+
+    table, replay = archive.get(table_id, KIND_BGA_TABLE), archive.get(table_id, KIND_BGA_REPLAY)
+    if table is None or replay is None:
+        return
+
+    expansions = bga_scraping.parse_table_info(json.loads(table), table_id)
+    if not isinstance(expansions, tuple):
+        return
+
+    result = bga_scraping.parse_replay(json.loads(replay), table_id, '', *expansions)
+    if isinstance(result, tuple):
+        return (table_id, *result)
+
+
+def reparse_entomology(archive, table_id, variant='lmp', ranked=True, tournament=False):
+    """ Returns the table's row for hive_db from its archived game json, or None
+    """
+    from scripts import entomology_scraping
+
+    j = json.loads(archive.get(table_id, KIND_ENTOMOLOGY))
+    if not j or not entomology_scraping.check_game(j, table_id, variant, ranked, tournament):
+        return
+
+    action_list = entomology_scraping.decode_moves(j)
+    if action_list is None:
+        print(f'Error decoding moves list for table_id: {table_id}')
+        return
+
+    return (table_id, *entomology_scraping.game_metadata(j, variant), action_list)
+
+
+def reparse_chunk(task):
+    """ Worker entry point: parses a (kind, table_ids) chunk of the archive into hive_db rows
+    """
+    kind, table_ids = task
+    archive = get_archive()
+    reparse = reparse_bga if kind == KIND_BGA_REPLAY else reparse_entomology
+
+    rows = []
+    for table_id in table_ids:
+        try:
+            row = reparse(archive, table_id)
+        except (ValueError, zlib.error) as e:
+            print(f'Exception raised reparsing table_id {table_id}: ', e)
+            continue
+
+        if row:
+            rows.append(row)
+
+    return rows
+
+
+def reparse(workers, sources):
+    """ Rebuilds the tables and actions rows of every archived table, parsing chunks in a pool of worker processes
+        while this process does every insert
+    """
+    archive = get_archive()
+    tasks = [(kind, table_ids[i:i + REPARSE_CHUNK_SIZE])
+             for kind in sources
+             for table_ids in [archive.get_table_ids(kind)]
+             for i in range(0, len(table_ids), REPARSE_CHUNK_SIZE)]
+
+    start = time.time()
+    parsed, written = 0, 0
+    db = hive_db.get_db()
+    with multiprocessing.Pool(workers) as pool:
+        for rows in pool.imap_unordered(reparse_chunk, tasks):
+            parsed += 1
+            if db.insert_many_table_data(rows, replace=True):
+                written += len(rows)
+            else:
+                written += sum(db.insert_many_table_data([row], replace=True) for row in rows)
+
+            if parsed % 20 == 0:
+                print(f'{parsed}/{len(tasks)} chunks reparsed, {written} tables written', flush=True)
+
+    print(f'REPARSE COMPLETED: wrote {written} tables in {time.time() - start:.1f}s')
+
+
+def print_stats(archive):
+    with closing(archive.con.cursor()) as cur:
+        cur.execute('SELECT kind, COUNT(*), SUM(size) FROM records GROUP BY kind')
+        for kind, count, size in cur.fetchall():
+            print(f'  kind {kind}: {count} records, {size / 2**20:.1f} MiB compressed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['reparse', 'reindex', 'stats'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parser processes used by reparse')
+    parser.add_argument('--source', choices=['bga', 'entomology', 'all'], default='all', help='which archived responses to reparse')
+    args = parser.parse_args()
+
+    if args.command == 'reparse':
+        sources = {'bga': [KIND_BGA_REPLAY], 'entomology': [KIND_ENTOMOLOGY]}.get(args.source, [KIND_BGA_REPLAY, KIND_ENTOMOLOGY])
+        reparse(args.workers, sources)
+    elif args.command == 'reindex':
+        print(f'Indexed {get_archive().rebuild_index()} segments')
+        print_stats(get_archive())
+    else:
+        print_stats(get_archive())
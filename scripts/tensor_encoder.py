@@ -0,0 +1,206 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from db.move_codec import COLORS, GAME_STATES, encode_move
+from scripts import hive_engine
+from scripts import position_index
+
+# Fixed shape training tensors for every position of an exported game_strings/ file.
+#
+# Each position is encoded before its move is played, as PLANES planes of BOARD_SIZE x BOARD_SIZE axial cells
+# (row r, column q) centred on the hive: one plane per colour and bug type marking the piece on top of each stack,
+# then one plane holding every stack's height. Colours are absolute, to_move says whose turn it is.
+TENSOR_DIR = 'tensors'
+MANIFEST = 'manifest.json'
+SHARD_GAMES = 128  # games per .npz shard, about 6,500 positions or 110MB of planes before compression
+BOARD_SIZE = 32    # a hive of all 28 pieces spans at most 28 cells along any axis
+PLANE_BUGS = 'QSBGAMLP'
+PLANE_NAMES = [color + bug for color in COLORS for bug in PLANE_BUGS] + ['height']
+PLANES = len(PLANE_NAMES)
+HEIGHT_PLANE = PLANES - 1
+
+# GameStateString -> value of the final result for (white, black)
+VALUES = {hive_engine.WHITE_WINS: (1, -1), hive_engine.BLACK_WINS: (-1, 1), hive_engine.DRAW: (0, 0)}
+
+
+def piece_plane(piece):
+    return COLORS.index(piece[0]) * len(PLANE_BUGS) + PLANE_BUGS.index(piece[1])
+
+
+def replay_game(game_string, stones, position):
+    """ Replays a GameString, appending a (position, plane, q, r, height) row to stones for every stack of every
+        position before a move. Returns the game's (to_move, ply, move code) per position and its GameStateString.
+    """
+    game_type, state, _, moves = game_string.rstrip('\n').split(';', 3)
+    game = hive_engine.GameState(hive_engine.parse_game_type(game_type))
+
+    rows = []
+    for ply, move in enumerate(moves.split(';') if moves else []):
+        for cell, stack in game.stacks.items():
+            q, r = hive_engine.axial(cell)
+            stones.append((position, piece_plane(stack[-1]), q, r, len(stack)))
+
+        rows.append((game.turn % 2, ply, encode_move(move)))
+        position += 1
+        game.play(move)
+
+    return rows, state
+
+
+def build_boards(stones, positions):
+    """ Scatters every (position, plane, q, r, height) row into a (positions, PLANES, BOARD_SIZE, BOARD_SIZE) array
+        in one pass, each position shifted so its hive sits in the middle of the window.
+        Returns the boards and a mask of the positions whose hive fits in the window.
+    """
+    boards = np.zeros((positions, PLANES, BOARD_SIZE, BOARD_SIZE), dtype=np.uint8)
+    fits = np.ones(positions, dtype=bool)
+    if not stones:
+        return boards, fits
+
+    position, plane, q, r, height = np.array(stones, dtype=np.int32).T
+
+    # bounding box of each position's hive
+    lo_q, lo_r = np.full(positions, BOARD_SIZE, dtype=np.int32), np.full(positions, BOARD_SIZE, dtype=np.int32)
+    hi_q, hi_r = np.full(positions, -BOARD_SIZE, dtype=np.int32), np.full(positions, -BOARD_SIZE, dtype=np.int32)
+    np.minimum.at(lo_q, position, q)
+    np.minimum.at(lo_r, position, r)
+    np.maximum.at(hi_q, position, q)
+    np.maximum.at(hi_r, position, r)
+
+    x = q - lo_q[position] + (BOARD_SIZE - (hi_q - lo_q + 1))[position] // 2
+    y = r - lo_r[position] + (BOARD_SIZE - (hi_r - lo_r + 1))[position] // 2
+    inside = (x >= 0) & (x < BOARD_SIZE) & (y >= 0) & (y < BOARD_SIZE)
+    fits[position[~inside]] = False
+
+    position, plane, x, y, height = position[inside], plane[inside], x[inside], y[inside], height[inside]
+    boards[position, plane, y, x] = 1
+    boards[position, HEIGHT_PLANE, y, x] = height
+
+    return boards, fits
+
+
+def encode_shard(task):
+    """ Worker entry point: encodes an (output directory, shard number, first game index, lines, dedupe index path)
+        chunk into an .npz shard. Returns the shard's manifest entry.
+    """
+    out_dir, shard, first_game, lines, dedupe = task
+    index = position_index.PositionIndex(dedupe) if dedupe else None
+    stones, rows, games, unique, skipped = [], [], [], [], 0
+    for game_index, line in enumerate(lines, start=first_game):
+        if not line.strip():
+            continue
+        try:
+            game_rows, state = replay_game(line, stones, len(rows))
+        except ValueError as e:
+            # undo the stones of the partly replayed game
+            while stones and stones[-1][0] >= len(rows):
+                stones.pop()
+            print(f'Skipping game {game_index}: {e}')
+            skipped += 1
+            continue
+
+        rows += game_rows
+        games += [(game_index, GAME_STATES.index(state), *VALUES.get(state, (0, 0)))] * len(game_rows)
+        if index:
+            # keep a position only where the index first saw it, once
+            seen = set()
+            for key in position_index.hash_game_string(line)[0].tolist():
+                entry = index.lookup(key)
+                unique.append(key not in seen and (entry is None or entry['first_game'] == game_index))
+                seen.add(key)
+
+    boards, fits = build_boards(stones, len(rows))
+    duplicates = 0
+    if index:
+        duplicates = int((fits & ~np.array(unique, dtype=bool)).sum())
+        fits &= np.array(unique, dtype=bool)
+    to_move, ply, move = np.array(rows, dtype=np.uint16).reshape(-1, 3).T
+    game, outcome, white_value, black_value = np.array(games, dtype=np.int32).reshape(-1, 4).T
+
+    file_name = f'shard-{shard:05d}.npz'
+    np.savez_compressed(os.path.join(out_dir, file_name),
+                        boards=boards[fits],
+                        to_move=to_move[fits].astype(np.uint8),
+                        ply=ply[fits],
+                        move=move[fits],
+                        game=game[fits].astype(np.uint32),
+                        outcome=outcome[fits].astype(np.uint8),
+                        value=np.where(to_move == 0, white_value, black_value)[fits].astype(np.int8))
+
+    return {'file': file_name, 'positions': int(fits.sum()), 'games': len(set(game.tolist())),
+            'first_game': first_game, 'skipped_games': skipped, 'duplicate_positions': duplicates,
+            'dropped_positions': int((~fits).sum()) - duplicates}
+
+
+def encode_file(path, out_dir, workers=1, dedupe=None):
+    """ Encodes every game of a GameString file into SHARD_GAMES game shards under out_dir, described by a manifest.
+        With dedupe, the path of a position index built from this file, only the first occurrence of each position
+        (up to symmetry) is kept.
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [(out_dir, n, i, lines[i:i + SHARD_GAMES], dedupe) for n, i in enumerate(range(0, len(lines), SHARD_GAMES))]
+
+    start = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        shards = list(pool.imap(encode_shard, tasks))
+
+    manifest = {
+        'source': os.path.basename(path),
+        'created': int(time.time()),
+        'dedupe': dedupe,
+        'board_size': BOARD_SIZE,
+        'planes': PLANE_NAMES,
+        'arrays': {
+            'boards': 'uint8 (positions, planes, board_size, board_size), rows are r and columns q',
+            'to_move': 'uint8, 0 white 1 black',
+            'ply': 'uint16, index of the move played from the position',
+            'move': 'uint16, db.move_codec code of the move played from the position',
+            'game': 'uint32, line index of the game in the source file',
+            'outcome': 'uint8, index of the GameStateString in db.move_codec.GAME_STATES',
+            'value': 'int8, final result for the side to move: 1 win, 0 draw, -1 loss',
+        },
+        'positions': sum(shard['positions'] for shard in shards),
+        'games': sum(shard['games'] for shard in shards),
+        'shards': shards,
+    }
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    elapsed = time.time() - start
+    print(f'{path}: encoded {manifest["positions"]} positions of {manifest["games"]} games into {len(shards)} shards '
+          f'in {elapsed:.1f}s ({manifest["positions"] / elapsed if elapsed else 0:.0f} positions/s)')
+    return manifest
+
+
+def iter_shards(out_dir):
+    """ Yields each shard of an encoded file in order as a dict of arrays
+    """
+    with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    for shard in manifest['shards']:
+        with np.load(os.path.join(out_dir, shard['file'])) as arrays:
+            yield dict(arrays)
+
+
+# python -m scripts.tensor_encoder [game_strings files], the latest export by default
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='GameString files to encode, the latest file in game_strings/ by default')
+    parser.add_argument('--out', default=TENSOR_DIR, help='shards of each file go in a directory named after it under this one')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='encoder processes')
+    parser.add_argument('--dedupe', metavar='INDEX', help='drop repeated positions, using a scripts.position_index index built from the same file')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob('game_strings/*.txt'), key=os.path.getmtime)[-1:]
+    for path in paths:
+        encode_file(path, os.path.join(args.out, os.path.splitext(os.path.basename(path))[0]), args.workers, args.dedupe)
@@ -0,0 +1,36 @@
+import os
+
+# UHP string helpers shared by the exporter and the readers of its files, which must not need the DB
+UHP_BASE_GAME = 'Base'
+TABLE_IDS_SUFFIX = '.tables'
+
+
+def get_game_type_string(m, l, p):
+    """ Returns the UHP GameTypeString for the given expansion booleans
+    """
+    game_type_string = UHP_BASE_GAME
+    if m or l or p:
+        game_type_string += '+'
+    if m:
+        game_type_string += 'M'
+    if l:
+        game_type_string += 'L'
+    if p:
+        game_type_string += 'P'
+
+    return game_type_string
+
+
+def get_turn_string(num_moves):
+    """ Returns the UHP TurnString of the side to move after num_moves moves
+    """
+    turn_num = (num_moves // 2) + 1
+    turn_string = 'White' if num_moves % 2 == 0 else 'Black'
+
+    return f'{turn_string}[{turn_num}]'
+
+
+def table_ids_path(path):
+    """ Returns the path of the .tables file listing the table_id of every line of an export
+    """
+    return os.path.splitext(path)[0] + TABLE_IDS_SUFFIX
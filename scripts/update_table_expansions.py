@@ -2,10 +2,9 @@ import db.hive_db as hive_db
 import scripts.bga_scraping as bga_scraping
 import scripts.entomology_scraping as ent_scraping
 import json
-import time
 import zlib
 from ctypes import c_uint32
-from requests import Session
+from scripts import http_client
 
 from requests import JSONDecodeError
 from requests.exceptions import RequestException, HTTPError
@@ -20,7 +19,7 @@ from selenium.webdriver.support import expected_conditions as EC
 
 def insert_new_table(driver, sess, uuid, i):
     try:
-        results = ent_scraping.analyze_table_data(driver, sess, uuid, 'lmp', ranked=True, tournament=False)
+        results = ent_scraping.analyze_table_data(driver, sess, uuid, 'lmp', ranked=True, tournament=False, table_id=i)
         if results:
             hive_db.insert_table_data(i, *results)
             print(f'Inserted table_id: {i}, num_moves: {len(results[-1])}')
@@ -33,8 +32,9 @@ def insert_new_table(driver, sess, uuid, i):
     
     except WebDriverException as e:
         print(e)
-        print('Attempting to establish new connection in 1 minute...')
-        time.sleep(60)
+        print('Attempting to establish new connection...')
+        http_client.record_failure(ent_scraping.BASE)
+        http_client.wait_for_host(ent_scraping.BASE)
 
         if driver:
             driver.quit()
@@ -42,10 +42,10 @@ def insert_new_table(driver, sess, uuid, i):
         driver = ent_scraping.new_webdriver()
 
     except RequestException as e:
+        # the session already retried, wait for the host to come back
         print(e)
-        print('Attempting to establish new connection in 1 minute...')
-        time.sleep(60)
-        sess = Session()
+        print('Attempting to establish new connection...')
+        http_client.wait_for_host(ent_scraping.BASE)
 
 
 def update_entomology_table(sess, table_id):
@@ -56,7 +56,7 @@ def update_entomology_table(sess, table_id):
 if __name__ == "__main__":
     table_ids = hive_db.get_unique_table_ids()
     bga_sess = bga_scraping.get_next_session()
-    ent_sess = Session()
+    ent_sess = http_client.Session()
     ent_driver = ent_scraping.new_webdriver()
 
     uuid_list = []
@@ -79,8 +79,7 @@ if __name__ == "__main__":
         else:
             table_id = index
 
-        resp = ent_sess.get(ent_scraping.BASE + ent_scraping.construct_xhr(uuid_list[index]))
-        j = resp.json()
+        j = ent_scraping.fetch_game(ent_sess, uuid_list[index], table_id)
         if j:
             m = 'm' in j['variant']
             l = 'l' in j['variant']
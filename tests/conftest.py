@@ -0,0 +1,60 @@
+import os
+import sys
+import types
+
+import pytest
+
+# the tests import db and scripts from the repo root, wherever pytest is run from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# hive_db opens its shared handle on import, keep it off the real DB: every test opens its own
+os.environ.setdefault('HIVEMIND_DB', ':memory:')
+
+# the scrapers import the credentials in accounts.py, which isn't committed. The tests log in with their own.
+try:
+    import accounts
+except ImportError:
+    sys.modules['accounts'] = types.ModuleType('accounts')
+    sys.modules['accounts'].ACCOUNTS = []
+
+from db import hive_db
+from db import metrics
+from scripts import http_cache
+from scripts import http_client
+from scripts import replay_archive
+
+
+@pytest.fixture(autouse=True)
+def isolated_metrics(tmp_path, monkeypatch):
+    """ Keeps the metrics every test records in its own tmp_path
+    """
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path / 'metrics'))
+    monkeypatch.setattr(metrics, '_metrics', {})
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ Runs the test in tmp_path with its own DB behind the module level functions, and fresh per-process
+        response cache, replay archive and rate limiters
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(http_cache, '_caches', {})
+    monkeypatch.setattr(replay_archive, '_archives', {})
+    monkeypatch.setattr(http_client, '_limiters', {})
+    # the fake server answers at once, there's nothing to be polite to
+    monkeypatch.setattr(http_client, 'DEFAULT_RATE', 1000.0)
+    monkeypatch.setattr(http_client, 'ACCOUNT_RATE', 1000.0)
+
+    with hive_db.use_db(str(tmp_path / 'hivemind.db')):
+        yield tmp_path
+
+
+@pytest.fixture
+def bga():
+    """ A FakeBGA server, see fake_bga.py
+    """
+    from fake_bga import FakeBGA
+
+    fake = FakeBGA().start()
+    yield fake
+    fake.stop()
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from scripts.bga_scraping import LOGIN, RANKING, GAMES, TABLE, ARCHIVE, REPLAY, DEPLETED, NO_ACCESS, EMPTY_ARCHIVE
+
+HISTORY_PAGE_SIZE = 10
+TABLE_INTERVAL = 3600   # seconds between two games of a player's history
+LATENCY = 0.01          # seconds every request takes, so concurrent requests overlap
+
+
+class FakeBGA:
+    """ Local stand-in for the BoardGameArena endpoints the scrapers use, served from a background thread.
+        Every player has `history` tables, newest first with one forfeit in five, and every account can fetch
+        `replay_limit` replays before it gets DEPLETED. Accounts are told apart by the request token they logged in with.
+    """
+
+    def __init__(self, players=(1001, 1002, 1003), history=25, replay_limit=1000, lost=(), no_access=(), banned=()):
+        self.players = list(players)
+        self.history = history
+        self.replay_limit = replay_limit
+        self.lost = set(lost)             # table_ids whose replay is lost
+        self.no_access = set(no_access)   # emails of accounts too new to access replays
+        self.banned = set(banned)         # emails of banned accounts
+        self.now = int(time.time())
+        self.tokens = {}                  # request token -> email
+        self.replays = {}                 # email -> replays fetched
+        self.requests = []                # (path, params) of every request
+        self.in_flight = {}               # email -> requests being answered
+        self.max_in_flight = {}           # email -> most requests answered at once
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def base(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self, parse_qs(urlsplit(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                fake.handle(self, parse_qs(body))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def table_ids(self, player_id):
+        """ Returns the ids of every table in player_id's history, newest first
+        """
+        return [100000000 + player_id * 1000 + n for n in range(self.history, 0, -1)]
+
+    def table_end(self, table_id):
+        return self.now - (self.history - table_id % 1000) * TABLE_INTERVAL
+
+    def handle(self, request, params):
+        params = {key: values[0] for key, values in params.items()}
+        path = urlsplit(request.path).path
+        email = self.tokens.get(request.headers.get('X-Request-Token'))
+        with self.lock:
+            self.requests.append((path, params))
+            self.in_flight[email] = self.in_flight.get(email, 0) + 1
+            self.max_in_flight[email] = max(self.max_in_flight.get(email, 0), self.in_flight[email])
+
+        try:
+            time.sleep(LATENCY)
+            body = self.respond(path, params, email)
+        finally:
+            with self.lock:
+                self.in_flight[email] -= 1
+
+        if body is None:
+            request.send_error(404)
+            return
+
+        content = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        request.send_response(200)
+        # BGA answers json with a text/html content type
+        request.send_header('Content-Type', 'text/html')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    def respond(self, path, params, email):
+        if path == '/account':
+            token = f'token{len(self.tokens)}'
+            self.tokens[token] = None
+            return f'<html><input type="hidden" id="request_token" value="{token}"></html>'
+
+        if path == LOGIN:
+            self.tokens[params['request_token']] = params['email']
+            return {'status': 1}
+
+        if path == RANKING:
+            start = int(params['start'])
+            return {'data': {'ranks': [{'id': str(player_id)} for player_id in self.players[start:start + 10]]}}
+
+        if path == GAMES:
+            page = int(params['page'])
+            tables = [table_id for table_id in self.table_ids(int(params['player']))
+                      if int(params['start_date']) <= self.table_end(table_id) <= int(params['end_date'])]
+            tables = tables[(page - 1) * HISTORY_PAGE_SIZE:page * HISTORY_PAGE_SIZE]
+            return {'data': {'tables': [{'table_id': str(table_id), 'end': str(self.table_end(table_id)),
+                                         'concede': '1' if table_id % 5 == 0 else '0'} for table_id in tables]}}
+
+        if path == TABLE:
+            return {'status': 1, 'data': {'options': {'100': {'value': '2'}, '101': {'value': '2'}, '102': {'value': '1'}}}}
+
+        if path == ARCHIVE:
+            return {'status': 1}
+
+        if path == REPLAY:
+            return self.replay(int(params['table']), email)
+
+    def replay(self, table_id, email):
+        if email in self.banned:
+            return {'error': 'Replays are disabled for your account'}
+        if email in self.no_access:
+            return {'error': NO_ACCESS}
+
+        with self.lock:
+            self.replays[email] = self.replays.get(email, 0) + 1
+            if self.replays[email] > self.replay_limit:
+                return {'error': DEPLETED}
+
+        if table_id in self.lost:
+            return {'error': f'{EMPTY_ARCHIVE} (table {table_id})'}
+
+        white, black = table_id % 1000 + 1, table_id % 1000 + 2
+        return {'data': {'players': [{'id': black, 'color': '#000000'}, {'id': white, 'color': '#ffffff'}],
+                         'logs': [{'move_id': 1, 'data': [{'type': 'tokenPlayed', 'log': '', 'args': {'notation': 'wG1'}}]},
+                                  {'move_id': 2, 'data': [{'type': 'tokenPlayed', 'log': '', 'args': {'notation': 'bG1 wG1-'}},
+                                                          {'type': 'updateReflexionTime', 'log': ''}]},
+                                  {'move_id': 3, 'data': [{'type': 'message', 'log': 'passes'}]},
+                                  {'move_id': 4, 'data': [{'type': 'queenSurr', 'log': '', 'args': {'winner': white}}]}]}}
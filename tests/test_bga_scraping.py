@@ -0,0 +1,264 @@
+import asyncio
+import json
+
+import pytest
+
+from db import hive_db
+from scripts import bga_async_scraping
+from scripts import bga_scraping
+from scripts.bga_scraping import DEPLETED, EMPTY_ARCHIVE, NO_ACCESS
+
+ACCOUNTS = [('first@example.com', 'password'), ('second@example.com', 'password')]
+TABLES_PER_PLAYER = 20   # of the fake's 25 games per player, one in five is forfeit
+
+
+def replay_response(fake, table_id):
+    return fake.replay(table_id, ACCOUNTS[0][0])
+
+
+@pytest.mark.parametrize('error, expected', [
+    (DEPLETED, None),
+    (NO_ACCESS, None),
+    ('Replays are disabled for your account', None),
+    (f'{EMPTY_ARCHIVE} (table 5)', 5),
+    ('Something else went wrong', 5),
+])
+def test_parse_replay_errors(error, expected):
+    assert bga_scraping.parse_replay({'error': error}, 5, 'first@example.com', True, True, True) == expected
+
+
+def test_parse_replay(bga):
+    table_id = bga.table_ids(1001)[0]
+    white, black, winner, m, l, p, actions = bga_scraping.parse_replay(replay_response(bga, table_id), table_id, ACCOUNTS[0][0], True, True, False)
+
+    assert (white, black, winner, m, l, p) == (table_id % 1000 + 1, table_id % 1000 + 2, white, True, True, False)
+    assert [action['type'] for action in actions] == ['tokenPlayed', 'tokenPlayed', 'message', 'queenSurr']
+    assert [action['notation'] for action in actions[:2]] == ['wG1', 'bG1 wG1-']
+
+
+def test_parse_table_info():
+    options = {'data': {'options': {'100': {'value': '2'}, '101': {'value': '1'}, '102': {'value': '2'}}}}
+
+    assert bga_scraping.parse_table_info(options, 5) == (True, False, True)
+    assert bga_scraping.parse_table_info({'data': {'options': {}}}, 5) == 5
+    assert bga_scraping.parse_table_info({'error': 'Unknown table'}, 5) is None
+
+
+@pytest.fixture
+def sync_bga(workdir, bga, monkeypatch):
+    """ The fake server behind bga_scraping's sessions, logging in with ACCOUNTS in order
+    """
+    monkeypatch.setattr(bga_scraping, 'BASE', bga.base)
+    monkeypatch.setattr(bga_scraping, 'ACCOUNTS', ACCOUNTS)
+    monkeypatch.setattr(bga_scraping, 'sess_gen', None)
+    return bga
+
+
+def test_sync_session_scrapes_tables(sync_bga):
+    sess = bga_scraping.get_next_session()
+    players = bga_scraping.get_players_by_rank(sess, 3)
+    assert players == sync_bga.players
+
+    table_ids = bga_scraping.get_top_arena_tables(sess, players)
+    assert len(table_ids) == len(players) * TABLES_PER_PLAYER
+    assert not any(table_id % 5 == 0 for table_id in table_ids)
+
+    table_id = min(table_ids)
+    result = bga_scraping.analyze_table_data(sess, table_id)
+    assert result[:6] == (table_id % 1000 + 1, table_id % 1000 + 2, table_id % 1000 + 1, True, True, False)
+
+    # the replay is served from the response cache the second time, without using any quota
+    replays = sync_bga.replays[ACCOUNTS[0][0]]
+    assert bga_scraping.analyze_table_data(sess, table_id) == result
+    assert sync_bga.replays[ACCOUNTS[0][0]] == replays
+
+
+def test_sync_session_skips_lost_replays_and_stops_when_depleted(sync_bga):
+    table_ids = sync_bga.table_ids(1001)[:3]
+    sync_bga.lost.add(table_ids[0])
+    sync_bga.replay_limit = 1
+    sess = bga_scraping.get_next_session()
+
+    assert bga_scraping.analyze_table_data(sess, table_ids[0]) == table_ids[0]
+    assert bga_scraping.analyze_table_data(sess, table_ids[1]) is None
+
+    # the next account takes over
+    assert bga_scraping.get_next_session().email == ACCOUNTS[1][0]
+
+
+def scrape(bga, accounts, table_ids):
+    """ Logs in accounts to the fake server and scrapes table_ids with them. Returns the table ids left.
+    """
+    async def run():
+        accts = [await bga_async_scraping.login(email, password, base=bga.base) for email, password in accounts]
+        writer = hive_db.TableWriter()
+        try:
+            return await bga_async_scraping.scrape_tables(accts, table_ids, writer)
+        finally:
+            writer.flush()
+            await asyncio.gather(*(acct.close() for acct in accts))
+
+    return asyncio.run(run())
+
+
+def test_async_history_search(workdir, bga):
+    async def run():
+        acct = await bga_async_scraping.login(*ACCOUNTS[0], base=bga.base)
+        try:
+            players = await bga_async_scraping.get_players_by_rank(acct, 3)
+            return players, await bga_async_scraping.get_top_arena_tables(acct, players)
+        finally:
+            await acct.close()
+
+    players, table_ids = asyncio.run(run())
+    assert players == bga.players
+    assert table_ids == {table_id for player_id in players for table_id in bga.table_ids(player_id) if table_id % 5}
+
+
+def test_async_scrape_spreads_tables_over_accounts_until_depleted(workdir, bga):
+    bga.replay_limit = 10
+    table_ids = [table_id for player_id in bga.players for table_id in bga.table_ids(player_id) if table_id % 5]
+
+    remaining = scrape(bga, ACCOUNTS, table_ids)
+
+    stored = hive_db.get_unique_table_ids()
+    assert len(stored) == 2 * bga.replay_limit
+    assert sorted([*stored, *remaining]) == sorted(table_ids)
+    for email, _ in ACCOUNTS:
+        _, used, limit, _, depleted_timestamp = hive_db.get_account(email)
+        assert used == limit == bga.replay_limit
+        assert depleted_timestamp
+
+
+def test_async_scrape_skips_accounts_without_access(workdir, bga):
+    bga.no_access.add(ACCOUNTS[0][0])
+    table_ids = bga.table_ids(1001)[:8]
+
+    assert scrape(bga, ACCOUNTS, table_ids) == []
+    assert hive_db.get_unique_table_ids() == set(table_ids)
+    assert bga.replays.get(ACCOUNTS[1][0]) == len(table_ids)
+
+
+def test_async_requests_per_account_are_bounded(workdir, bga):
+    table_ids = [table_id for player_id in bga.players for table_id in bga.table_ids(player_id)]
+
+    scrape(bga, ACCOUNTS, table_ids)
+
+    for email, _ in ACCOUNTS:
+        assert 1 < bga.max_in_flight[email] <= bga_async_scraping.MAX_CONCURRENT_REQUESTS
+
+
+def test_account_quota_resets_after_its_window(workdir):
+    email = ACCOUNTS[0][0]
+    hive_db.update_account_quota(email, 5, False)
+    _, used, _, window_start, _ = hive_db.get_account(email)
+    assert used == 5
+
+    assert bga_async_scraping.account_due(email, window_start + 1)
+    assert hive_db.get_account(email)[1] == 5
+
+    # an account that never got depleted still starts a new window once REPLAY_RESET has passed
+    assert bga_async_scraping.account_due(email, window_start + bga_async_scraping.REPLAY_RESET)
+    assert hive_db.get_account(email)[1] == 0
+
+
+def test_depleted_account_waits_for_reset(workdir):
+    email = ACCOUNTS[0][0]
+    hive_db.update_account_quota(email, 5, True)
+    depleted_timestamp = hive_db.get_account(email)[4]
+
+    assert not bga_async_scraping.account_due(email, depleted_timestamp + 1)
+    assert bga_async_scraping.account_due(email, depleted_timestamp + bga_async_scraping.REPLAY_RESET)
+    assert hive_db.get_account(email)[1:5:3] == (0, None)
+
+
+def test_tables_left_by_a_depleted_scrape_stay_pending(workdir, bga):
+    async def search():
+        acct = await bga_async_scraping.login(*ACCOUNTS[0], base=bga.base)
+        try:
+            return await bga_async_scraping.get_top_arena_tables(acct, bga.players)
+        finally:
+            await acct.close()
+
+    bga.replay_limit = 10
+    table_ids = asyncio.run(search())
+    assert sorted(hive_db.get_pending_tables()) == sorted(table_ids)
+
+    # the watermark moved past every table, only the pending ones are left to scrape
+    remaining = scrape(bga, ACCOUNTS, hive_db.get_pending_tables())
+    assert remaining
+    assert sorted(hive_db.get_pending_tables()) == sorted(remaining)
+
+    # searching again finds nothing else to queue
+    asyncio.run(search())
+    assert sorted(hive_db.get_pending_tables()) == sorted(remaining)
+
+
+
+def test_frontier_searches_the_most_expected_new_games_first(workdir, monkeypatch):
+    now = 1_700_000_000
+    clock = [now - 60 * 86400]
+    monkeypatch.setattr(hive_db.time, 'time', lambda: clock[0])
+
+    # never searched, the ranking decides
+    hive_db.set_player_ranks([1, 2, 3])
+    assert hive_db.get_frontier(3) == [1, 2, 3]
+
+    # player 3 drops out of the ranking, and finds 300 new games in the month after a search, 10 a day
+    hive_db.set_player_ranks([1, 2])
+    hive_db.searched_player(3, 0)
+    clock[0] = now - 30 * 86400
+    hive_db.searched_player(3, 299)
+    clock[0] = now
+    assert hive_db.get_frontier(3) == [1, 3, 2]
+
+    # a player searched just now has nothing new to find
+    hive_db.searched_player(1, 0)
+    assert hive_db.get_frontier(3) == [3, 2, 1]
+    assert hive_db.get_frontier(2) == [3, 2]
+
+
+def test_is_known_history_page():
+    assert not bga_scraping.is_known_history_page([5, 4], {5, 4}, None)
+    assert bga_scraping.is_known_history_page([5, 4], {5}, 4)
+    assert not bga_scraping.is_known_history_page([6, 5, 4], {5}, 4)
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_history_search_stops_at_the_watermark(sync_bga, use_async):
+    sess = None if use_async else bga_scraping.get_next_session()
+
+    def search():
+        """ Searches player 1001's history, returns the tables found and the history pages requested
+        """
+        requested = len(sync_bga.requests)
+        if use_async:
+            async def run():
+                acct = await bga_async_scraping.login(*ACCOUNTS[0], base=sync_bga.base)
+                try:
+                    return await bga_async_scraping.get_top_arena_tables(acct, [1001])
+                finally:
+                    await acct.close()
+
+            table_ids = asyncio.run(run())
+        else:
+            table_ids = bga_scraping.get_top_arena_tables(sess, [1001])
+
+        return table_ids, sum(path == bga_scraping.GAMES for path, _ in sync_bga.requests[requested:])
+
+    history = sync_bga.table_ids(1001)
+    table_ids, pages = search()
+    assert table_ids == {table_id for table_id in history if table_id % 5}
+    assert pages >= 4  # the 3 pages of the history, and the empty one after them
+    assert hive_db.get_history_watermarks([1001])[1001][0] == history[0]
+
+    # once they're scraped, the first page is all at or before the watermark
+    hive_db.get_db().insert_many_table_data([(table_id, 1, 2, 1, True, True, False, []) for table_id in table_ids])
+    assert search() == (set(), 1)
+
+    # with 5 newer games, the search goes one page further to reach the watermark
+    sync_bga.history += 5
+    table_ids, pages = search()
+    assert table_ids == {table_id for table_id in sync_bga.table_ids(1001)[:5] if table_id % 5}
+    assert pages == 2
+    assert hive_db.get_history_watermarks([1001])[1001][0] == sync_bga.table_ids(1001)[0]
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from db import hive_db
+from scripts import hive_engine
+from scripts.uhp import get_turn_string
+
+# the scraper renders games with selenium when their moves can't be decoded
+pytest.importorskip('selenium')
+from scripts import entomology_scraping
+
+GAME = ['wG1', 'bG1 wG1-', 'wQ -wG1', 'bQ bG1-']
+
+# a game's json data in entomology's raw format, placements as 'dropb' and moves as 'move <bug>'
+RECORDED_GAME = r'''
+{"variant": "lmp", "ranked": 1, "tournament": 0, "white": {"name": "alice"}, "black": {"name": "bob"}, "result": "white",
+ "moves": ["dropb wG1 N 0 .", "dropb bG1 N 1 wG1-", "dropb wQ N 2 -wG1", "dropb bQ N 3 bG1-", "dropb wA1 N 4 -wQ",
+           "dropb bA1 N 5 bQ-", "move A wA1 N 6 bA1-", "dropb bA2 N 7 bQ/", "move Q wQ N 8 \\wG1", "move A bA2 N 9 -wQ"]}
+'''
+RECORDED_MOVES = ['wG1', 'bG1 wG1-', 'wQ -wG1', 'bQ bG1-', 'wA1 -wQ', 'bA1 bQ-', 'wA1 bA1-', 'bA2 bQ/', 'wQ \\wG1', 'bA2 -wQ']
+
+
+def test_parallel_crawl_keeps_a_game_that_fails_to_insert(workdir, monkeypatch):
+    uuid_list = [f'uuid{i}' for i in range(6)]
+
+    def analyze_table_data(driver, sess, uuid, *args, table_id=None, **kwargs):
+        # a notation sqlite can't bind fails the batch, then its own insert
+        notations = [object()] if table_id == 4 else GAME
+        return ('white', 'black', 'draw', True, True, True,
+                [{'notation': notation, 'move_number': n} for n, notation in enumerate(notations, start=1)])
+
+    # the worker processes fork with the patched module
+    monkeypatch.setattr(entomology_scraping, 'analyze_table_data', analyze_table_data)
+    entomology_scraping.crawl_parallel(uuid_list, workers=2, num_shards=2)
+
+    assert hive_db.get_unique_table_ids() == {0, 1, 2, 3, 5}
+    assert [table_id for table_id, _, _ in hive_db.get_crawl_failures()] == [4]
+    # a resumed crawl has nothing left, every game is either stored or recorded
+    assert entomology_scraping.plan_shards(len(uuid_list), 2) == []
+
+
+def test_decoder_reads_a_recorded_game():
+    j = json.loads(RECORDED_GAME)
+    actions = entomology_scraping.decode_moves(j)
+
+    assert [action['notation'] for action in actions] == RECORDED_MOVES
+    assert [action['move_number'] for action in actions] == list(range(1, len(RECORDED_MOVES) + 1))
+    assert entomology_scraping.game_metadata(j) == ('alice', 'bob', 'white', True, True, True)
+    hive_engine.check_game_string(f'Base+MLP;InProgress;{get_turn_string(len(RECORDED_MOVES))};' + ';'.join(RECORDED_MOVES))
+
+
+def test_games_are_rendered_until_the_decoder_agrees_with_chrome(monkeypatch):
+    rendered = [{'notation': notation, 'move_number': n} for n, notation in enumerate(RECORDED_MOVES, start=1)]
+    monkeypatch.setattr(entomology_scraping, 'fetch_game', lambda sess, uuid, table_id=None: json.loads(RECORDED_GAME))
+    monkeypatch.setattr(entomology_scraping, 'render_moves', lambda driver, uuid: rendered)
+    driver = object()
+
+    assert entomology_scraping.decoder_agrees(driver, None, ['uuid'])
+
+    # a decoder that is wrong but well formed keeps the crawl on chrome
+    rendered[-1] = {'notation': 'bA2 wQ/', 'move_number': len(rendered)}
+    assert not entomology_scraping.decoder_agrees(driver, None, ['uuid'])
+    assert entomology_scraping.analyze_table_data(driver, None, 'uuid', decode=False)[-1] == rendered
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+from scripts import game_dataset
+from scripts.generate_game_strings import table_ids_path
+
+GAME_STRINGS = ['Base+MLP;InProgress;Black[2];wQ;bQ wQ-;wG1 -wQ', 'Base;Draw;White[2];wA1;bA1 wA1-']
+
+
+def write_export(tmp_path, table_ids=None):
+    path = str(tmp_path / 'export.txt')
+    with open(path, 'w') as f:
+        f.write('\n'.join(GAME_STRINGS) + '\n')
+    if table_ids is not None:
+        with open(table_ids_path(path), 'w') as f:
+            f.write(''.join(f'{table_id}\n' for table_id in table_ids))
+
+    return path
+
+
+def test_entomology_table_id_zero_is_kept(tmp_path):
+    dataset = game_dataset.GameDataset(game_dataset.build_sidecar(write_export(tmp_path, [0, 100000001])))
+
+    assert [dataset.game(i)[:2] for i in range(len(dataset))] == [(0, 'entomology'), (100000001, 'bga')]
+    assert [dataset.game_string(i) for i in range(len(dataset))] == GAME_STRINGS
+    dataset.close()
+
+
+def test_export_without_table_ids(tmp_path):
+    dataset = game_dataset.GameDataset(game_dataset.build_sidecar(write_export(tmp_path), source='boardspace'))
+
+    assert [dataset.game(i)[:2] for i in range(len(dataset))] == [(None, 'boardspace'), (None, 'boardspace')]
+    dataset.close()
+
+
+def test_reading_a_dataset_does_not_open_the_db(tmp_path):
+    # e.g. a checkout with only the LFS stub of db/hivemind.db
+    code = "import sys; from scripts import game_dataset; sys.exit('db.hive_db' in sys.modules)"
+    env = {**os.environ, 'HIVEMIND_DB': str(tmp_path / 'missing' / 'hivemind.db')}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    assert subprocess.run([sys.executable, '-c', code], cwd=root, env=env).returncode == 0
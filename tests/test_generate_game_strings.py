@@ -0,0 +1,35 @@
+from db import hive_db
+from scripts import generate_game_strings
+from scripts.generate_game_strings import exported_table_ids, table_ids_path
+
+GAME = ['wG1', 'bG1 wG1-', 'wQ -wG1', 'bQ bG1-']
+FILTERS = {'include_bots': False, 'uses_m': True, 'uses_l': True, 'uses_p': True, 'include_bga': True, 'include_bs': True}
+
+
+def row(table_id, moves=GAME):
+    return (table_id, 'white', 'black', 'draw', True, True, True,
+            [{'notation': notation, 'move_number': n} for n, notation in enumerate(moves, start=1)])
+
+
+def lines(path):
+    with open(path) as f, open(table_ids_path(path)) as ids:
+        return f.read().splitlines(), [int(table_id) for table_id in ids.read().split()]
+
+
+def test_incremental_export_appends_tables_stored_out_of_order_once(workdir):
+    (workdir / 'game_strings').mkdir()
+    db = hive_db.get_db()
+    db.insert_many_table_data([row(2)])
+
+    path, count = generate_game_strings.run_export(FILTERS, 'test', 'test')
+    assert count == 1
+
+    # older and newer tables stored after the export, around an exported one written again
+    db.insert_many_table_data([row(1), row(3), row(2)], replace=True)
+    assert generate_game_strings.run_export(FILTERS, 'test', 'test') == (path, 2)
+
+    games, table_ids = lines(path)
+    assert table_ids == [2, 1, 3]
+    assert len(games) == 3
+    assert generate_game_strings.run_export(FILTERS, 'test', 'test') == (path, 0)
+    assert exported_table_ids(path) == {1, 2, 3}
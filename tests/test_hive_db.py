@@ -0,0 +1,126 @@
+import pytest
+
+from db import hive_db
+
+GAME = ['wQ', 'bQ wQ-', 'wG1 -wQ', 'bG1 bQ-']
+
+
+@pytest.fixture
+def db(tmp_path):
+    with hive_db.HiveDB(str(tmp_path / 'hivemind.db')) as db:
+        yield db
+
+
+def row(table_id, moves=GAME):
+    return (table_id, 'white', 'black', 'draw', True, True, True,
+            [{'notation': notation, 'move_number': n} for n, notation in enumerate(moves, start=1)])
+
+
+def test_failed_games_are_committed_with_the_checkpoint_past_them(db):
+    db.add_crawl_shards([(0, 3)])
+    shard_id = db.get_crawl_shards()[0][0]
+
+    writer = hive_db.TableWriter(db)
+    writer.add(*row(0))
+    writer.fail(1, 'DecodeError: could not decode the moves list')
+    writer.add(*row(2))
+    writer.checkpoint(shard_id, 3)
+    writer.flush()
+
+    assert db.get_crawl_shards()[0][3] == 3
+    assert [table_id for table_id, _, _ in db.get_crawl_failures()] == [1]
+
+
+def test_a_retried_game_leaves_the_failures(db):
+    writer = hive_db.TableWriter(db)
+    writer.fail(1, 'HTTPError: 502')
+    writer.flush()
+
+    writer.add(*row(1))
+    writer.flush()
+
+    assert db.get_crawl_failures() == []
+    assert db.get_unique_table_ids() == {1}
+
+
+def test_tables_are_selected_by_insertion_sequence_not_table_id(db):
+    db.insert_many_table_data([row(200, GAME[:2])])
+    watermark = db.get_last_seq()
+
+    # an older table stored later, and a stored table written again
+    db.insert_many_table_data([row(100, GAME[:3])])
+    db.insert_many_table_data([row(200, GAME[:2])], replace=True)
+
+    assert db.get_table_ids(seq_range=(watermark, db.get_last_seq())) == [100, 200]
+    assert db.get_table_ids(seq_range=(db.get_last_seq(), db.get_last_seq())) == []
+
+
+def test_a_row_failing_on_its_own_is_recorded_with_the_checkpoint(db):
+    db.add_crawl_shards([(0, 3)])
+    shard_id = db.get_crawl_shards()[0][0]
+
+    writer = hive_db.TableWriter(db)
+    writer.add(*row(0, GAME[:2]))
+    # a notation sqlite can't bind fails the batch, then its own insert
+    writer.add(1, 'white', 'black', 'draw', True, True, True, [{'notation': object(), 'move_number': 1}])
+    writer.add(*row(2, GAME[:3]))
+    writer.checkpoint(shard_id, 3)
+    writer.flush()
+
+    assert db.get_crawl_shards()[0][3] == 3
+    assert db.get_unique_table_ids() == {0, 2}
+    assert [(table_id, reason) for table_id, reason, _ in db.get_crawl_failures()] == [(1, 'insert failed')]
+
+
+def player_stats(db):
+    return db.con.execute('SELECT * FROM player_stats ORDER BY player_id, color, uses_mosquito, uses_ladybug, uses_pillbug').fetchall()
+
+
+def test_updating_expansions_moves_the_player_stats(db):
+    db.insert_many_table_data([row(1, GAME[:2]), row(2, GAME[:3])])
+    db.update_table_expansions(1, 0, 1, 0)
+    updated = player_stats(db)
+
+    db.rebuild_player_stats()
+    assert updated == player_stats(db)
+    assert all(games > 0 for *_, games, _, _, _, _ in updated)
+
+    # a later replace takes the game out of the new expansions, without leaving negative rows
+    db.insert_many_table_data([row(1, GAME[:2])], replace=True)
+    replaced = player_stats(db)
+    db.rebuild_player_stats()
+    assert replaced == player_stats(db)
+
+
+LONG_GAME = GAME + ['wA1 wQ\\', 'bA1 bQ/', 'wA1 bA1-', 'bA2 /bQ', 'wB1 wQ/', 'bB1 \\bQ']
+
+
+def test_updated_expansions_reject_the_same_game_from_another_source(db):
+    actions = row(0, LONG_GAME)[7]
+    # an entomology game first stored as a base game, then found to use every expansion
+    db.insert_many_table_data([(5, 'white', 'black', 'draw', False, False, False, actions)])
+    db.update_table_expansions(5, 1, 1, 1)
+
+    # the same game scraped from BGA is a duplicate
+    db.insert_many_table_data([(100000001, 1, 2, 1, True, True, True, actions)])
+    assert db.get_unique_table_ids() == {5}
+
+    # while a base game with the same moves is another game
+    db.insert_many_table_data([(100000002, 1, 2, 1, False, False, False, actions)])
+    assert db.get_unique_table_ids() == {5, 100000002}
+
+
+def test_only_an_upgraded_database_reports_its_migration(tmp_path, capsys):
+    hive_db.HiveDB(str(tmp_path / 'new.db')).close()
+    assert capsys.readouterr().out == ''
+
+    # a database left at schema version 10 by an older checkout
+    path = str(tmp_path / 'old.db')
+    con = hive_db.sqlite3.connect(path)
+    con.executescript(hive_db.DB_SCHEMA + ';\n'.join(hive_db.MIGRATIONS[:10]) + ';\nPRAGMA user_version = 10;')
+    con.close()
+
+    hive_db.HiveDB(path).close()
+    assert capsys.readouterr().out == f'Migrated {path} from schema version 10 to {len(hive_db.MIGRATIONS)}\n'
+    hive_db.HiveDB(path).close()
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,19 @@
+import random
+
+import pytest
+
+from scripts import hive_engine
+
+
+@pytest.mark.parametrize('expansions', [(), ('M', 'L', 'P')])
+def test_updated_articulation_points_match_a_new_search(expansions):
+    rng = random.Random(0)
+    for _ in range(20):
+        game = hive_engine.GameState(expansions)
+        for _ in range(150):
+            if game.state not in (hive_engine.NOT_STARTED, hive_engine.IN_PROGRESS):
+                break
+
+            legal = sorted(game.legal_moves())
+            game.play(game.move_string(*rng.choice(legal)) if legal else hive_engine.PASS_MOVE)
+            assert game.articulation_points() == hive_engine.articulation_points(game.stacks)
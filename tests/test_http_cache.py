@@ -0,0 +1,37 @@
+import os
+
+from scripts import http_cache
+
+
+def test_a_shared_blob_is_counted_once_when_evicting(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / 'cache'))
+    cache.put('https://example.com/a', None, b'same payload' * 100)
+    cache.put('https://example.com/b', None, b'same payload' * 100)
+    cache.put('https://example.com/c', None, b'other payload' * 100)
+    size = cache.size()
+    # the shared blob is the least recently used, dropping both its requests frees just enough
+    cache.con.execute("UPDATE responses SET last_access = 0 WHERE url LIKE '%/a' OR url LIKE '%/b'")
+    cache.con.commit()
+    cache.max_bytes = size - 1
+
+    cache.evict()
+
+    assert cache.get('https://example.com/a') is None
+    assert cache.get('https://example.com/b') is None
+    assert cache.get('https://example.com/c') == b'other payload' * 100
+    assert cache.size() <= cache.max_bytes
+
+
+def test_a_blob_is_kept_while_a_request_still_uses_it(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / 'cache'))
+    cache.put('https://example.com/a', None, b'same payload' * 100)
+    cache.put('https://example.com/b', None, b'same payload' * 100)
+    cache.con.execute("UPDATE responses SET created = 0 WHERE url LIKE '%/a'")
+    cache.con.commit()
+
+    cache.evict()
+
+    assert cache.get('https://example.com/a') is None
+    assert cache.get('https://example.com/b') == b'same payload' * 100
+    blob, = cache.con.execute('SELECT blob FROM responses').fetchone()
+    assert os.path.exists(cache._blob_path(blob))
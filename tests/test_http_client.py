@@ -0,0 +1,166 @@
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from scripts import http_client
+
+
+class FakeClock:
+    """ Stands in for the time module: sleeping only moves the clock forward
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeAdapter(BaseAdapter):
+    """ Answers every request with the next of the given statuses, or raises it if it's an exception
+    """
+
+    def __init__(self, statuses, headers=None):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+
+        resp = requests.Response()
+        resp.status_code, resp.request, resp.url = status, request, request.url
+        resp.headers.update(self.headers)
+        resp._content = b'{}'
+        return resp
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(http_client, 'time', clock)
+    monkeypatch.setattr(http_client, '_limiters', {})
+    # the longest backoff every time
+    monkeypatch.setattr(http_client.random, 'uniform', lambda lo, hi: hi)
+    return clock
+
+
+def session(statuses, headers=None):
+    sess = http_client.Session()
+    adapter = FakeAdapter(statuses, headers)
+    sess.mount('https://', adapter)
+    return sess, adapter
+
+
+def test_token_bucket_spends_its_burst_then_spaces_requests(clock):
+    bucket = http_client.TokenBucket(2.0, burst=4)
+    assert [bucket.reserve() for _ in range(6)] == [0, 0, 0, 0, 0.5, 1.0]
+
+    # tokens come back at the rate, up to the burst
+    clock.now += 100
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0, 0.5]
+
+
+def test_token_bucket_adapts_its_rate(clock):
+    bucket = http_client.TokenBucket(4.0)
+
+    # the responses to requests already in flight are the same throttling episode
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 2.0
+    clock.now += http_client.THROTTLE_COOLDOWN
+    bucket.throttled()
+    assert bucket.rate == 1.0
+
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 4.0
+
+    for _ in range(20):
+        clock.now += http_client.THROTTLE_COOLDOWN
+        bucket.throttled()
+    assert bucket.rate == http_client.MIN_RATE
+
+
+def test_circuit_breaker_opens_and_lets_one_trial_through(clock):
+    breaker = http_client.CircuitBreaker(failures=3, reset=60)
+    for _ in range(2):
+        breaker.failed()
+    breaker.check('host')
+
+    breaker.failed()
+    with pytest.raises(http_client.CircuitOpenError):
+        breaker.check('host')
+    assert breaker.wait_time() == 60
+
+    clock.now += 30
+    assert breaker.wait_time() == 30
+    with pytest.raises(http_client.CircuitOpenError):
+        breaker.check('host')
+
+    # half open: one trial goes through, the next request waits on it
+    clock.now += 30
+    breaker.check('host')
+    with pytest.raises(http_client.CircuitOpenError):
+        breaker.check('host')
+
+    # a failed trial keeps the circuit open for another period, a successful one closes it
+    breaker.failed()
+    assert breaker.wait_time() == 60
+    clock.now += 60
+    breaker.check('host')
+    breaker.succeeded()
+    breaker.check('host')
+    assert breaker.wait_time() == 0
+
+
+def test_session_retries_server_errors_with_backoff(clock):
+    sess, adapter = session([503, 500, 200], {'Retry-After': '7'})
+
+    assert sess.get('https://example.com/page').status_code == 200
+    assert adapter.sent == 3
+    # the server asked for 7 seconds both times
+    assert clock.sleeps == [7.0, 7.0]
+    # the 503 halved the host's rate, the success crept it back up
+    assert http_client.host_bucket('example.com').rate == http_client.DEFAULT_RATE / 2 + http_client.RATE_INCREASE
+
+
+def test_session_does_not_retry_client_errors(clock):
+    sess, adapter = session([404, 200])
+
+    assert sess.get('https://example.com/page').status_code == 404
+    assert adapter.sent == 1
+
+
+def test_session_gives_up_and_opens_the_circuit(clock, monkeypatch):
+    monkeypatch.setattr(http_client, 'MAX_RETRIES', 2)
+    sess, adapter = session([requests.exceptions.ConnectionError()] * 3 + [500, 500, 200])
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        sess.get('https://example.com/page')
+    assert adapter.sent == 3
+    assert clock.sleeps == [1.0, 2.0]
+
+    # the 5th failure in a row opens the circuit, the retry after it isn't sent
+    with pytest.raises(http_client.CircuitOpenError):
+        sess.get('https://example.com/page')
+    assert adapter.sent == 5
+
+    clock.now += http_client.CIRCUIT_RESET
+    assert sess.get('https://example.com/page').status_code == 200
+    assert http_client.breaker('example.com').wait_time() == 0
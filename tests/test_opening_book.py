@@ -0,0 +1,79 @@
+from db import hive_db
+from scripts import opening_book
+from scripts.generate_game_strings import exported_table_ids
+
+OPENING = ['wG1', 'bG1 wG1-', 'wQ -wG1', 'bQ bG1-']
+GAMES = {1: (OPENING + ['wA1 /wG1'], 'white wins'), 2: (OPENING + ['wA1 wQ\\'], 'black wins'),
+         3: (OPENING + ['wA1 wQ/'], 'draw'), 4: (OPENING[:3] + ['bQ bG1/'], 'white wins')}
+FILTERS = {'include_bots': False, 'uses_m': True, 'uses_l': True, 'uses_p': True, 'include_bga': True, 'include_bs': True}
+
+
+def row(table_id, moves, winner):
+    return (table_id, 'white', 'black', winner, True, True, True,
+            [{'notation': notation, 'move_number': n} for n, notation in enumerate(moves, start=1)])
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_a_written_book_is_read_back(tmp_path):
+    root = opening_book.Node()
+    for moves, winner in GAMES.values():
+        state = hive_db.BS_RESULTS[winner]
+        opening_book.add_game(root, *opening_book.canonical_moves(f'Base+MLP;{state};;' + ';'.join(moves)))
+    path = str(tmp_path / 'book.bin')
+    opening_book.write_book(path, root, 5, len(GAMES))
+
+    book = opening_book.OpeningBook(path)
+    assert (book.depth, book.games) == (5, 4)
+    assert book.results(0) == (2, 1, 1)
+    assert book.results(book.lookup('Base+MLP', ';'.join(OPENING))) == (1, 1, 1)
+    # the same placement written from another piece is the same node
+    assert book.lookup('Base+MLP', ';'.join(OPENING + ['wA1 /wG1'])) == book.lookup('Base+MLP', ';'.join(OPENING + ['wA1 wQ\\']))
+    assert book.lookup('Base+MLP', ';'.join(OPENING + ['wA1 -wQ'])) is None
+    assert sorted(book.continuations(book.lookup('Base+MLP', ';'.join(OPENING[:3])))) == [
+        ('bQ bG1-', 1, 1, 1), ('bQ bG1/', 1, 0, 0)]
+
+    # the trie read back writes the same book
+    opening_book.write_book(str(tmp_path / 'copy.bin'), opening_book.read_trie(book), 5, len(GAMES))
+    book.close()
+    assert read(str(tmp_path / 'copy.bin')) == read(path)
+
+
+def test_an_updated_book_is_the_rebuilt_book(workdir):
+    db = hive_db.get_db()
+    db.insert_many_table_data([row(2, *GAMES[2])])
+    path = opening_book.update_book(FILTERS, 'test')
+
+    # older and newer tables stored after the book
+    db.insert_many_table_data([row(table_id, *GAMES[table_id]) for table_id in (1, 3, 4)])
+    assert opening_book.update_book(FILTERS, 'test') == path
+    rebuilt = opening_book.update_book(FILTERS, 'full', rebuild=True)
+
+    assert read(path) == read(rebuilt)
+    assert exported_table_ids(path) == exported_table_ids(rebuilt) == {1, 2, 3, 4}
+    book = opening_book.OpeningBook(path)
+    assert book.games == 4
+    book.close()
+
+
+def test_a_rewritten_table_rebuilds_the_book(workdir, capsys):
+    db = hive_db.get_db()
+    db.insert_many_table_data([row(table_id, *GAMES[table_id]) for table_id in (1, 2, 3)])
+    path = opening_book.update_book(FILTERS, 'test')
+
+    # table 1 is scraped again and turns out to be another game, its old moves must leave the book
+    db.insert_many_table_data([row(1, *GAMES[4])], replace=True)
+    capsys.readouterr()
+    opening_book.update_book(FILTERS, 'test')
+    assert '1 tables of' in capsys.readouterr().out
+
+    rebuilt = opening_book.update_book(FILTERS, 'full', rebuild=True)
+    assert read(path) == read(rebuilt)
+    book = opening_book.OpeningBook(path)
+    assert book.games == 3
+    # only table 2's win is left at the placement table 1 also played
+    assert book.results(book.lookup('Base+MLP', ';'.join(GAMES[1][0]))) == (0, 1, 0)
+    book.close()
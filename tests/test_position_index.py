@@ -0,0 +1,78 @@
+import random
+
+import numpy as np
+import pytest
+
+from scripts import hive_engine
+from scripts import position_index
+
+
+def random_game_string(seed, moves=40):
+    rng = random.Random(seed)
+    game = hive_engine.GameState(('M', 'L', 'P'))
+    played = []
+    while len(played) < moves and game.state in (hive_engine.NOT_STARTED, hive_engine.IN_PROGRESS):
+        legal = sorted(game.legal_moves())
+        played.append(game.move_string(*rng.choice(legal)) if legal else hive_engine.PASS_MOVE)
+        game.play(played[-1])
+
+    return 'Base+MLP;InProgress;White[1];' + ';'.join(played)
+
+
+def key_of(stones, to_move, game_type):
+    return position_index.game_key(position_index.hash_positions(stones, to_move, game_type)[0])
+
+
+@pytest.mark.parametrize('swap', [False, True])
+def test_symmetric_games_have_the_same_key(swap):
+    stones, to_move, game_type, _ = position_index.replay_stones(random_game_string(0))
+    position, kinds, level, q, r = stones
+    key = key_of(stones, to_move, game_type)
+    assert key == position_index.game_key_of(random_game_string(0))
+
+    assert len(position_index.SYMMETRIES) == 12
+    for a, b, c, d in position_index.SYMMETRIES:
+        # every symmetry of the board, somewhere else on it, possibly with the colours swapped
+        moved = np.array([position, kinds ^ (position_index.COLOR_SWAP * swap), level, a * q + b * r + 3, c * q + d * r - 5])
+        assert key_of(moved, to_move ^ swap, game_type) == key
+
+    assert key != position_index.game_key_of(random_game_string(1))
+
+
+def test_a_written_table_is_looked_up(tmp_path):
+    path = str(tmp_path / 'positions.idx')
+    # there are at least 1024 slots, so the keys ending in 5 collide, and 2047 wraps around past 1023
+    keys = np.array([5, 1024 + 5, 2048 + 5, 5, 6, 2047, 1023], dtype=np.uint64)
+    white = np.array([1, 0, 0, 1, 0, 0, 0], dtype=bool)
+    black = np.array([0, 1, 0, 0, 0, 0, 0], dtype=bool)
+    draws = np.array([0, 0, 1, 0, 1, 0, 0], dtype=bool)
+    games = np.array([7, 8, 9, 3, 4, 5, 6], dtype=np.uint64)
+    position_index.write_table(path, keys, white, black, draws, games)
+
+    index = position_index.PositionIndex(path)
+    assert (index.slots, index.entries, index.positions) == (1024, 6, 7)
+    assert list(index.table['key'][5:9]) == [5, 6, 1024 + 5, 2048 + 5]  # probed past 6 in its own slot
+    assert list(index.table['key'][[1023, 0]]) == [1023, 2047]
+
+    found = {key: index.lookup(np.uint64(key)) for key in (5, 1024 + 5, 2048 + 5, 6, 2047, 1023)}
+    assert {key: (int(e['count']), int(e['white_wins']), int(e['black_wins']), int(e['draws']), int(e['first_game']))
+            for key, e in found.items()} == {
+        5: (2, 2, 0, 0, 3), 1029: (1, 0, 1, 0, 8), 2053: (1, 0, 0, 1, 9), 6: (1, 0, 0, 1, 4), 2047: (1, 0, 0, 0, 5),
+        1023: (1, 0, 0, 0, 6)}
+    # missing keys are only found missing at the end of their probe sequence
+    assert index.lookup(np.uint64(3072 + 5)) is None
+    assert index.lookup(np.uint64(3072 + 1023)) is None
+    assert index.lookup(np.uint64(100)) is None
+
+
+def test_an_indexed_game_finds_its_positions(tmp_path):
+    path = str(tmp_path / 'positions.idx')
+    game_strings = [random_game_string(0), random_game_string(1)]
+    position_index.write_table(path, *position_index.hash_chunk(list(enumerate(game_strings))))
+
+    index = position_index.PositionIndex(path)
+    stats = index.occurrences(game_strings[0])
+    assert len(stats) == 40
+    assert all(count >= 1 for count, *_ in stats)
+    # both games start from the empty board
+    assert stats[0][0] == 2
@@ -0,0 +1,18 @@
+import pytest
+
+from db import hive_db
+
+
+@pytest.fixture
+def db(tmp_path):
+    with hive_db.HiveDB(str(tmp_path / 'hivemind.db')) as db:
+        yield db
+
+
+def test_migrations_reach_latest_version(db):
+    assert db.con.execute('PRAGMA user_version').fetchone()[0] == len(hive_db.MIGRATIONS)
+
+
+def test_hot_queries_use_an_index(db):
+    full_scans = db.check_query_plans()
+    assert not full_scans, '\n'.join(f'{name} performs a full scan: {plan}' for name, plan in full_scans.items())
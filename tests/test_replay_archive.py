@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+from db import hive_db
+from scripts import bga_async_scraping
+from scripts import replay_archive
+from scripts.replay_archive import KIND_BGA_REPLAY, KIND_BGA_TABLE
+
+
+def snapshot(db):
+    """ Every tables and actions row, without the insertion sequence a rewrite moves
+    """
+    tables = db.con.execute(f'SELECT {hive_db.TABLE_COLUMNS} FROM tables ORDER BY table_id').fetchall()
+    actions = db.con.execute('SELECT * FROM actions ORDER BY table_id, move_number, type').fetchall()
+
+    return tables, actions
+
+
+def test_the_latest_copy_is_read_back(tmp_path, monkeypatch):
+    # every record starts a new segment
+    monkeypatch.setattr(replay_archive, 'SEGMENT_BYTES', 1)
+    archive = replay_archive.ReplayArchive(str(tmp_path / 'archive'))
+    archive.put(1, KIND_BGA_TABLE, b'table 1')
+    archive.put(1, KIND_BGA_REPLAY, b'replay 1')
+    archive.put(2, KIND_BGA_REPLAY, b'replay 2')
+    archive.put(1, KIND_BGA_REPLAY, b'replay 1 again')
+    archive.put_new(2, KIND_BGA_REPLAY, b'replay 2 again')
+
+    assert archive.get(1, KIND_BGA_TABLE) == b'table 1'
+    assert archive.get(1, KIND_BGA_REPLAY) == b'replay 1 again'
+    assert archive.get(2, KIND_BGA_REPLAY) == b'replay 2'
+    assert archive.get(2, KIND_BGA_TABLE) is None
+    assert archive.get_table_ids(KIND_BGA_REPLAY) == [1, 2]
+    assert len([name for name in os.listdir(archive.path) if name.startswith('segment-')]) == 4
+
+
+def test_a_lost_index_is_rebuilt_from_the_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(replay_archive, 'SEGMENT_BYTES', 40)
+    path = str(tmp_path / 'archive')
+    archive = replay_archive.ReplayArchive(path)
+    for i in range(5):
+        archive.put(i % 3, KIND_BGA_REPLAY, f'replay {i}'.encode())
+    archive.con.close()
+    for name in os.listdir(path):
+        if name.startswith('index.db'):
+            os.remove(os.path.join(path, name))
+
+    # a record cut short by a crash while it was appended
+    last_segment = max(name for name in os.listdir(path) if name.startswith('segment-'))
+    with open(os.path.join(path, last_segment), 'ab') as f:
+        f.write(replay_archive.FRAME_HEADER.pack(KIND_BGA_REPLAY, 0, 100) + b'cut')
+
+    archive = replay_archive.ReplayArchive(path)
+    assert archive.get_table_ids(KIND_BGA_REPLAY) == []
+    assert archive.rebuild_index() == len([name for name in os.listdir(path) if name.startswith('segment-')]) > 1
+
+    assert archive.get_table_ids(KIND_BGA_REPLAY) == [0, 1, 2]
+    assert [archive.get(i, KIND_BGA_REPLAY) for i in range(3)] == [b'replay 3', b'replay 4', b'replay 2']
+
+
+def test_reparse_writes_the_rows_of_the_original_parse(workdir, bga):
+    async def scrape(table_ids):
+        acct = await bga_async_scraping.login('first@example.com', 'password', base=bga.base)
+        writer = hive_db.TableWriter()
+        try:
+            return await bga_async_scraping.scrape_tables([acct], table_ids, writer)
+        finally:
+            writer.flush()
+            await acct.close()
+
+    table_ids = [table_id for table_id in bga.table_ids(1001) if table_id % 5][:6]
+    assert asyncio.run(scrape(table_ids)) == []
+    db = hive_db.get_db()
+    scraped = snapshot(db)
+    assert [row[0] for row in scraped[0]] == sorted(table_ids)
+
+    # rows a parser bug got wrong are replaced
+    with db.con:
+        db.con.execute("UPDATE actions SET notation = 'wQ' WHERE notation = 'wG1'")
+        db.con.execute('UPDATE tables SET winner = NULL')
+    replay_archive.reparse(2, [KIND_BGA_REPLAY])
+    assert snapshot(db) == scraped
+
+    # and an empty DB gets them all back
+    with hive_db.use_db(str(workdir / 'reparsed.db')) as reparsed:
+        replay_archive.reparse(2, [KIND_BGA_REPLAY])
+        assert snapshot(reparsed) == scraped
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+from db.move_codec import GAME_STATES, encode_move
+from scripts import position_index
+from scripts import tensor_encoder
+
+GAMES = [['wG1', 'bG1 wG1-', 'wQ -wG1', 'bQ bG1-'], ['wG1', 'bG1 -wG1', 'wQ wG1-'], ['wG1', 'bG1 wG1-', 'wQ wG1-'],
+         ['wQ', 'bQ wQ-', 'wB1 -wQ', 'bB1 bQ-', 'wB1 wQ', 'bB1 bQ']]
+STATES = ['WhiteWins', 'Draw', 'BlackWins', 'BlackWins']
+
+
+def write_games(tmp_path):
+    """ Writes GAMES to a GameString file, the third one with an illegal move
+    """
+    path = str(tmp_path / 'games.txt')
+    with open(path, 'w') as f:
+        f.writelines(f'Base;{state};White[1];{";".join(moves)}\n' for moves, state in zip(GAMES, STATES))
+
+    return path
+
+
+def test_shards_read_back_every_position(tmp_path, monkeypatch):
+    monkeypatch.setattr(tensor_encoder, 'SHARD_GAMES', 2)
+    out_dir = str(tmp_path / 'tensors')
+    manifest = tensor_encoder.encode_file(write_games(tmp_path), out_dir)
+
+    with open(f'{out_dir}/{tensor_encoder.MANIFEST}') as f:
+        assert json.load(f) == manifest
+    assert [(shard['games'], shard['positions'], shard['skipped_games']) for shard in manifest['shards']] == [(2, 7, 0), (1, 6, 1)]
+
+    arrays = {name: np.concatenate([shard[name] for shard in tensor_encoder.iter_shards(out_dir)]) for name in manifest['arrays']}
+    played = [moves for i, moves in enumerate(GAMES) if i != 2]
+    assert arrays['boards'].shape == (13, tensor_encoder.PLANES, tensor_encoder.BOARD_SIZE, tensor_encoder.BOARD_SIZE)
+    assert arrays['game'].tolist() == [0] * 4 + [1] * 3 + [3] * 6
+    assert arrays['ply'].tolist() == [ply for moves in played for ply in range(len(moves))]
+    assert arrays['move'].tolist() == [encode_move(move) for moves in played for move in moves]
+    assert arrays['to_move'].tolist() == [ply % 2 for moves in played for ply in range(len(moves))]
+    assert arrays['outcome'].tolist() == [GAME_STATES.index(STATES[game]) for game in arrays['game'].tolist()]
+    # seen from the side to move: white won game 0, game 1 was drawn and black won game 3
+    assert arrays['value'].tolist() == [1, -1, 1, -1, 0, 0, 0, -1, 1, -1, 1, -1, 1]
+
+    boards = arrays['boards']
+    assert not boards[0].any()
+    # in the last position of game 3 the white beetle is on top of its queen
+    last = boards[12]
+    assert sorted(last[tensor_encoder.HEIGHT_PLANE][last[tensor_encoder.HEIGHT_PLANE] > 0].tolist()) == [1, 1, 2]
+    assert [last[tensor_encoder.piece_plane(piece)].sum() for piece in ('wB', 'wQ', 'bB', 'bQ')] == [1, 0, 1, 1]
+    assert last[tensor_encoder.HEIGHT_PLANE][last[tensor_encoder.piece_plane('wB')] == 1].tolist() == [2]
+
+
+def test_dedupe_keeps_the_first_occurrence_of_each_position(tmp_path):
+    path = write_games(tmp_path)
+    index_path = str(tmp_path / 'positions.idx')
+    with open(path) as f:
+        position_index.write_table(index_path, *position_index.hash_chunk(list(enumerate(f))))
+
+    manifest = tensor_encoder.encode_file(path, str(tmp_path / 'tensors'), dedupe=index_path)
+    game = np.concatenate([shard['game'] for shard in tensor_encoder.iter_shards(str(tmp_path / 'tensors'))])
+
+    # game 1 is a reflection of game 0's first positions, and every game starts from the empty board
+    assert game.tolist() == [0] * 4 + [3] * 5
+    assert manifest['shards'][0]['duplicate_positions'] == 4
+    assert manifest['positions'] == position_index.PositionIndex(index_path).entries